@@ -0,0 +1,458 @@
+"""
+Bulk backfill: moves historical points to the database in large gzipped chunks.
+
+The uploaders write a loop's worth of points at a time, fine for live data but days
+to move a few million points after an outage or from the local 1.x database to the
+cloud bucket. This reads a local source as a stream of line protocol, cuts it in
+chunks of `--chunk` lines, gzips them and keeps `--parallel` requests in flight.
+
+    python backfill.py influx1 [--start 2024-05-01] [--end 2024-06-01]   the [Local] database
+    python backfill.py file export.lp[.gz]                               a line protocol file
+    python backfill.py spool [spool]                                     a spool folder (not emptied)
+    python backfill.py sqlite [data/solar.sqlite]                        the [SQLite] database
+
+The destination is the [Cloud] bucket or the [Local] database, as [Method] Cloud in
+config.ini says (or --to cloud/local/collector).
+
+Chunks that fail are retried with a growing delay. Progress is saved in a checkpoint
+file every time the chunks before it are all written, so an interrupted run (Ctrl+C,
+power cut, too many failures) carries on from there when started again with the
+same arguments. A throughput report is printed every `--report` seconds and at the end.
+
+classes:
+    - destination: the write end point, one keep-alive connection per thread
+    - backfill: reads, chunks, sends and checkpoints
+"""
+
+import sys, os, time, json, gzip, math, argparse, pathlib, threading, http.client
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse, urlencode
+import rpi_errors as rpie
+from line_protocol import line_encoder
+
+
+# sources: each one yields line protocol strings with ns timestamps, always in the same order
+
+def influx1_lines(config, start:float = None, end:float = None, window:float = 86400):
+    """
+    Every point of the [Local] database, one measurement after the other, `window` seconds at a time
+
+    1.x answers in JSON, where a float field of 2.0 comes back as 2: the field types are
+    read with SHOW FIELD KEYS so they are written as they were, and not as integers.
+    """
+    from influxdb import InfluxDBClient
+
+    local_dir = config.get_local()
+    client = InfluxDBClient(local_dir["ifhost"], local_dir["ifport"], local_dir["ifuser"], local_dir["ifpass"], local_dir["ifdb"])
+    encoder = line_encoder()
+    casts = {"float": float, "integer": int, "string": str, "boolean": bool}
+    quote = lambda name: '"' + name.replace('"', '\\"') + '"'
+
+    measurements = sorted(item["name"] for item in client.query("SHOW MEASUREMENTS").get_points())
+    for measurement in measurements:
+        types = {item["fieldKey"]: casts.get(item["fieldType"], float)
+                 for item in client.query(f"SHOW FIELD KEYS FROM {quote(measurement)}").get_points()}
+        first = start
+        if first is None:
+            oldest = list(client.query(f"SELECT * FROM {quote(measurement)} ORDER BY time ASC LIMIT 1", epoch="ns").get_points())
+            if not oldest: continue
+            first = oldest[0]["time"]/1e9
+        last = time.time() if end is None else end
+        window_start = math.floor(first)
+        while window_start < last:
+            window_end = min(window_start + window, last)
+            result = client.query(f"SELECT * FROM {quote(measurement)} WHERE time >= {int(window_start*1e9)} "
+                                  f"AND time < {int(window_end*1e9)} GROUP BY *", epoch="ns")
+            # GROUP BY * keeps the tags apart from the fields, series sorted so a resume sees the same order
+            for (_, tags), points in sorted(result.items(), key=lambda item: sorted((item[0][1] or {}).items())):
+                tags = tuple((key, value) for key, value in (tags or {}).items() if value not in (None, ""))
+                for point in points:
+                    fields = {key: types.get(key, float)(value) for key, value in point.items()
+                              if key != "time" and value is not None}
+                    line = encoder.encode(measurement, tags, fields, point["time"])
+                    if line is not None: yield line
+            window_start = window_end
+    client.close()
+
+
+def file_lines(filename:str):
+    """ a line protocol file, gzipped if it ends in .gz, comments and empty lines left out """
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt", encoding="utf-8") as file:
+        for line in file:
+            line = line.rstrip("\n")
+            if line.strip() and not line.startswith("#"): yield line
+
+
+def spool_lines(directory:str):
+    """
+    The segments of a spool folder that weren't replayed yet, oldest first.
+    The spool isn't changed: stop main.py first, and delete the folder once the backfill is done.
+    """
+    from spool import spool
+    backlog = spool(directory)
+    number, offset = backlog._read_offset()
+    for segment in backlog._segments():
+        with open(backlog._path(segment), "r") as file:
+            if segment == number: file.seek(offset)
+            for line in file:
+                line = line.rstrip("\n")
+                if line.strip(): yield line
+
+
+def sqlite_lines(filename:str, start:float = None, end:float = None):
+    from sqlite_solution import upload_data_sqlite
+    database = upload_data_sqlite(filename)
+    try:
+        yield from database.export_lines(start, end)
+    finally:
+        database.stop()
+
+
+class destination:
+    """
+        ## Purpose and use:
+            Sends gzipped line protocol to one write end point with http.client, keeping
+            one connection per thread alive between chunks (a new TLS handshake per chunk
+            costs more than the chunk on a slow uplink).
+
+                cloud:     {url}/api/v2/write?org=&bucket=&precision=ns   Authorization: Token
+                local:     http://ifhost:ifport/write?db=&u=&p=&precision=n
+                collector: {url}/write?source=backfill
+        ### Methods:
+            - `write`: sends one gzipped chunk
+    """
+    def __init__(self, url:str, path:str, headers:dict = None, timeout:float = 60):
+        """
+        ### Arguments:
+            url: str = scheme, host and port of the server
+            path: str = write path with its query string
+            headers: dict = extra headers, ie Authorization
+            timeout: float = seconds to wait for one request
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.hostname:
+            raise rpie.CriticalError(f"{url} is not a valid url")
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path.rstrip("/") + path
+        self.headers = {"Content-Type": "text/plain; charset=utf-8", "Content-Encoding": "gzip", **(headers or {})}
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @classmethod
+    def from_config(cls, config, name:str, timeout:float = 60):
+        """ the destination of a config.ini section: cloud, local or collector """
+        if name == "cloud":
+            cloud_dir = config.get_cloud()
+            query = urlencode({"org": cloud_dir["org"], "bucket": cloud_dir["bucket"], "precision": "ns"})
+            return cls(cloud_dir["url"], f"/api/v2/write?{query}", {"Authorization": f"Token {cloud_dir['token']}"}, timeout)
+        if name == "local":
+            local_dir = config.get_local()
+            query = urlencode({"db": local_dir["ifdb"], "u": local_dir["ifuser"], "p": local_dir["ifpass"], "precision": "n"})
+            return cls(f"http://{local_dir['ifhost']}:{str(local_dir['ifport']).strip()}", f"/write?{query}", timeout=timeout)
+        if name == "collector":
+            return cls(config.get_collector()["url"], "/write?source=backfill", timeout=timeout)
+        raise rpie.CriticalError(f"{name} is not a valid destination, use cloud, local or collector")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            kind = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            connection = self._local.connection = kind(self.host, self.port, timeout=self.timeout)
+        return connection
+
+    def write(self, body:bytes):
+        """
+        Args:
+            body (bytes): gzipped line protocol
+        Returns:
+            (int, str, float): status, response text and Retry-After seconds (None if not given)
+        Raises:
+            OSError, http.client.HTTPException: when the server can't be reached, the connection is dropped
+        """
+        connection = self._connection()
+        try:
+            connection.request("POST", self.path, body=body, headers=self.headers)
+            response = connection.getresponse()
+            text = response.read().decode("utf-8", "replace")
+        except Exception:
+            connection.close()
+            self._local.connection = None
+            raise
+        retry = response.getheader("Retry-After")
+        try:
+            retry = float(retry) if retry is not None else None
+        except ValueError:
+            retry = None
+        return response.status, text, retry
+
+
+class backfill:
+    """
+        ## Purpose and use:
+            Cuts a stream of line protocol in chunks and sends them with `parallel` requests
+            in flight. Compression happens in the sending threads (zlib lets go of the GIL),
+            so the main thread only reads and cuts.
+
+            Chunks finish out of order. The checkpoint is the number of lines before the
+            first chunk not written yet: everything before it is in the database, and a
+            resume skips that many lines of the source. A chunk after it may be sent twice
+            on a resume, which InfluxDB takes as the same points written again.
+
+            A chunk is retried `retries` times, waiting 1, 2, 4 ... s (or the server's
+            Retry-After). Refused chunks (400, 401, 403, 404, 413) are not retried: the run stops.
+        ### Methods:
+            - `run`: sends the stream, returns the report
+            - `report`: lines, chunks, bytes and rates so far
+    """
+    def __init__(self, target:destination, checkpoint:str, description:dict, chunk:int = 5000,
+                 parallel:int = 4, retries:int = 5, compresslevel:int = 6, report_every:float = 10):
+        """
+        ### Arguments:
+            target: destination = where the chunks are written
+            checkpoint: str = progress file, None to not save any
+            description: dict = source, destination and time range, a checkpoint of other arguments isn't used
+            chunk: int = lines per request
+            parallel: int = requests in flight
+            retries: int = tries per chunk after the first one
+            compresslevel: int = gzip level, 1 (fast) to 9 (small)
+            report_every: float = seconds between two progress lines, 0 = only at the end
+        """
+        self.target = target
+        self.checkpoint = checkpoint
+        self.description = description
+        self.chunk = max(1, int(chunk))
+        self.parallel = max(1, int(parallel))
+        self.retries = max(0, int(retries))
+        self.compresslevel = int(compresslevel)
+        self.report_every = float(report_every)
+
+        self.done_lines = 0 # lines in the checkpoint
+        self.counts = {"lines": 0, "chunks": 0, "raw_bytes": 0, "wire_bytes": 0, "retries": 0}
+        self._lock = threading.Lock()
+        self._failed = None
+        self._started = None
+
+    def _load_checkpoint(self):
+        """ Returns: int = lines already written by an earlier run with the same description """
+        if self.checkpoint is None or not os.path.isfile(self.checkpoint): return 0
+        try:
+            with open(self.checkpoint, "r") as file:
+                saved = json.load(file)
+        except Exception as err:
+            raise rpie.CriticalError(f"checkpoint {self.checkpoint} could not be read, delete it to start again, error: {err}")
+        if saved.get("description") != self.description:
+            raise rpie.CriticalError(f"checkpoint {self.checkpoint} is from another backfill ({saved.get('description')}), "
+                                     f"use --restart or another --checkpoint")
+        return int(saved.get("lines", 0))
+
+    def _save_checkpoint(self, finished:bool = False):
+        if self.checkpoint is None: return
+        # write then rename, like the spool offset
+        with open(self.checkpoint + ".tmp", "w") as file:
+            json.dump({"description": self.description, "lines": self.done_lines, "finished": finished,
+                       "time": time.strftime("%Y-%m-%d %H:%M:%S")}, file)
+        os.replace(self.checkpoint + ".tmp", self.checkpoint)
+
+    def _chunks(self, lines, skip:int):
+        """ yields (first line number, lines), after skipping the lines of the checkpoint """
+        number = 0
+        chunk = []
+        for line in lines:
+            if number < skip:
+                number += 1
+                continue
+            chunk.append(line)
+            if len(chunk) >= self.chunk:
+                yield number, chunk
+                number += len(chunk)
+                chunk = []
+        if chunk: yield number, chunk
+
+    def _send(self, lines:[str,...]):
+        """ one chunk, with retries. Returns: bool = written """
+        raw = "\n".join(lines).encode("utf-8")
+        body = gzip.compress(raw, compresslevel=self.compresslevel)
+        for attempt in range(self.retries + 1):
+            if self._failed is not None: return False
+            wait_for = 2**attempt
+            try:
+                status, text, retry = self.target.write(body)
+            except Exception as err:
+                status, text, retry = None, f"{err}, {type(err)}", None
+            if status is not None and 200 <= status < 300:
+                with self._lock:
+                    self.counts["lines"] += len(lines)
+                    self.counts["chunks"] += 1
+                    self.counts["raw_bytes"] += len(raw)
+                    self.counts["wire_bytes"] += len(body)
+                return True
+            if status in (400, 401, 403, 404, 413):
+                self._failed = f"the server refused a chunk ({status}): {text[:500]}"
+                return False
+            if attempt < self.retries:
+                with self._lock: self.counts["retries"] += 1
+                time.sleep(retry if retry is not None else wait_for)
+        self._failed = f"a chunk failed {self.retries + 1} times, last answer: {status} {text[:500]}"
+        return False
+
+    def report(self):
+        """ Returns: dict = counts, rates and compression so far """
+        with self._lock:
+            counts = dict(self.counts)
+        elapsed = max(time.monotonic() - self._started, 1e-9) if self._started else 0.0
+        rate = lambda value: value/elapsed if elapsed else 0.0
+        return {**counts, "checkpoint": self.done_lines, "seconds": elapsed,
+                "lines_per_second": rate(counts["lines"]),
+                "raw_mb_per_second": rate(counts["raw_bytes"])/1e6,
+                "wire_mb_per_second": rate(counts["wire_bytes"])/1e6,
+                "compression": counts["raw_bytes"]/counts["wire_bytes"] if counts["wire_bytes"] else 0.0}
+
+    def _print_report(self, final:bool = False):
+        report = self.report()
+        print(f"{'done' if final else 'sent'} {report['lines']:,} lines in {report['chunks']:,} chunks, {report['seconds']:.0f} s: "
+              f"{report['lines_per_second']:,.0f} lines/s, {report['wire_mb_per_second']:.2f} MB/s sent "
+              f"({report['raw_mb_per_second']:.2f} MB/s of line protocol, {report['compression']:.1f}x smaller), "
+              f"{report['retries']} retries, checkpoint at line {report['checkpoint']:,}", flush=True)
+
+    def run(self, lines):
+        """
+        Args:
+            lines (iterable): the line protocol stream, in the same order as the run that made the checkpoint
+        Returns:
+            dict: the report
+        Raises:
+            CriticalError: when a chunk can't be written, the checkpoint is kept for the next run
+        """
+        skip = self.done_lines = self._load_checkpoint()
+        if skip: print(f"resuming after line {skip:,} ({self.checkpoint})", flush=True)
+        self._started = time.monotonic()
+        next_report = self._started + self.report_every if self.report_every > 0 else math.inf
+        in_flight = {} # future -> (first line, lines)
+        finished = {} # first line -> lines, written but not yet in the checkpoint
+
+        def settle(done):
+            for future in done:
+                first, count = in_flight.pop(future)
+                if future.result(): finished[first] = count
+            # move the checkpoint over the chunks that are written in a row
+            moved = False
+            while self.done_lines in finished:
+                self.done_lines += finished.pop(self.done_lines)
+                moved = True
+            if moved: self._save_checkpoint()
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            try:
+                for first, chunk in self._chunks(lines, skip):
+                    # one chunk waiting per thread, the source is never read far ahead
+                    while len(in_flight) >= 2*self.parallel:
+                        done, _ = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                        settle(done)
+                    if self._failed is not None: break
+                    in_flight[pool.submit(self._send, chunk)] = (first, len(chunk))
+                    if time.monotonic() >= next_report:
+                        next_report += self.report_every
+                        self._print_report()
+                while in_flight:
+                    done, _ = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                    settle(done)
+                    if time.monotonic() >= next_report:
+                        next_report += self.report_every
+                        self._print_report()
+            except KeyboardInterrupt:
+                self._failed = "interrupted"
+                settle([future for future in in_flight if future.done()])
+                raise
+            finally:
+                if self._failed is not None: self._save_checkpoint()
+
+        if self._failed is not None:
+            self._print_report()
+            raise rpie.CriticalError(f"backfill stopped at line {self.done_lines:,}, start it again to resume: {self._failed}")
+        self._save_checkpoint(finished=True)
+        self._print_report(final=True)
+        return self.report()
+
+
+def parse_time(text:str):
+    """ seconds since the epoch from a number or an ISO date (local time unless it has an offset) """
+    if text is None: return None
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+if __name__ == "__main__":
+    import tools
+
+    path = pathlib.Path(__file__).parent.resolve()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", choices=("influx1", "file", "spool", "sqlite"))
+    parser.add_argument("location", nargs="?", help="the file or folder (spool and sqlite default to config.ini)")
+    parser.add_argument("--config", default=str(path/"config.ini"))
+    parser.add_argument("--to", choices=("cloud", "local", "collector"), help="default: [Method] Cloud")
+    parser.add_argument("--start", help="influx1 and sqlite: first time, epoch seconds or ISO date")
+    parser.add_argument("--end", help="influx1 and sqlite: time to stop at (excluded), now by default")
+    parser.add_argument("--window", type=float, default=24, help="influx1: hours read per query")
+    parser.add_argument("--chunk", type=int, default=5000, help="lines per request")
+    parser.add_argument("--parallel", type=int, default=4, help="requests in flight")
+    parser.add_argument("--retries", type=int, default=5, help="tries per chunk after the first one")
+    parser.add_argument("--compresslevel", type=int, default=6, help="gzip level, 1 to 9")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for one request")
+    parser.add_argument("--report", type=float, default=10, help="seconds between progress lines")
+    parser.add_argument("--checkpoint", help="progress file, default: backfill-<source>-<destination>.json")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the beginning")
+    args = parser.parse_args()
+
+    # a CLI run, errors are printed rather than blinked
+    rpie.led.set_led = lambda state: None
+    config = tools.read_config(args.config)
+    if args.to is None: args.to = "cloud" if config.get_methods()[0] else "local"
+
+    start, end = parse_time(args.start), parse_time(args.end)
+    if args.source == "influx1":
+        # the end is fixed on the first run, so a resume reads the same points
+        end = end if end is not None else math.floor(time.time())
+        location = None
+        lines = influx1_lines(config, start, end, window=args.window*3600)
+    elif args.source == "file":
+        if args.location is None: parser.error("file needs the name of the file")
+        location = os.path.abspath(args.location)
+        lines = file_lines(location)
+    elif args.source == "spool":
+        location = os.path.abspath(args.location or str(path/config.get_spool()["directory"]))
+        lines = spool_lines(location)
+    else:
+        location = os.path.abspath(args.location or config.get_sqlite()["filename"])
+        lines = sqlite_lines(location, start, end)
+
+    description = {"source": args.source, "location": location, "to": args.to, "start": start, "end": end}
+    checkpoint = args.checkpoint or str(path/f"backfill-{args.source}-{args.to}.json")
+    if args.restart and os.path.isfile(checkpoint): os.remove(checkpoint)
+    if os.path.isfile(checkpoint) and args.source == "influx1" and args.end is None:
+        # carry on with the end of the interrupted run
+        try:
+            with open(checkpoint, "r") as file:
+                saved = json.load(file)["description"]
+            if saved.get("start") == start and saved.get("source") == "influx1" and saved.get("to") == args.to:
+                end = description["end"] = saved["end"]
+                lines = influx1_lines(config, start, end, window=args.window*3600)
+        except Exception:
+            pass
+
+    job = backfill(destination.from_config(config, args.to, timeout=args.timeout), checkpoint, description,
+                   chunk=args.chunk, parallel=args.parallel, retries=args.retries,
+                   compresslevel=args.compresslevel, report_every=args.report)
+    try:
+        job.run(lines)
+    except rpie.CriticalError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print(f"\ninterrupted, checkpoint at line {job.done_lines:,}, start it again to resume", file=sys.stderr)
+        sys.exit(130)
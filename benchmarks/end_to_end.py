@@ -0,0 +1,207 @@
+"""
+End to end benchmark: the main.py loop with fake data, sending to a mock InfluxDB.
+
+A local HTTP server answers the v1 `/write` (upload_data_local_influx and the
+collector's end point) and the v2 `/api/v2/write` (upload_data_influxdb_cloud) end
+points with 204 and counts the lines it gets, so the uploaders do their real work (encoding, HTTP, gzip) without a database.
+Ticks run back to back: no scheduler, no sampling delay, no LED.
+
+For every backend it reports the latency percentiles of each stage of the loop and
+the points per second that reached the server. Results are saved as JSON, named after
+the current commit, so two commits can be compared:
+
+    python benchmarks/end_to_end.py [--ticks 500] [--latency ms] [--compare results/xxx.json]
+
+With --outage the server takes the connections but never answers, and the uploaders
+are set up the way main.py sets them up on the loop thread (one try, breaker open after
+the first failure, timeouts fitted in half the period). The run fails (exit code 1) if
+a tick takes longer than the period:
+
+    python benchmarks/end_to_end.py --outage [--period 3]
+"""
+
+import sys, os, time, json, gzip, argparse, threading, subprocess, pathlib, statistics
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+root = pathlib.Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(root))
+
+import tools
+import rpi_errors as rpie
+
+
+class mock_influxdb(BaseHTTPRequestHandler):
+    """ answers every write with 204 after `latency` seconds, counts requests and lines """
+    protocol_version = "HTTP/1.1" # keep-alive, like the real server
+    latency = 0.0
+    hang = False
+    lock = threading.Lock()
+    counts = {"requests": 0, "lines": 0, "bytes": 0}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        size = len(body)
+        if self.headers.get("Content-Encoding", "") == "gzip": body = gzip.decompress(body)
+        if urlparse(self.path).path not in ("/write", "/api/v2/write"):
+            self.send_response(404)
+        else:
+            if self.hang: time.sleep(60) # a dead uplink, the client times out first
+            if self.latency: time.sleep(self.latency)
+            with self.lock:
+                self.counts["requests"] += 1
+                self.counts["lines"] += sum(1 for line in body.splitlines() if line.strip())
+                self.counts["bytes"] += size
+            self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        # /ping and /health
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class fast_fake_data(tools.read_fake_data):
+    """ read_fake_data without the 0.05 s between sampling rounds """
+    def measure(self):
+        self.engine.sample(self.read_sensor, self.ina_list, delay=0)
+        return self.engine.as_dict()
+
+
+def percentiles(values:[float,...]):
+    """ Returns: dict: p50/p90/p99/max in ms """
+    values = sorted(values)
+    pick = lambda q: values[min(len(values)-1, int(q*len(values)))]*1e3
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": values[-1]*1e3,
+            "mean": statistics.fmean(values)*1e3}
+
+
+def make_backend(name:str, port:int, period:float = None):
+    """ with a period, the uploader is set up as main.py does on the loop thread (see tools.make_uploader) """
+    url = f"http://127.0.0.1:{port}"
+    loop = {} if period is None else {"retries": 0, "failure_threshold": 1}
+    if name == "collector":
+        # the collector's /write takes the same gzipped line protocol
+        if period is not None: loop = {"timeout": tools.write_budget("Collector", period, 5)[0]}
+        return tools.load_uploader("collector")(url=url, source="bench", **loop)
+    if name.startswith("cloud"):
+        if period is not None: loop["timeout"], loop["connect_timeout"] = tools.write_budget("Cloud", period, 10, 5)
+        return tools.load_uploader("cloud")(bucket="bench", org="bench", token="bench", url=url,
+                                            batch="batch" in name, encoder="line" if "line" in name else "default", **loop)
+    if period is not None: loop["timeout"] = tools.write_budget("Local", period, None)[0]
+    return tools.load_uploader("local")(ifuser="bench", ifpass="bench", ifdb="bench", ifhost="127.0.0.1", ifport=port,
+                                        encoder="line" if "line" in name else "default", **loop)
+
+
+def run(backend:str, ticks:int, port:int, period:float = None):
+    """ the body of the main.py loop, every stage timed on the monotonic clock """
+    send = make_backend(backend, port, period)
+    model = fast_fake_data()
+    name = model.get_name()
+    stages = {stage: [] for stage in ("measure_network", "net_usage", "measure_cpu", "local_performance",
+                                      "measure", "generic", "flush", "tick")}
+    def timed(stage, function, *args, **kwargs):
+        start = time.monotonic_ns()
+        result = function(*args, **kwargs)
+        stages[stage].append((time.monotonic_ns()-start)*1e-9)
+        return result
+
+    with mock_influxdb.lock:
+        mock_influxdb.counts.update(requests=0, lines=0, bytes=0)
+    hash_netin1, hash_netout2 = model.measure_network()
+    started = time.monotonic()
+    for _ in range(ticks):
+        tick = time.monotonic_ns()
+        net_in, net_out = timed("measure_network", model.measure_network)
+        timed("net_usage", send.net_usage, net_in=(net_in-hash_netin1)/1024/1024, net_out=(net_out-hash_netout2)/1024/1024)
+        hash_netin1, hash_netout2 = net_in, net_out
+        cpu, ram = timed("measure_cpu", model.measure_cpu)
+        timed("local_performance", send.local_performance, machine_name=name, cpu_usage=cpu, ram_usage=ram)
+        data = timed("measure", model.measure)
+        timed("generic", send.generic, data=data, point_name="Electricity Gen", tag_type="House")
+        if hasattr(send, "flush"): timed("flush", send.flush, force=True)
+        stages["tick"].append((time.monotonic_ns()-tick)*1e-9)
+    elapsed = time.monotonic() - started
+
+    with mock_influxdb.lock:
+        counts = dict(mock_influxdb.counts)
+    return {
+        "ticks": ticks,
+        "seconds": elapsed,
+        "points_per_second": counts["lines"]/elapsed,
+        "ticks_per_second": ticks/elapsed,
+        "requests": counts["requests"],
+        "points": counts["lines"],
+        "bytes": counts["bytes"],
+        "stages_ms": {stage: percentiles(values) for stage, values in stages.items() if values}
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=root).stdout.strip() or "unknown"
+    except Exception:
+        return "unknown"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ticks", type=int, default=500, help="loops per backend")
+    parser.add_argument("--latency", type=float, default=0, help="ms the mock server waits before answering")
+    parser.add_argument("--backends", default="cloud,cloud_line,cloud_batch,cloud_batch_line,local,local_line,collector")
+    parser.add_argument("--output", default=str(root/"benchmarks"/"results"), help="folder for the JSON results")
+    parser.add_argument("--compare", help="an earlier results file, prints the change in tick p50 and points/s")
+    parser.add_argument("--outage", action="store_true", help="the server never answers, checks every tick fits in --period")
+    parser.add_argument("--period", type=float, default=3, help="seconds per loop, for --outage")
+    args = parser.parse_args()
+    if args.outage: args.ticks = min(args.ticks, 20)
+
+    # the LED thread would print "blink" every tick off a Pi
+    rpie.led.set_led = lambda state: None
+    mock_influxdb.latency = args.latency/1e3
+    mock_influxdb.hang = args.outage
+    server = ThreadingHTTPServer(("127.0.0.1", 0), mock_influxdb)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    results = {"commit": commit(), "time": time.strftime("%Y-%m-%d %H:%M:%S"), "ticks": args.ticks,
+               "latency_ms": args.latency, "backends": {}}
+    too_slow = []
+    for backend in args.backends.split(","):
+        result = results["backends"][backend] = run(backend.strip(), args.ticks, port, args.period if args.outage else None)
+        if args.outage and result["stages_ms"]["tick"]["max"] > args.period*1e3: too_slow.append(backend)
+        tick = result["stages_ms"]["tick"]
+        print(f"{backend:18s} tick p50 {tick['p50']:7.2f} ms  p99 {tick['p99']:7.2f} ms  "
+              f"{result['points_per_second']:9.0f} points/s  {result['requests']/args.ticks:5.1f} requests/tick")
+        for stage, values in result["stages_ms"].items():
+            if stage == "tick": continue
+            print(f"    {stage:18s} p50 {values['p50']:7.3f}  p90 {values['p90']:7.3f}  p99 {values['p99']:7.3f}  max {values['max']:7.2f} ms")
+    server.shutdown()
+    if args.outage:
+        # the writes are left hanging on the server, nothing to save
+        if too_slow: sys.exit(f"during the outage a tick took longer than {args.period} s with: {', '.join(too_slow)}")
+        print(f"during the outage every tick took less than {args.period} s")
+        sys.exit(0)
+
+    os.makedirs(args.output, exist_ok=True)
+    filename = os.path.join(args.output, f"end_to_end-{results['commit']}.json")
+    with open(filename, "w") as file:
+        json.dump(results, file, indent=1)
+    print(f"saved {filename}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            before = json.load(file)
+        print(f"compared with {before['commit']} ({before['time']}):")
+        for backend, result in results["backends"].items():
+            old = before["backends"].get(backend)
+            if old is None: continue
+            p50, old_p50 = result["stages_ms"]["tick"]["p50"], old["stages_ms"]["tick"]["p50"]
+            print(f"{backend:18s} tick p50 {old_p50:7.2f} -> {p50:7.2f} ms ({(p50/old_p50-1)*100:+.0f}%)  "
+                  f"points/s {old['points_per_second']:.0f} -> {result['points_per_second']:.0f} "
+                  f"({(result['points_per_second']/old['points_per_second']-1)*100:+.0f}%)")
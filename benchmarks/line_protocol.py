@@ -0,0 +1,75 @@
+"""
+Micro-benchmark: line_protocol.line_encoder against the influxdb_client.Point path
+(used by cloud_solution) and the dict + make_lines path (used by local_solution).
+
+Every version encodes one loop's worth of points, the same ones main.py sends:
+"Electricity Gen" for every house and field, then CPU/RAM and network for the machine.
+
+Run from the repository folder:
+    python benchmarks/line_protocol.py [loops]
+"""
+
+import sys, time, timeit, pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.resolve()))
+
+import influxdb_client
+from influxdb.line_protocol import make_lines
+from line_protocol import line_encoder
+
+data = {
+    "blue_house": {"voltage": 0.0123, "power": 1.234, "bus_voltage": 12.61},
+    "red_house": {"voltage": 0.0456, "power": 1.567, "bus_voltage": 12.58},
+    "green_house": {"voltage": 0.0789, "power": 1.891, "bus_voltage": 12.72},
+    "bus": {"voltage": 0.0111, "power": 1.222, "bus_voltage": 12.33},
+    "bus_average": {"voltage": 12.64, "power": 15.97},
+}
+machine = "solar-pi"
+
+
+def with_points():
+    now = time.time_ns()
+    points = [influxdb_client.Point("Electricity Gen").tag("House", tag).field(field, float(value)).time(now)
+              for tag in data for field, value in data[tag].items()]
+    points += [influxdb_client.Point("cpu_usage").tag("Machine", machine).field("CPU", 12.5).time(now),
+               influxdb_client.Point("ram_usage").tag("Machine", machine).field("RAM", 412345678).time(now),
+               influxdb_client.Point("network").tag("Machine", machine).field("upload", 0.12).time(now),
+               influxdb_client.Point("network").tag("Machine", machine).field("download", 0.34).time(now)]
+    # this is what the write api does with them before sending
+    return [point.to_line_protocol() for point in points]
+
+
+def with_dicts():
+    now = time.time_ns()
+    points = [{"measurement": "Electricity Gen", "tags": {"House": tag}, "time": now, "fields": {field: float(value)}}
+              for tag in data for field, value in data[tag].items()]
+    points += [{"measurement": machine, "time": now, "fields": {"cpu": 12.5, "ram": 412345678.0}},
+               {"measurement": machine, "time": now, "fields": {"net_in": 0.12, "net_out": 0.34}}]
+    return make_lines({"points": points}).splitlines()
+
+
+encoder = line_encoder()
+def with_encoder():
+    now = time.time_ns()
+    encoder.clear()
+    for tag in data:
+        for field, value in data[tag].items():
+            encoder.add("Electricity Gen", (("House", tag),), {field: float(value)}, now)
+    encoder.add("cpu_usage", (("Machine", machine),), {"CPU": 12.5}, now)
+    encoder.add("ram_usage", (("Machine", machine),), {"RAM": 412345678}, now)
+    encoder.add("network", (("Machine", machine),), {"upload": 0.12}, now)
+    encoder.add("network", (("Machine", machine),), {"download": 0.34}, now)
+    return encoder.lines()
+
+
+if __name__ == "__main__":
+    loops = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    # the encoder has to write exactly what Point writes
+    assert [line.rsplit(" ", 1)[0] for line in with_encoder()] == [line.rsplit(" ", 1)[0] for line in with_points()]
+
+    results = {}
+    for name, function in [("Point (cloud)", with_points), ("dict + make_lines (local)", with_dicts), ("line_encoder", with_encoder)]:
+        best = min(timeit.repeat(function, number=loops, repeat=5))
+        results[name] = best / loops * 1e6
+    for name, us in results.items():
+        print(f"{name:28s} {us:9.1f} us per loop  ({results['Point (cloud)']/us:4.1f}x Point)")
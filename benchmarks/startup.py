@@ -0,0 +1,77 @@
+"""
+Start up budget check: how long main.py takes from the first import to the first sample,
+for every backend, and how much memory the imports cost.
+
+Every combination runs in a fresh python (imports are cached otherwise) with fake data,
+so it works without a Pi. The clients are created but nothing is sent:
+    - imports: tools and the modules main.py always imports
+    - config: read_config and every get_ method main.py calls
+    - clients: tools.load_uploader and the upload object
+    - sample: the first model.measure()
+
+Exits with 1 when a total goes over the budget, so it can be run before a release:
+    python benchmarks/startup.py [--budget seconds] [--memory MB]
+"""
+
+import sys, json, subprocess, pathlib, argparse
+
+root = pathlib.Path(__file__).parent.parent.resolve()
+
+# runs in the child python, prints one json line
+child = r"""
+import sys, time, json, resource
+sys.path.insert(0, ROOT)
+started = time.monotonic_ns()
+phases = {}
+def mark(phase):
+    global started
+    now = time.monotonic_ns()
+    phases[phase] = round((now-started)*1e-9, 4)
+    started = now
+
+import tools, rpi_errors, upload_worker, spool, rollup, deadband, scheduler
+mark("imports")
+config = tools.read_config(ROOT + "/config.ini")
+config.get_methods(); config.get_time(); config.get_upload(); config.get_spool()
+config.get_deadband(); config.get_rollup(); config.get_sensors(); config.get_sampling()
+mark("config")
+uploader = tools.load_uploader(BACKEND)
+if BACKEND == "cloud":
+    send = uploader(bucket="bucket", org="org", token="token", url="http://localhost:8086")
+else:
+    send = uploader(ifuser="user", ifpass="pass", ifdb="db", ifhost="localhost", ifport=8086)
+model = tools.read_fake_data(acquisition="hardware")
+mark("clients")
+model.measure()
+mark("sample")
+phases["total"] = round(sum(phases.values()), 4)
+phases["rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1)
+phases["modules"] = sorted(name for name in ("numpy", "influxdb", "influxdb_client", "ina219", "psutil") if name in sys.modules)
+print(json.dumps(phases))
+"""
+
+
+def run(backend:str):
+    code = child.replace("ROOT", repr(str(root))).replace("BACKEND", repr(backend))
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=root)
+    if result.returncode != 0:
+        raise RuntimeError(f"{backend} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=5, help="seconds from import to first sample")
+    parser.add_argument("--memory", type=float, default=150, help="MB of RSS after the first sample")
+    args = parser.parse_args()
+
+    over = []
+    for backend in ("cloud", "local"):
+        report = run(backend)
+        modules = report.pop("modules")
+        print(f"{backend:6} " + "  ".join(f"{phase} {value}" for phase, value in report.items()) + f"  loaded: {', '.join(modules)}")
+        if report["total"] > args.budget: over.append(f"{backend} took {report['total']} s (budget {args.budget} s)")
+        if report["rss_mb"] > args.memory: over.append(f"{backend} used {report['rss_mb']} MB (budget {args.memory} MB)")
+
+    for problem in over: print(f"OVER BUDGET: {problem}")
+    sys.exit(1 if over else 0)
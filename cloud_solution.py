@@ -9,6 +9,10 @@ import influxdb_client, os, time
 from influxdb_client.client.write_api import SYNCHRONOUS
 import socket # hostname
 import rpi_errors as rpie 
+from line_protocol import line_encoder
+from transport import batch_controller, wire_meter
+from scheduler import tick_scheduler
+from resilience import resilient, circuit_open
 
 
 class upload_data_influxdb_cloud:
@@ -20,9 +24,21 @@ class upload_data_influxdb_cloud:
             - `local_performance`: send data about cpu/ram/disk usage
             - `net_usage`: sends net usage
             - `generic`: send a generic data point
+            - `raw_series`: send a timestamped series (ie from sampling.continuous_sampler) in one write
+            - `flush`: send the points held back in batch mode
+            - `write_lines`: write line protocol as it is
+            - `transport_stats`: bytes sent, bytes saved by gzip and the adaptive batch size
+            - `health`: circuit breaker state and retry counters
+            - `stop`: sends the points still held back and closes the client
         
     """
-    def __init__(self, bucket: str= None, org:str = None, token: str =None, url: str= None):
+    def __init__(self, bucket: str= None, org:str = None, token: str =None, url: str= None,
+                    batch: bool = False, batch_size: int = 500, flush_interval: float = 0,
+                    spool = None, replay_chunk: int = 5000, encoder: str = "default",
+                    gzip: bool = False, pool_size: int = None, timeout: float = 10, connect_timeout: float = None,
+                    adaptive: bool = False, target_latency: float = 2, min_batch: int = 50, max_batch: int = 5000,
+                    report_interval: float = 3600, retries: int = 2, base_delay: float = 0.2, max_delay: float = 2,
+                    failure_threshold: int = 3, reset_timeout: float = 30):
         """ 
         ## Simple init function, establishes connection to InfluxDB cloud
         
@@ -31,6 +47,26 @@ class upload_data_influxdb_cloud:
             org : str = organization name
             token : str = the key influxdb uses to log you into the account
             url: str = database url, similar to https://eu-central-1-1.aws.cloud2.influxdata.com
+            batch: bool = hold the points and send them together in one write when `flush` is called
+            batch_size: int = in batch mode, send as soon as this many points are waiting
+            flush_interval: float = in batch mode, seconds to wait between writes (0 = every `flush`)
+            spool: spool = optional spool.spool object, points that fail to send are saved there
+            replay_chunk: int = the most spooled points replayed after each successful write
+            encoder: str = "default" builds influxdb_client.Point objects, "line" writes line protocol 
+                           directly with line_protocol.line_encoder (faster on a Pi)
+            gzip: bool = compress the writes, line protocol shrinks 5 to 10 times
+            pool_size: int = connections kept open for reuse, None = the client default (cpus*5)
+            timeout: float = seconds to wait for an answer
+            connect_timeout: float = seconds to wait for the connection, None = same as timeout
+            adaptive: bool = batch_size (and the spool replay chunk) follow the latency of the writes, 
+                             see transport.batch_controller
+            target_latency: float = seconds a write should take in adaptive mode
+            min_batch, max_batch: int = limits of the adaptive batch size
+            report_interval: float = seconds between two "transport" points (bytes sent and saved), 0 = never
+            retries, base_delay, max_delay: float = tries after the first one and their jittered waits,
+                                                    see resilience.retry_policy
+            failure_threshold, reset_timeout: failures in a row after which writes fail fast, and seconds 
+                                              between two pings while they do, see resilience.circuit_breaker
               
             For more info, check:
             https://docs.influxdata.com/influxdb/cloud/api-guide/client-libraries/python/
@@ -43,9 +79,14 @@ class upload_data_influxdb_cloud:
         if org is None:     raise rpie.CriticalError(f"{org} is not a valid org")
         if url is None:     raise rpie.CriticalError(f"{url} is not a valid url")
         if token is None:   raise rpie.CriticalError("Token was not imported from the export, or it was omitted")
+        if encoder not in ("default", "line"): raise rpie.CriticalError(f"{encoder} is not a valid encoder")
         
         try:
-            self.client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
+            # the client takes ms, and a (connect, read) pair for separate timeouts
+            client_timeout = int(timeout*1e3) if connect_timeout is None else (int(connect_timeout*1e3), int(timeout*1e3))
+            pool = {} if pool_size is None else {"connection_pool_maxsize": int(pool_size)}
+            self.client = influxdb_client.InfluxDBClient(url=url, token=token, org=org, enable_gzip=gzip,
+                                                         timeout=client_timeout, **pool)
             # InfluxDBClient doesn't mention raising any specific errors.
         except Exception as err: 
             raise rpie.CriticalError(f"When creating InfluxDBClient object, the following error was encountered:\n {err}, {type(err)}")
@@ -57,8 +98,39 @@ class upload_data_influxdb_cloud:
         
         self.bucket=bucket
         self.org=org
+        self.guard = resilient(f"InfluxDB cloud ({url})", retries=retries, base_delay=base_delay, max_delay=max_delay,
+                               failure_threshold=failure_threshold, reset_timeout=reset_timeout, probe=self.client.ping)
+        
+        # batch mode: points wait in _pending as (point, error class, description) until flush
+        self.batch = batch
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self._pending = []
+        self._last_flush = time.monotonic()
+        
+        self.spool = spool
+        self.replay_chunk = replay_chunk
+        self.encoder = line_encoder() if encoder == "line" else None
+        self._series_encoder = self.encoder or line_encoder()
+        
+        self.controller = batch_controller(size=self.batch_size, target=target_latency, minimum=min_batch,
+                                           maximum=max_batch, timeout=timeout) if adaptive else None
+        # the client gzips the body in update_request_body, wrapping it sees both sizes of every write
+        self.meter = wire_meter()
+        update_body = self.client.conf.update_request_body
+        def metered(path, body):
+            _body = update_body(path, body)
+            if path == "/api/v2/write":
+                raw = len(body.encode("utf-8")) if isinstance(body, str) else len(body)
+                self.meter.add(raw, len(_body))
+            return _body
+        self.client.conf.update_request_body = metered
+        self.report_schedule = None
+        if report_interval > 0:
+            self.report_schedule = tick_scheduler(period=report_interval)
+            self.report_schedule.due() # starts the grid, the first report is one interval from now
     
-    def local_performance(self, machine_name:str=None, cpu_usage:float=None, ram_usage:float=None):
+    def local_performance(self, machine_name:str=None, cpu_usage:float=None, ram_usage:float=None, timestamp:int=None):
         """
         ## Sends performance data
         
@@ -69,6 +141,7 @@ class upload_data_influxdb_cloud:
         ## Arguments:
             - `cpu_usage`:float = percentage of cpu in use
             - `ram_uage`: float = total RAM use
+            - `timestamp`: int = ns since the epoch, when it was measured (now if not given)
         
         ## Raises:
             SilentError: if the point/measurment couldn't be added to the bucket.
@@ -93,23 +166,33 @@ class upload_data_influxdb_cloud:
             "ram_usage": ["RAM", ram_usage]
         } 
         
-        try:
-            for key in data:
-                #Todo: Change to a better sintax and less repetitive naming in the database
-                # idea for future implementation (requires changes to the grafana server which can't be done now):
-                # point_cpu =  influxdb_client.Point("local_performance").tag("Machine", machine_name).field("CPU", cpu_usage)
-                # point_ram =  influxdb_client.Point("local_performance").tag("Machine", machine_name).field("RAM", ram_usage)
-                # alternatively, just use Generic, but where is the fun in that?
-                
-                # anyway, the reason to use this method is because errors are handled silently, and I won't change this until
-                # i can also change the grafana server that relies on this infobeing dleivered the same way it used to be.
-                
-                point = influxdb_client.Point(key).tag("Machine", machine_name).field(data[key][0], data[key][1])
-                self.write_api.write(bucket=self.bucket, org=self.org, record=point)
-        except Exception as err:
-            rpie.SilentError(f"cpu data was not sent to influxdb, error: {err}")
+        unsent = []
+        for key in data:
+            #Todo: Change to a better sintax and less repetitive naming in the database
+            # idea for future implementation (requires changes to the grafana server which can't be done now):
+            # point_cpu =  influxdb_client.Point("local_performance").tag("Machine", machine_name).field("CPU", cpu_usage)
+            # point_ram =  influxdb_client.Point("local_performance").tag("Machine", machine_name).field("RAM", ram_usage)
+            # alternatively, just use Generic, but where is the fun in that?
+            
+            # anyway, the reason to use this method is because errors are handled silently, and I won't change this until
+            # i can also change the grafana server that relies on this infobeing dleivered the same way it used to be.
+            
+            point = self._point(key, "Machine", machine_name, data[key][0], data[key][1], timestamp)
+            if point is None: continue
+            if self.batch:
+                self._queue(point, rpie.SilentError, f"cpu data: {key}={data[key][1]}")
+                continue
+            if unsent: # the write already failed once, don't wait for another timeout
+                unsent.append(point)
+                continue
+            try:
+                self._write(point)
+            except Exception as err:
+                unsent.append(point)
+                if not isinstance(err, circuit_open): rpie.SilentError(f"cpu data was not sent to influxdb, error: {err}")
+        self._spool_points(unsent)
     
-    def net_usage(self,machine_name:str=None, net_in:float=None, net_out:float=None):
+    def net_usage(self,machine_name:str=None, net_in:float=None, net_out:float=None, timestamp:int=None):
         """
         ## Sends performance data
         
@@ -118,6 +201,7 @@ class upload_data_influxdb_cloud:
         ## Arguments:
             - `net_in`:float = amount of data recieved
             - `net_out`: float = amount of data sent
+            - `timestamp`: int = ns since the epoch, when it was measured (now if not given)
         
         ## Raises:
             ShortError: blinks the LED shortly to let the user know data usage is unavailble,
@@ -140,15 +224,25 @@ class upload_data_influxdb_cloud:
             "download": float(net_out)
         }
         
-        try:
-            for key in data:
-                # this is good, unlike local_performance...
-                point = influxdb_client.Point("network").tag("Machine", machine_name).field(key, data[key])
-                self.write_api.write(bucket=self.bucket, org=self.org, record=point)
-        except Exception as err:
-            rpie.ShortError(f"net usage info could not be sent, error: {err}")
+        unsent = []
+        for key in data:
+            # this is good, unlike local_performance...
+            point = self._point("network", "Machine", machine_name, key, data[key], timestamp)
+            if point is None: continue
+            if self.batch:
+                self._queue(point, rpie.ShortError, f"net usage: {key}={data[key]}")
+                continue
+            if unsent: # the write already failed once, don't wait for another timeout
+                unsent.append(point)
+                continue
+            try:
+                self._write(point)
+            except Exception as err:
+                unsent.append(point)
+                if not isinstance(err, circuit_open): rpie.ShortError(f"net usage info could not be sent, error: {err}")
+        self._spool_points(unsent)
     
-    def generic(self, data, point_name:str ="m1", tag_type:str = "tag1"):
+    def generic(self, data, point_name:str ="m1", tag_type:str = "tag1", timestamp:int=None):
         """
         ## Somewhat Generic data logging method
         
@@ -161,6 +255,7 @@ class upload_data_influxdb_cloud:
                             }
             point_name (str): Name of the measurement logged in InfluxDB (ie, electric_data)
             tag_type (str): Name of the tag type used (ie, house)
+            timestamp (int): ns since the epoch, when it was measured (now if not given)
 
         Raises:
             SendingError: when data cannot be logged. The LED on the Raspberry will blink.
@@ -168,19 +263,193 @@ class upload_data_influxdb_cloud:
         if data is None:
             raise rpie.CriticalError("No data was assigned to the function")
         
+        unsent = []
         for _tag in data:
             tag_dict=data[_tag] # tag1
             for value_name in tag_dict:
                 try:
-                    point = influxdb_client.Point(point_name).tag(tag_type, _tag).field(value_name, float(tag_dict[value_name]))
+                    point = self._point(point_name, tag_type, _tag, value_name, float(tag_dict[value_name]), timestamp)
                 except Exception as err: 
                     rpie.SendingError(f"at time {time.time()} the process of creating a measurment failed, bucket: {self.bucket}, org: {self.org}  \
                         \n the following error was encountered: {err}, {type(err)} \n \
                             the current values: {point_name}, {tag_type}:{_tag}, {value_name}:{tag_dict[value_name]}")
+                    continue
+                if point is None: continue
+                if self.batch:
+                    self._queue(point, rpie.SendingError, f"{point_name}, {tag_type}:{_tag}, {value_name}:{tag_dict[value_name]}")
+                    continue
                 try:
-                    self.write_api.write(bucket=self.bucket, org=self.org, record=point)
+                    self._write(point)
                 except Exception as err: 
+                    unsent.append(point)
+                    # the breaker logged the outage once, not every point
+                    if isinstance(err, circuit_open): continue
                     rpie.SendingError(f"at time {time.time()} the process of writing to the api failed, bucket: {self.bucket}, org: {self.org}  \
                         \n the following error was encountered: {err}, {type(err)} \n \
                             the current values: {point_name}, {tag_type}:{_tag}, {value_name}:{tag_dict[value_name]}")
+        
+        if unsent: self._spool_points(unsent)
+        elif not self.batch: self._replay()
+    
+    def raw_series(self, times, data, point_name:str ="m1", tag_type:str = "tag1"):
+        """
+        ## Sends a raw, timestamped series in one write
+        
+        Args:
+            times (list): timestamps in ns
+            data (dict): {"tag 1": {"field name 1": list of values, same length as times}}
+            point_name (str): Name of the measurement logged in InfluxDB
+            tag_type (str): Name of the tag type used (ie, house)
+        Raises:
+            SendingError: when the series cannot be logged.
+        """
+        self._series_encoder.clear()
+        self._series_encoder.series(point_name, tag_type, times, data)
+        lines = self._series_encoder.lines()
+        if not lines: return
+        try:
+            self._write(lines)
+        except Exception as err:
+            if not isinstance(err, circuit_open): rpie.SendingError(f"at time {time.time()} a raw series of {len(lines)} points could not be written, bucket: {self.bucket}, org: {self.org}  \
+                \n the following error was encountered: {err}, {type(err)}")
+            self._spool_points(lines)
+    
+    def write_lines(self, lines:[str,...]):
+        """
+        Writes line protocol as it is, in one request (used by the collector and the spool replay)
+
+        Raises:
+            whatever the write api raises, nothing is spooled or logged here
+        """
+        self._write(lines)
+    
+    def _write(self, record):
+        """
+        One write request, with retries and the circuit breaker, timed for the adaptive batch size
 
+        Raises:
+            circuit_open: the database is known to be down, nothing was sent
+            whatever the write api raised on the last try
+        """
+        points = len(record) if isinstance(record, list) else 1
+        start = time.monotonic()
+        try:
+            self.guard.call(self.write_api.write, bucket=self.bucket, org=self.org, record=record)
+        except circuit_open:
+            raise
+        except Exception:
+            if self.controller is not None: self.controller.record(points, time.monotonic()-start, failed=True)
+            raise
+        if self.controller is not None: self.controller.record(points, time.monotonic()-start)
+    
+    def transport_stats(self, reset:bool = False):
+        """
+        Args:
+            reset (bool): start counting the bytes again (`wire_meter.report`)
+        Returns:
+            dict: requests, raw_bytes, wire_bytes, saved_bytes, saved_per_day, ratio since the last reset,
+                  and batch_size, latency_ms, changes in adaptive mode
+        """
+        stats = self.meter.report(reset=reset)
+        if self.controller is not None: stats.update(self.controller.stats())
+        return stats
+    
+    def health(self):
+        """ Returns: dict: breaker state (closed, open, half_open), failures in a row, retries, rejected writes... """
+        return self.guard.stats()
+    
+    def _report(self):
+        """ sends the transport stats to the "transport" measurement every report_interval seconds """
+        if self.report_schedule is None or not self.report_schedule.due(): return
+        try:
+            machine_name = socket.gethostname()
+        except Exception:
+            machine_name = "Machine Undetected"
+        self.generic({machine_name: self.transport_stats(reset=True)}, point_name="transport", tag_type="Machine")
+    
+    def _point(self, measurement:str, tag_key:str, tag_value:str, field:str, value, timestamp:int = None):
+        """
+        Makes one timestamped point with the selected encoder, at `timestamp` (ns) or now.
+        
+        Returns: Point, or a line protocol str with the line encoder (None if the value can't be written)
+        """
+        if timestamp is None: timestamp = time.time_ns()
+        if self.encoder is None:
+            return influxdb_client.Point(measurement).tag(tag_key, tag_value).field(field, value).time(timestamp)
+        return self.encoder.encode(measurement, ((tag_key, tag_value),), {field: value}, timestamp)
+    
+    def _queue(self, point, error, details:str):
+        """
+        Holds a point for the next batched write. Points are timestamped when they 
+        are made, so they keep the time they were measured at and not the time they were sent at.
+        
+        Args:
+            point (Point or str): the point to send
+            error (Exception class): the rpi error to raise if the point can't be sent
+            details (str): what to write in the error log about this point
+        """
+        self._pending.append((point, error, details))
+        if len(self._pending) >= (self.batch_size if self.controller is None else self.controller.size):
+            self.flush(force=True)
+    
+    def flush(self, force:bool=False):
+        """
+        ## Sends every point held back in batch mode in one write
+        
+        Called once per loop in main.py. If `flush_interval` is set, points are held 
+        until that many seconds have passed since the last write (or `batch_size` points 
+        are waiting). Does nothing when batch mode is off.
+        
+        In adaptive mode the points go in as many writes of `controller.size` as needed.
+        
+        The transport stats go out from here too, when they are due.
+        
+        Args:
+            force (bool): ignore `flush_interval` and send now
+        Raises:
+            The error each point was queued with (SendingError, ShortError or SilentError).
+            Each error type is raised once, listing all the points that failed with it.
+        """
+        self._report()
+        if not self._pending: return
+        if not force and (time.monotonic()-self._last_flush) < self.flush_interval: return
+        
+        pending, self._pending = self._pending, []
+        self._last_flush = time.monotonic()
+        sent = 0
+        try:
+            while sent < len(pending):
+                size = len(pending) if self.controller is None else self.controller.size
+                self._write([item[0] for item in pending[sent:sent+size]])
+                sent += size
+        except Exception as err:
+            pending = pending[sent:]
+            self._spool_points([item[0] for item in pending])
+            if isinstance(err, circuit_open): return
+            failed = {}
+            for _, error, details in pending:
+                failed.setdefault(error, []).append(details)
+            for error in failed:
+                error(f"at time {time.time()} a batch of {len(pending)} points could not be written, bucket: {self.bucket}, org: {self.org}  \
+                    \n the following error was encountered: {err}, {type(err)} \n \
+                        the failed values: {'; '.join(failed[error])}")
+            return
+        self._replay()
+    
+    def _spool_points(self, points):
+        """ saves points that could not be sent in the spool (if there is one) """
+        if self.spool is None or not points: return
+        self.spool.append([point if isinstance(point, str) else point.to_line_protocol() for point in points])
+    
+    def _replay(self):
+        """ 
+        Sends one chunk of spooled points. Only called after live data went through,
+        so the backlog is sent while the database is up and never ahead of new data.
+        """
+        if self.spool is not None:
+            self.spool.replay(self.write_lines, max_lines=self.replay_chunk if self.controller is None else self.controller.size)
+    
+    def stop(self, *args, **kwargs):
+        """ sends the points still held back in batch mode (or spools them) and closes the client """
+        self.flush(force=True)
+        self.client.close()
@@ -0,0 +1,303 @@
+"""
+Fleet collector: one process that takes the points of many Pis and writes them to
+InfluxDB in large batches, with one client and one token.
+
+The Pis send with collector_solution.upload_data_collector ([Collector] enabled in their
+config.ini). The collector writes with the backend chosen in its own config.ini
+([Method] Cloud, same [Cloud] / [Local] sections as main.py). Run it with:
+    python collector.py [path to config.ini]
+
+classes:
+    - collector: per source queues, merged into batched writes by a background thread
+    - collector_handler: the HTTP end point
+"""
+
+import sys, time, json, gzip, threading, pathlib, hmac
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import rpi_errors as rpie
+from resilience import is_transient
+from line_protocol import check_line
+
+
+class collector:
+    """
+        ## Purpose and use:
+            Every source (a Pi) has its own queue of line protocol lines. A thread takes
+            lines from all the queues in turn (so one busy Pi can't starve the others) and
+            writes up to `batch_size` of them in one request, every `flush_interval`
+            seconds or as soon as a full batch is waiting.
+
+            Backpressure: a source with more than `source_limit` lines waiting, or any
+            source once `max_pending` lines are waiting in total, is refused (accept returns
+            False, the HTTP end point answers 429) until the queue drains. The Pi keeps its
+            points and sends them again later.
+
+            When a write fails the batch goes back to the front of the queues and is tried
+            again after `flush_interval`, so the queues fill up and the Pis are slowed down
+            instead of points being lost here. A batch the database refuses for good (a 4xx
+            other than 408/429, see resilience.is_transient) would block the queues forever,
+            it is logged with its first lines and dropped.
+        ### Methods:
+            - `accept`: queues the lines of one source
+            - `flush`: writes one batch
+            - `stats`: queue sizes and counters
+            - `stop`: writes what is still queued and stops the thread
+    """
+    def __init__(self, uploader, batch_size:int = 5000, flush_interval:float = 5,
+                 source_limit:int = 20000, max_pending:int = 200000):
+        """
+        ### Arguments:
+            uploader: anything with a `write_lines(lines)` method that raises when it fails
+                      (upload_data_influxdb_cloud or upload_data_local_influx)
+            batch_size: int = most lines per write
+            flush_interval: float = seconds between writes when there is less than a batch
+            source_limit: int = lines one source can have waiting
+            max_pending: int = lines all the sources together can have waiting
+        """
+        self.uploader = uploader
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.source_limit = max(1, int(source_limit))
+        self.max_pending = max(1, int(max_pending))
+
+        self._queues = {} # source -> deque of lines
+        self._pending = 0
+        self._lock = threading.Condition()
+        self._running = True
+        self._retry_at = 0.0
+
+        self.accepted = 0
+        self.refused = 0
+        self.written = 0
+        self.failed_writes = 0
+        self.dropped = 0
+        self.sources = {} # source -> {accepted, refused, last_seen}
+
+        self._thread = threading.Thread(target=self._run, name="collector", daemon=True)
+        self._thread.start()
+
+    def accept(self, source:str, lines:[str,...]):
+        """
+        Args:
+            source (str): name of the Pi
+            lines (list): line protocol lines
+        Returns:
+            bool: False if the source has to wait (backpressure), nothing was queued
+        """
+        with self._lock:
+            counters = self.sources.setdefault(source, {"accepted": 0, "refused": 0, "last_seen": 0})
+            counters["last_seen"] = time.time()
+            queue = self._queues.setdefault(source, deque())
+            if len(queue) + len(lines) > self.source_limit or self._pending + len(lines) > self.max_pending:
+                counters["refused"] += len(lines)
+                self.refused += len(lines)
+                return False
+            queue.extend(lines)
+            self._pending += len(lines)
+            counters["accepted"] += len(lines)
+            self.accepted += len(lines)
+            if self._pending >= self.batch_size: self._lock.notify_all()
+            return True
+
+    def retry_after(self):
+        """ Returns: int = seconds a refused source should wait, about the time to write what is queued """
+        batches = self._pending/self.batch_size
+        return max(1, int(self.flush_interval*min(batches, 12)))
+
+    def _take(self):
+        """ up to batch_size lines, taken from every source in turn """
+        batch = []
+        while len(batch) < self.batch_size and self._pending:
+            share = max(1, (self.batch_size - len(batch))//len(self._queues))
+            for source, queue in list(self._queues.items()):
+                take = min(share, len(queue), self.batch_size - len(batch))
+                batch.extend((source, queue.popleft()) for _ in range(take))
+                self._pending -= take
+                if not queue: del self._queues[source]
+        return batch
+
+    def flush(self):
+        """
+        Writes one batch
+
+        Returns:
+            int: lines written, 0 if there was nothing to write or the write failed
+        Raises:
+            SendingError: (logged only) when the backend refuses the batch
+        """
+        with self._lock:
+            batch = self._take()
+        if not batch: return 0
+        try:
+            self.uploader.write_lines([line for _, line in batch])
+        except Exception as err:
+            if not is_transient(err):
+                # the same batch would be refused again, and hold up every batch behind it
+                with self._lock:
+                    self.failed_writes += 1
+                    self.dropped += len(batch)
+                sample = "\n".join(line for _, line in batch[:5])
+                rpie.SendingError(f"at time {time.time()} the database refused a batch of {len(batch)} points, they are dropped \
+                    \n the following error was encountered: {err}, {type(err)} \n the first lines: \n{sample}")
+                return 0
+            with self._lock:
+                # back to the front of their queues, in the same order
+                for source, line in reversed(batch):
+                    self._queues.setdefault(source, deque()).appendleft(line)
+                self._pending += len(batch)
+                self.failed_writes += 1
+                self._retry_at = time.monotonic() + self.flush_interval
+            rpie.SendingError(f"at time {time.time()} the collector could not write a batch of {len(batch)} points \
+                \n the following error was encountered: {err}, {type(err)}")
+            return 0
+        with self._lock:
+            self.written += len(batch)
+        return len(batch)
+
+    def stats(self):
+        """
+        Returns: dict: {pending, accepted, refused, written, failed_writes, dropped, sources: {source: {accepted, refused, pending, last_seen}}}
+        """
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "accepted": self.accepted,
+                "refused": self.refused,
+                "written": self.written,
+                "failed_writes": self.failed_writes,
+                "dropped": self.dropped,
+                "sources": {source: {**counters, "pending": len(self._queues.get(source, ()))}
+                            for source, counters in self.sources.items()}
+            }
+
+    def stop(self, timeout:float = 30):
+        """ writes what is queued (for up to `timeout` seconds) and stops the thread """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        self._thread.join(timeout=max(0, deadline - time.monotonic()))
+        while self._pending and time.monotonic() < deadline:
+            if not self.flush(): break
+
+    def _run(self):
+        last = time.monotonic()
+        while True:
+            with self._lock:
+                while self._running:
+                    now = time.monotonic()
+                    due = max(last + self.flush_interval, self._retry_at)
+                    if self._pending and (now >= due or (self._pending >= self.batch_size and now >= self._retry_at)): break
+                    self._lock.wait(timeout=max(0.01, due - now) if self._pending else self.flush_interval)
+                if not self._running: return
+            last = time.monotonic()
+            self.flush()
+
+
+class collector_handler(BaseHTTPRequestHandler):
+    """
+        ## The HTTP end point
+            POST /write or /api/v2/write, body: line protocol (gzip if Content-Encoding says so)
+                the source is the `source` query parameter, the client address without it
+                204: queued, 429: busy (see Retry-After), 400: bad request,
+                401: no or wrong "Authorization: Token <token>" header (when there is a token)
+                lines that don't parse are answered with a 400 listing them, the others
+                are queued all the same (a partial write, as InfluxDB does it)
+            GET /health: collector.stats() as JSON
+        The collector object and the token are set on the class by `serve`.
+    """
+    collector = None
+    token = None
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/write", "/api/v2/write"):
+            self._answer(404)
+            return
+        if self.token is not None and not hmac.compare_digest(self.headers.get("Authorization", "").encode(), f"Token {self.token}".encode()):
+            self._answer(401, {"error": "missing or wrong token"})
+            return
+        source = parse_qs(url.query).get("source", [self.client_address[0]])[0]
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding", "") == "gzip": body = gzip.decompress(body)
+            lines = [line for line in body.decode("utf-8").splitlines() if line.strip() and not line.startswith("#")]
+        except Exception as err:
+            self._answer(400, {"error": f"{err}"})
+            return
+        good, bad = [], []
+        for line in lines:
+            error = check_line(line)
+            if error is None: good.append(line)
+            else: bad.append(f"{error}: {line}")
+        lines = good
+        if lines and not self.collector.accept(source, lines):
+            self._answer(429, {"error": "collector busy"}, {"Retry-After": str(self.collector.retry_after())})
+        elif bad:
+            self._answer(400, {"error": f"partial write: {len(bad)} lines could not be parsed", "lines": bad[:20]})
+        else:
+            self._answer(204)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self._answer(200, self.collector.stats())
+        else:
+            self._answer(404)
+
+    def _answer(self, code:int, body:dict = None, headers:dict = None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(code)
+        for key, value in (headers or {}).items(): self.send_header(key, value)
+        if data: self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if data: self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # one line per request would fill the error log, only refusals are interesting
+        pass
+
+
+def serve(collector_object, host:str = "127.0.0.1", port:int = 8090, token:str = None):
+    """
+    Args:
+        collector_object (collector): where the lines go
+        host (str): address to listen on, only this machine by default
+        port (int): port to listen on
+        token (str): shared secret the Pis send, None = writes aren't checked
+    Returns: ThreadingHTTPServer, not started (call serve_forever)
+    """
+    if token is None and host not in ("127.0.0.1", "localhost", "::1"):
+        # anyone who can reach the port could write to the database with the collector's token
+        rpie.ShortError(f"the collector listens on {host} without a token, any machine on the network can write through it")
+    handler = type("handler", (collector_handler,), {"collector": collector_object, "token": token})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    import tools
+
+    path = pathlib.Path(__file__).parent.resolve()
+    config = tools.read_config(sys.argv[1] if len(sys.argv) > 1 else f"{path}/config.ini")
+    use_cloud_solution, _ = config.get_methods()
+    collector_dir = config.get_collector()
+    # no spool here, while the database is down the queues fill up and the Pis spool their own points
+    # the writes run on the collector thread, they can take their time and retry
+    backend = tools.make_uploader(config, "cloud" if use_cloud_solution else "local", background=True)
+
+    merger = collector(backend, batch_size=collector_dir["batch_size"],
+                       flush_interval=collector_dir["flush_interval"],
+                       source_limit=collector_dir["source_limit"],
+                       max_pending=collector_dir["max_pending"])
+    server = serve(merger, collector_dir["listen"], collector_dir["port"], collector_dir["token"])
+    print(f"collector listening on {collector_dir['listen']}:{collector_dir['port']}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        merger.stop()
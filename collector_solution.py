@@ -0,0 +1,211 @@
+"""
+A file that contains the class needed to send data to a collector (collector.py)
+instead of writing to InfluxDB from every Pi.
+
+Only uses the standard library, the Pi doesn't need an InfluxDB client or a token.
+"""
+
+import urllib.request, urllib.error, urllib.parse
+import gzip, socket, time, json
+import rpi_errors as rpie
+from line_protocol import line_encoder, check_line
+
+
+class upload_data_collector:
+    """
+        ## Purpose and use:
+            Sends the same points upload_data_influxdb_cloud would write (same measurements,
+            tags and fields) to a collector over HTTP, as gzipped line protocol.
+            Points are held until `flush` (main.py calls it once per loop) so every loop is
+            one request.
+
+            When the collector is busy it answers 429 with a Retry-After: the points are kept
+            and sent with the next flush after that time. When more than `max_buffer` points
+            are waiting (or the collector can't be reached) they go to the spool, if there is one.
+            When the collector answers a partial write (400, some lines didn't parse, the
+            others were queued) only the refused lines are set aside, in the spool's
+            `rejected.lp` (logged and dropped without a spool).
+        ### Methods:
+            - `local_performance`: send data about cpu/ram/disk usage
+            - `net_usage`: sends net usage
+            - `generic`: send a generic data point
+            - `raw_series`: send a timestamped series (ie from sampling.continuous_sampler)
+            - `flush`: send the points held back
+            - `write_lines`: send line protocol straight away
+    """
+    def __init__(self, url: str = None, source: str = None, timeout: float = 5, max_buffer: int = 10000,
+                 spool = None, replay_chunk: int = 5000, token: str = None):
+        """
+        ### Arguments:
+            url: str = collector address, ie http://collector.local:8090
+            source: str = name of this Pi for the collector's backpressure, the hostname by default
+            timeout: float = seconds to wait for the collector
+            max_buffer: int = points kept in memory while the collector is busy
+            spool: spool = optional spool.spool object, points that fail to send are saved there
+            replay_chunk: int = the most spooled points replayed after each successful write
+            token: str = the collector's shared token ([Collector] token), None if it doesn't check one
+        ### Raises:
+            rpie.CriticalError: when the url is missing
+        """
+        if url is None: raise rpie.CriticalError(f"{url} is not a valid collector url")
+        if source is None:
+            try:
+                source = socket.gethostname()
+            except Exception:
+                source = "Machine Undetected"
+
+        self.url = f"{url.rstrip('/')}/write?{urllib.parse.urlencode({'source': source})}"
+        self.source = source
+        self.timeout = float(timeout)
+        self.headers = {"Content-Type": "text/plain; charset=utf-8", "Content-Encoding": "gzip"}
+        if token: self.headers["Authorization"] = f"Token {token}"
+        self.max_buffer = max(1, int(max_buffer))
+        self.spool = spool
+        self.replay_chunk = replay_chunk
+        self.encoder = line_encoder()
+        self._pending = []
+        self._retry_at = 0.0
+
+    def local_performance(self, machine_name:str=None, cpu_usage:float=None, ram_usage:float=None, timestamp:int=None):
+        if cpu_usage is None or ram_usage is None:
+            rpie.SilentError("either ram or cpu data was not supplied")
+        machine_name = machine_name or self._hostname()
+        now = time.time_ns() if timestamp is None else timestamp
+        self._add("cpu_usage", "Machine", machine_name, "CPU", cpu_usage, now)
+        self._add("ram_usage", "Machine", machine_name, "RAM", ram_usage, now)
+
+    def net_usage(self, machine_name:str=None, net_in:float=None, net_out:float=None, timestamp:int=None):
+        if net_in is None or net_out is None:
+            rpie.ShortError("Some net data was not supplied")
+        machine_name = machine_name or self._hostname()
+        now = time.time_ns() if timestamp is None else timestamp
+        self._add("network", "Machine", machine_name, "upload", net_in, now)
+        self._add("network", "Machine", machine_name, "download", net_out, now)
+
+    def generic(self, data, point_name:str ="m1", tag_type:str = "tag1", timestamp:int=None):
+        """
+        Args:
+            data (dict): {"tag 1": {"field name 1": field value 1}}, same as the other uploaders
+            point_name (str): Name of the measurement logged in InfluxDB (ie, electric_data)
+            tag_type (str): Name of the tag type used (ie, house)
+        Raises:
+            CriticalError: when there is no data
+        """
+        if data is None:
+            raise rpie.CriticalError("No data was assigned to the function")
+        now = time.time_ns() if timestamp is None else timestamp
+        for _tag, tag_dict in data.items():
+            for value_name, value in tag_dict.items():
+                # generic fields are floats, as the cloud uploader writes them
+                try:
+                    value = float(value)
+                except (TypeError, ValueError) as err:
+                    rpie.SilentError(f"{point_name} {_tag} {value_name}={value} could not be encoded, error: {err}")
+                    continue
+                self._add(point_name, tag_type, _tag, value_name, value, now)
+
+    def raw_series(self, times, data, point_name:str ="m1", tag_type:str = "tag1"):
+        self.encoder.clear()
+        self.encoder.series(point_name, tag_type, times, data)
+        self._pending.extend(self.encoder.lines())
+        self._overflow()
+
+    def flush(self, force:bool=False):
+        """
+        Sends the points held back in one request. Waits for the collector's Retry-After
+        unless `force` is set.
+
+        Raises:
+            SendingError: when the collector can't be reached
+        """
+        if not self._pending: return
+        if not force and time.monotonic() < self._retry_at: return
+        pending, self._pending = self._pending, []
+        try:
+            self.write_lines(pending)
+        except urllib.error.HTTPError as err:
+            if err.code == 429:
+                # the collector is full, keep the points for later
+                self._retry_at = time.monotonic() + float(err.headers.get("Retry-After", 5))
+                self._pending = pending + self._pending
+                self._overflow()
+                return
+            self._spool_points(pending)
+            rpie.SendingError(f"at time {time.time()} the collector refused {len(pending)} points, url: {self.url} \
+                \n the following error was encountered: {err}, {type(err)}")
+            return
+        except Exception as err:
+            self._spool_points(pending)
+            rpie.SendingError(f"at time {time.time()} {len(pending)} points could not be sent to the collector, url: {self.url} \
+                \n the following error was encountered: {err}, {type(err)}")
+            return
+        self._replay()
+
+    def write_lines(self, lines:[str,...]):
+        """
+        Sends line protocol to the collector in one gzipped request. On a partial write
+        the lines the collector couldn't parse are rejected (see `_reject`) and the call
+        returns normally, the rest was queued.
+
+        Raises:
+            urllib.error.HTTPError, urllib.error.URLError: when the collector didn't take them
+        """
+        body = gzip.compress("\n".join(lines).encode(), compresslevel=5)
+        request = urllib.request.Request(self.url, data=body, method="POST", headers=self.headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as err:
+            if err.code != 400: raise
+            try:
+                answer = json.loads(err.read() or b"{}")
+            except ValueError:
+                answer = {}
+            if not str(answer.get("error", "")).startswith("partial write"): raise
+            # the collector runs the same check, the lines it refused are the ones failing it here
+            self._reject([line for line in lines if check_line(line) is not None], err)
+
+    def _reject(self, lines:[str,...], err:Exception):
+        """ lines the collector refused for good, to the spool's rejected.lp, or only logged without a spool """
+        if not lines: return
+        if self.spool is not None:
+            self.spool.reject(lines, err)
+            return
+        sample = "\n".join(lines[:5])
+        rpie.SendingError(f"at time {time.time()} the collector refused {len(lines)} points for good, they are dropped: \
+            \n{sample}")
+
+    def _add(self, measurement:str, tag_key:str, tag_value:str, field:str, value, timestamp:int):
+        """ the value keeps its type (RAM is an int), a field written as 5i and then as 5.0 is refused by the database """
+        try:
+            line = self.encoder.encode(measurement, ((tag_key, tag_value),), {field: value}, timestamp)
+        except (TypeError, ValueError) as err:
+            rpie.SilentError(f"{measurement} {tag_value} {field}={value} could not be encoded, error: {err}")
+            return
+        if line is not None: self._pending.append(line)
+        self._overflow()
+
+    def _overflow(self):
+        """ past max_buffer the oldest points go to the spool (or are lost, without one) """
+        if len(self._pending) <= self.max_buffer: return
+        extra = len(self._pending) - self.max_buffer
+        overflow, self._pending = self._pending[:extra], self._pending[extra:]
+        if self.spool is None:
+            rpie.SilentError(f"collector busy, {extra} points were dropped")
+        self._spool_points(overflow)
+
+    def _hostname(self):
+        try:
+            return socket.gethostname()
+        except Exception:
+            return "Machine Undetected"
+
+    def _spool_points(self, points):
+        """ saves points that could not be sent in the spool (if there is one) """
+        if self.spool is None or not points: return
+        self.spool.append(points)
+
+    def _replay(self):
+        """ sends one chunk of spooled points, only after live data went through """
+        if self.spool is None: return
+        self.spool.replay(self.write_lines, max_lines=self.replay_chunk)
@@ -0,0 +1,134 @@
+"""
+Deadband (change-only) reporting in front of the uploaders.
+
+At night the panels produce nothing and every house sends the same zeros every
+3 seconds. This stage only lets a value through when it has moved far enough from
+the last value sent, or when the series has been quiet for too long (heartbeat).
+
+classes:
+    - deadband_filter: wraps an uploader and drops values that didn't change
+"""
+
+import time, socket
+
+
+def parse_threshold(text:str):
+    """
+    "0.01" -> (0.01, 0) absolute, "5%" -> (0, 0.05) relative
+
+    Returns: (float, float) = absolute, relative
+    """
+    text = str(text).strip()
+    if text.endswith("%"): return 0.0, float(text[:-1])/100
+    return float(text), 0.0
+
+
+class deadband_filter:
+    """
+        ## Purpose and use:
+            Takes the same calls as the uploader it wraps. For every series (measurement,
+            tag, field) it remembers the last value sent and when it was sent. A new value
+            is only sent when:
+                - it differs from the last one by more than the field's threshold, or
+                - `heartbeat` seconds passed since the series was last sent
+            so the dashboards can still tell "no change" from "Pi is down".
+
+            Thresholds are per field name, absolute (0.01) or relative to the last sent
+            value ("5%"). Fields without a threshold are only dropped when they are
+            exactly the same as last time.
+
+            local_performance and net_usage send both of their values if either one changed.
+        ### Methods:
+            - `local_performance`, `net_usage`, `generic`: same as the uploader
+            - `raw_series`, `flush`, `stop`: passed to the uploader
+            - `stats`: sent and suppressed counters
+    """
+    def __init__(self, uploader, thresholds:dict = None, heartbeat:float = 300):
+        """
+        ### Arguments:
+            uploader: the uploader (or upload_worker) to send to
+            thresholds: dict = {field name: threshold}, "0.01" or "5%" (see parse_threshold)
+            heartbeat: float = seconds after which a value is sent even if it didn't change
+        """
+        self.uploader = uploader
+        self.thresholds = {field: parse_threshold(threshold) for field, threshold in (thresholds or {}).items()}
+        self.heartbeat = float(heartbeat)
+        # (measurement, tag, field) -> (last value sent, time.monotonic() it was sent)
+        self._last = {}
+        self.sent = 0
+        self.suppressed = 0
+
+    def stats(self):
+        """ Returns: dict: {sent: int, suppressed: int} points """
+        return {"sent": self.sent, "suppressed": self.suppressed}
+
+    def _changed(self, key, field:str, value, now:float):
+        """ True if the value has to be sent, the last sent value is updated when it is """
+        last = self._last.get(key)
+        if last is not None and now - last[1] < self.heartbeat:
+            try:
+                absolute, relative = self.thresholds.get(field, (0.0, 0.0))
+                if abs(float(value) - last[0]) <= max(absolute, relative*abs(last[0])):
+                    return False
+            except (TypeError, ValueError):
+                pass # not a number, send it
+        try:
+            self._last[key] = (float(value), now)
+        except (TypeError, ValueError):
+            self._last.pop(key, None)
+        return True
+
+    def _filter_pair(self, measurement:str, machine_name:str, values:dict):
+        now = time.monotonic()
+        changed = [self._changed((measurement, machine_name, field), field, value, now) for field, value in values.items()]
+        if any(changed):
+            # both values are sent, so both count as sent now
+            for field, value in values.items():
+                if value is not None: self._last[(measurement, machine_name, field)] = (float(value), now)
+            self.sent += len(values)
+            return True
+        self.suppressed += len(values)
+        return False
+
+    def _hostname(self):
+        try:
+            return socket.gethostname()
+        except Exception:
+            return "Machine Undetected"
+
+    def local_performance(self, machine_name:str=None, cpu_usage:float=None, ram_usage:float=None, timestamp:int=None):
+        machine_name = machine_name or self._hostname()
+        if self._filter_pair("local_performance", machine_name, {"cpu": cpu_usage, "ram": ram_usage}):
+            self.uploader.local_performance(machine_name=machine_name, cpu_usage=cpu_usage, ram_usage=ram_usage, timestamp=timestamp)
+
+    def net_usage(self, machine_name:str=None, net_in:float=None, net_out:float=None, timestamp:int=None):
+        machine_name = machine_name or self._hostname()
+        if self._filter_pair("network", machine_name, {"net_in": net_in, "net_out": net_out}):
+            self.uploader.net_usage(machine_name=machine_name, net_in=net_in, net_out=net_out, timestamp=timestamp)
+
+    def generic(self, data, point_name:str ="m1", tag_type:str = "tag1", timestamp:int=None):
+        if data is None:
+            # let the uploader raise its own error
+            self.uploader.generic(data=data, point_name=point_name, tag_type=tag_type, timestamp=timestamp)
+            return
+
+        now = time.monotonic()
+        changed = {}
+        for tag, fields in data.items():
+            for field, value in fields.items():
+                if self._changed((point_name, tag, field), field, value, now):
+                    changed.setdefault(tag, {})[field] = value
+                    self.sent += 1
+                else:
+                    self.suppressed += 1
+        if changed:
+            self.uploader.generic(data=changed, point_name=point_name, tag_type=tag_type, timestamp=timestamp)
+
+    def raw_series(self, *args, **kwargs):
+        self.uploader.raw_series(*args, **kwargs)
+
+    def flush(self, *args, **kwargs):
+        if hasattr(self.uploader, "flush"): self.uploader.flush(*args, **kwargs)
+
+    def stop(self, *args, **kwargs):
+        if hasattr(self.uploader, "stop"): self.uploader.stop(*args, **kwargs)
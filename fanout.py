@@ -0,0 +1,130 @@
+"""
+Sends the same samples to several backends at once, ie the local InfluxDB for the
+control room and the cloud for the dashboards.
+
+classes:
+    - fanout: wraps any number of uploaders, writes to all of them concurrently
+"""
+
+import threading, time
+from concurrent.futures import ThreadPoolExecutor, wait
+import rpi_errors as rpie
+from metrics import timers
+
+
+class fanout:
+    """
+        ## Purpose and use:
+            Takes the same calls as the uploaders and hands each call to every sink. Every
+            sink has its own thread, so its calls stay in order and its client is only used
+            from one thread, and the sinks write at the same time: a call takes as long as
+            the slowest sink, not the sum of them.
+
+                send = fanout({"local": local_uploader, "cloud": cloud_uploader})
+
+            The sinks fail on their own. An error in one is logged (SilentError, the
+            uploaders log their own sending errors) and the others carry on. A call waits
+            at most `timeout` for the sinks, and only for the ones that had nothing queued:
+            a sink still busy with earlier calls isn't waited for again, so a hung backend
+            costs one timeout, not one per call (a tick makes four). Its calls queue up
+            behind it, up to `max_pending`, past which that sink skips calls (logged once)
+            until it catches up. The time every sink takes is recorded in the loop timings as
+            `sink_<name>`. As in upload_worker, the calls carry the time they were made at
+            (`timestamp`), a sink that is behind doesn't move its points to a later time.
+        ### Methods:
+            - `local_performance`, `net_usage`, `generic`, `raw_series`, `flush`: sent to every sink
+            - `stats`: calls, failures, skipped calls and calls waiting, per sink
+            - `stop`: waits for the sinks to finish and stops the ones that have a stop method
+    """
+    def __init__(self, sinks:dict, timeout:float = 5, max_pending:int = 100):
+        """
+        ### Arguments:
+            sinks: dict = {name: uploader}, the name is used in the logs and timings
+            timeout: float = the longest a call waits for the sinks, 0 = never wait
+            max_pending: int = calls that can wait for one sink
+        ### Raises:
+            rpie.CriticalError: if there are no sinks
+        """
+        if not sinks: raise rpie.CriticalError("fanout needs at least one sink")
+        self.sinks = dict(sinks)
+        self.timeout = float(timeout)
+        self.max_pending = max(1, int(max_pending))
+        self._pools = {name: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sink_{name}") for name in self.sinks}
+        self._lock = threading.Lock()
+        self._pending = {name: 0 for name in self.sinks}
+        self._skipping = {name: False for name in self.sinks}
+        self.counts = {name: {"calls": 0, "failed": 0, "skipped": 0} for name in self.sinks}
+        self._stopped = False
+
+    def local_performance(self, *args, **kwargs):
+        self._stamp(kwargs)
+        self._send("local_performance", args, kwargs)
+
+    def net_usage(self, *args, **kwargs):
+        self._stamp(kwargs)
+        self._send("net_usage", args, kwargs)
+
+    def generic(self, *args, **kwargs):
+        self._stamp(kwargs)
+        self._send("generic", args, kwargs)
+
+    def raw_series(self, *args, **kwargs):
+        self._send("raw_series", args, kwargs)
+
+    def flush(self, *args, **kwargs):
+        # only the sinks that hold points back have a flush
+        self._send("flush", args, kwargs)
+
+    def _stamp(self, kwargs:dict):
+        """ the time of the call, unless the stage in front gave one """
+        if kwargs.get("timestamp") is None: kwargs["timestamp"] = time.time_ns()
+
+    def _send(self, method:str, args, kwargs):
+        futures = []
+        for name, sink in self.sinks.items():
+            if not hasattr(sink, method): continue
+            with self._lock:
+                backlog = self._pending[name]
+                if backlog >= self.max_pending:
+                    self.counts[name]["skipped"] += 1
+                    if not self._skipping[name]:
+                        # only log once per backlog, not for every call
+                        self._skipping[name] = True
+                        rpie.SilentError(f"sink {name} has {self.max_pending} calls waiting, it skips calls until it catches up")
+                    continue
+                self._pending[name] += 1
+            future = self._pools[name].submit(self._call, name, sink, method, args, kwargs)
+            # a sink that is behind already made someone wait, the loop doesn't wait on it again
+            if not backlog: futures.append(future)
+        if futures and self.timeout > 0:
+            wait(futures, timeout=self.timeout)
+
+    def _call(self, name:str, sink, method:str, args, kwargs):
+        """ runs in the thread of the sink """
+        try:
+            with timers.time(f"sink_{name}"):
+                getattr(sink, method)(*args, **kwargs)
+            ok = True
+        except Exception as err:
+            ok = False
+            rpie.SilentError(f"sink {name} could not run {method}, error: {err}, {type(err)}")
+        with self._lock:
+            self._pending[name] -= 1
+            self.counts[name]["calls"] += 1
+            if not ok: self.counts[name]["failed"] += 1
+            if self._pending[name] < self.max_pending // 2: self._skipping[name] = False
+
+    def stats(self):
+        """ Returns: dict: {name: {calls, failed, skipped, pending}} """
+        with self._lock:
+            return {name: {**counts, "pending": self._pending[name]} for name, counts in self.counts.items()}
+
+    def stop(self, timeout:float = 10):
+        """ Stops every sink after the calls it still has waiting, waits up to `timeout` seconds for them (only the first time) """
+        with self._lock:
+            if self._stopped: return
+            self._stopped = True
+        futures = [self._pools[name].submit(getattr(sink, "stop", lambda: None)) for name, sink in self.sinks.items()]
+        wait(futures, timeout=timeout)
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,194 @@
+"""
+In-memory history of the recent values of every series, for local consumers (an on-site
+display, anomaly checks) that shouldn't have to ask the cloud for the last few hours.
+
+classes:
+    - history_store: fixed interval slots in preallocated arrays, optionally in front of an uploader
+"""
+
+import time, socket, threading, warnings
+import numpy as np
+import rpi_errors as rpie
+
+
+class history_store:
+    """
+        ## Purpose and use:
+            Time is cut in slots of `slot_seconds`. Every series (measurement, tag, field)
+            has a row in one preallocated float32 array of shape (max_series, slots), where
+            slots = hours*3600/slot_seconds, used as a ring: slot number n lives in column
+            n % slots. A value written goes in the column of its slot (the last value in a
+            slot wins), which is O(1). Columns are cleared when the ring comes back round,
+            so values older than `hours` are gone and memory never grows:
+
+                64 series, 6 hours of 3 s slots = 64*7200*4 bytes = 1.8 MB
+
+            It takes the same calls as the uploaders and passes them on to `uploader` (if
+            there is one), so main.py can put it in front of the pipeline:
+
+                send = history_store(send, hours=6)
+                ...
+                history.aggregate(("Electricity Gen", "blue_house", "power"), time.time()-900)
+        ### Methods:
+            - `local_performance`, `net_usage`, `generic`: same as the uploader, values are stored
+            - `raw_series`, `flush`, `stop`: passed to the uploader
+            - `add`: store one value
+            - `series`: the stored series
+            - `latest`, `range`, `aggregate`: queries
+            - `memory`: bytes used by the arrays
+    """
+    def __init__(self, uploader = None, hours:float = 6, slot_seconds:float = 3, max_series:int = 64):
+        """
+        ### Arguments:
+            uploader: the uploader (or stage) to pass the calls to, None to only store
+            hours: float = how much history is kept
+            slot_seconds: float = length of a slot, the period of the main loop is a good value
+            max_series: int = rows in the array, series past that are not stored (and logged once)
+        """
+        self.uploader = uploader
+        self.slot_ns = int(float(slot_seconds)*1e9)
+        self.slots = max(1, int(float(hours)*3600/float(slot_seconds)))
+        self.max_series = max(1, int(max_series))
+
+        self.values = np.full((self.max_series, self.slots), np.nan, dtype=np.float32)
+        # the slot number each column holds, -1 = empty
+        self.slot_numbers = np.full(self.slots, -1, dtype=np.int64)
+        self.newest = -1 # highest slot number written
+        self._rows = {} # (measurement, tag, field) -> row
+        self._full_logged = False
+        self._lock = threading.Lock()
+
+    # the uploader calls
+
+    def local_performance(self, machine_name:str=None, cpu_usage:float=None, ram_usage:float=None, timestamp:int=None):
+        machine_name = machine_name or self._hostname()
+        now = time.time_ns() if timestamp is None else timestamp
+        self.add(("local_performance", machine_name, "cpu"), cpu_usage, now)
+        self.add(("local_performance", machine_name, "ram"), ram_usage, now)
+        if self.uploader is not None:
+            self.uploader.local_performance(machine_name=machine_name, cpu_usage=cpu_usage, ram_usage=ram_usage, timestamp=timestamp)
+
+    def net_usage(self, machine_name:str=None, net_in:float=None, net_out:float=None, timestamp:int=None):
+        machine_name = machine_name or self._hostname()
+        now = time.time_ns() if timestamp is None else timestamp
+        self.add(("network", machine_name, "net_in"), net_in, now)
+        self.add(("network", machine_name, "net_out"), net_out, now)
+        if self.uploader is not None:
+            self.uploader.net_usage(machine_name=machine_name, net_in=net_in, net_out=net_out, timestamp=timestamp)
+
+    def generic(self, data, point_name:str ="m1", tag_type:str = "tag1", timestamp:int=None):
+        if data is not None:
+            now = time.time_ns() if timestamp is None else timestamp
+            for tag, fields in data.items():
+                for field, value in fields.items():
+                    self.add((point_name, tag, field), value, now)
+        if self.uploader is not None:
+            self.uploader.generic(data=data, point_name=point_name, tag_type=tag_type, timestamp=timestamp)
+
+    def raw_series(self, *args, **kwargs):
+        if self.uploader is not None: self.uploader.raw_series(*args, **kwargs)
+
+    def flush(self, *args, **kwargs):
+        if hasattr(self.uploader, "flush"): self.uploader.flush(*args, **kwargs)
+
+    def stop(self, *args, **kwargs):
+        if hasattr(self.uploader, "stop"): self.uploader.stop(*args, **kwargs)
+
+    def _hostname(self):
+        try:
+            return socket.gethostname()
+        except Exception:
+            return "Machine Undetected"
+
+    # storing
+
+    def add(self, key:tuple, value, timestamp:int = None):
+        """
+        Args:
+            key (tuple): (measurement, tag, field)
+            value (float): values that aren't numbers are ignored
+            timestamp (int): ns since the epoch, now if not given
+        """
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        number = (time.time_ns() if timestamp is None else int(timestamp)) // self.slot_ns
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                if len(self._rows) >= self.max_series:
+                    if not self._full_logged:
+                        self._full_logged = True
+                        rpie.SilentError(f"history is full ({self.max_series} series), {key} and later series are not kept")
+                    return
+                row = self._rows[key] = len(self._rows)
+            if number > self.newest: self._advance(number)
+            elif number <= self.newest - self.slots: return # older than the history
+            self.values[row, number % self.slots] = value
+
+    def _advance(self, number:int):
+        """ clears the columns between the newest slot and `number`, at most the whole ring """
+        start = max(self.newest + 1, number - self.slots + 1)
+        columns = np.arange(start, number + 1) % self.slots
+        self.values[:, columns] = np.nan
+        self.slot_numbers[columns] = np.arange(start, number + 1)
+        self.newest = number
+
+    # queries
+
+    def series(self):
+        """ Returns: list = the (measurement, tag, field) keys stored """
+        with self._lock:
+            return list(self._rows)
+
+    def memory(self):
+        """ Returns: int = bytes used by the arrays """
+        return self.values.nbytes + self.slot_numbers.nbytes
+
+    def _window(self, key:tuple, start:float = None, end:float = None):
+        """ the slot numbers and values of one series between two times (s since the epoch), oldest first """
+        row = self._rows.get(key)
+        if row is None or self.newest < 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        first = max(self.newest - self.slots + 1, 0 if start is None else int(start*1e9) // self.slot_ns)
+        last = self.newest if end is None else min(self.newest, int(end*1e9) // self.slot_ns)
+        if last < first:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        numbers = np.arange(first, last + 1)
+        columns = numbers % self.slots
+        values = self.values[row, columns]
+        keep = (self.slot_numbers[columns] == numbers) & ~np.isnan(values)
+        return numbers[keep], values[keep]
+
+    def range(self, key:tuple, start:float = None, end:float = None):
+        """
+        Args:
+            key (tuple): (measurement, tag, field)
+            start, end (float): seconds since the epoch, both included, None = all the history
+        Returns:
+            (np.ndarray, np.ndarray): slot start times in ns and the values, oldest first
+        """
+        with self._lock:
+            numbers, values = self._window(key, start, end)
+        return numbers*self.slot_ns, values
+
+    def latest(self, key:tuple):
+        """ Returns: (int, float) = time (ns) and value of the newest slot of the series, (None, None) if it's empty """
+        times, values = self.range(key)
+        if not len(values): return None, None
+        return int(times[-1]), float(values[-1])
+
+    def aggregate(self, key:tuple, start:float = None, end:float = None):
+        """
+        Returns:
+            dict: {count, mean, min, max, last} of the series between start and end, NaN when empty
+        """
+        with self._lock:
+            _, values = self._window(key, start, end)
+        if not len(values):
+            return {"count": 0, "mean": float("nan"), "min": float("nan"), "max": float("nan"), "last": float("nan")}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return {"count": int(len(values)), "mean": float(values.mean(dtype=np.float64)),
+                    "min": float(values.min()), "max": float(values.max()), "last": float(values[-1])}
@@ -0,0 +1,189 @@
+"""
+A small line protocol encoder for the fixed set of measurements this project sends.
+
+Both uploaders can use it instead of building influxdb_client.Point objects or
+nested dicts every loop. The escaped "measurement,tag=value" part of each line
+only changes when the house or machine changes, so it is worked out once and kept.
+
+classes:
+    - line_encoder: turns measurements into line protocol strings
+functions:
+    - check_line: a syntax check of one line, for lines written by someone else
+"""
+
+import math, re
+
+# same escaping rules as influxdb_client.Point
+_escape_measurement = str.maketrans({",": r"\,", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+_escape_key = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"})
+_escape_string = str.maketrans({'"': r"\"", "\\": r"\\"})
+
+# a field value: float, integer (i), unsigned (u), boolean or string
+_field_value = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?|[-+]?\d+i|\d+u|t|T|true|True|TRUE|f|F|false|False|FALSE|"(\\.|[^"\\])*"')
+_timestamp = re.compile(r"-?\d+")
+
+
+class line_encoder:
+    """
+        ## Purpose and use:
+            Writes points as line protocol, the text format both InfluxDB versions read:
+
+                measurement,tag=value field=1.5,other=2i 1690000000000000000
+
+            Field values are written the same way influxdb_client.Point writes them
+            (ints get an `i`, whole floats lose their `.0`, NaN/inf are skipped), so
+            switching encoders doesn't change the field types already in the database.
+        ### Methods:
+            - `encode`: returns one line
+            - `add`: adds one line to the buffer
+            - `series`: adds a line for every timestamp of a raw series
+            - `lines`: the lines in the buffer
+            - `clear`: empties the buffer so it can be reused for the next loop
+    """
+    def __init__(self, cache_size:int = 1024):
+        """
+        ### Arguments:
+            cache_size: int = how many measurement/tag prefixes to remember
+        """
+        self.cache_size = cache_size
+        self._prefixes = {}
+        self._fields = {}
+        self._buffer = []
+
+    def prefix(self, measurement:str, tags:tuple = ()):
+        """
+        Returns the escaped `measurement,tag=value` start of a line, from the cache if possible.
+
+        Args:
+            measurement (str): measurement name, ie "Electricity Gen"
+            tags (tuple): ((tag key, tag value), ...)
+        """
+        key = (measurement, tags)
+        try:
+            return self._prefixes[key]
+        except KeyError:
+            pass
+
+        prefix = str(measurement).translate(_escape_measurement)
+        for tag_key, tag_value in sorted(tags):
+            value = str(tag_value).translate(_escape_key)
+            if value.endswith("\\"): value += " "
+            prefix += f",{str(tag_key).translate(_escape_key)}={value}"
+
+        if len(self._prefixes) >= self.cache_size: self._prefixes.clear()
+        self._prefixes[key] = prefix
+        return prefix
+
+    def _field(self, name:str):
+        try:
+            return self._fields[name]
+        except KeyError:
+            if len(self._fields) >= self.cache_size: self._fields.clear()
+            escaped = self._fields[name] = str(name).translate(_escape_key)
+            return escaped
+
+    def encode(self, measurement:str, tags:tuple, fields:dict, timestamp:int = None):
+        """
+        Args:
+            measurement (str): measurement name
+            tags (tuple): ((tag key, tag value), ...)
+            fields (dict): {field name: value}
+            timestamp (int): nanoseconds since the epoch, or None to let the database pick
+        Returns:
+            str: the line, or None if none of the fields can be written
+        Raises:
+            ValueError: for field values that aren't float, int, bool or str
+        """
+        parts = []
+        for name, value in fields.items():
+            if value is None: continue
+            if isinstance(value, float):
+                if not math.isfinite(value): continue
+                text = str(value)
+                if text.endswith(".0"): text = text[:-2]
+            elif isinstance(value, bool):
+                text = "true" if value else "false"
+            elif isinstance(value, int):
+                text = f"{value}i"
+            elif isinstance(value, str):
+                text = f'"{value.translate(_escape_string)}"'
+            else:
+                raise ValueError(f'Type: "{type(value)}" of field: "{name}" is not supported.')
+            parts.append(f"{self._field(name)}={text}")
+
+        if not parts: return None
+        line = f"{self.prefix(measurement, tags)} {','.join(parts)}"
+        if timestamp is not None: line += f" {int(timestamp)}"
+        return line
+
+    def add(self, measurement:str, tags:tuple, fields:dict, timestamp:int = None):
+        """ same as `encode`, but the line goes in the buffer """
+        line = self.encode(measurement, tags, fields, timestamp)
+        if line is not None: self._buffer.append(line)
+        return line
+
+    def series(self, measurement:str, tag_type:str, times, data:dict):
+        """
+        Adds a timestamped line for every reading of a raw series (ie continuous_sampler.raw()).
+
+        Args:
+            measurement (str): measurement name
+            tag_type (str): tag key, the keys of `data` are its values
+            times (list): timestamps in ns
+            data (dict): {tag value: {field name: list of values, same length as times}}
+        """
+        for tag, fields in data.items():
+            tags = ((tag_type, tag),)
+            names = list(fields)
+            columns = [fields[name].tolist() if hasattr(fields[name], "tolist") else list(fields[name]) for name in names]
+            for i, timestamp in enumerate(times):
+                self.add(measurement, tags, {name: float(column[i]) for name, column in zip(names, columns)}, int(timestamp))
+
+    def lines(self):
+        """ Returns: list = a copy of the lines in the buffer """
+        return list(self._buffer)
+
+    def clear(self):
+        self._buffer.clear()
+
+
+def _split(text:str, separator:str, quotes:bool = False):
+    """ splits on `separator` where it isn't escaped (or inside a string field, with `quotes`) """
+    parts, start, i, quoted = [], 0, 0, False
+    while i < len(text):
+        char = text[i]
+        if char == "\\": i += 1
+        elif quotes and char == '"': quoted = not quoted
+        elif char == separator and not quoted:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def check_line(line:str):
+    """
+    Checks that a line has a measurement, `key=value` tags, at least one field with a
+    valid value and, if there is one, an integer timestamp. Doesn't check the field
+    types against the database: a line can pass here and still be refused for that.
+
+    Args:
+        line (str): one line of line protocol
+    Returns:
+        str: what is wrong with the line, None if it looks right
+    """
+    sections = _split(line.strip(), " ", quotes=True)
+    if len(sections) not in (2, 3): return "needs a measurement, fields and an optional timestamp separated by spaces"
+    series, fields = sections[0], sections[1]
+    measurement, *tags = _split(series, ",")
+    if not measurement: return "no measurement"
+    for tag in tags:
+        key, _, value = tag.partition("=")
+        if not key or not value or len(_split(tag, "=")) != 2: return f"bad tag: {tag}"
+    for field in _split(fields, ",", quotes=True):
+        key_value = _split(field, "=", quotes=True)
+        if len(key_value) != 2 or not key_value[0]: return f"bad field: {field}"
+        if not _field_value.fullmatch(key_value[1]): return f"bad field value: {field}"
+    if len(sections) == 3 and not _timestamp.fullmatch(sections[2]): return f"bad timestamp: {sections[2]}"
+    return None
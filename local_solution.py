@@ -5,9 +5,12 @@ Currently only one class in use.
 """
 
 from influxdb import InfluxDBClient
+from influxdb.line_protocol import make_lines
 import socket # hostname
-import os, time
+import os, time, math
 import rpi_errors as rpie 
+from line_protocol import line_encoder
+from resilience import resilient, circuit_open
 
 
 class upload_data_local_influx:
@@ -19,12 +22,24 @@ class upload_data_local_influx:
             - `local_performance`: send data about cpu/ram/disk usage
             - `net_usage`: sends net usage
             - `generic`: send a generic data point
+            - `raw_series`: send a timestamped series (ie from sampling.continuous_sampler) in one write
+            - `write_lines`: write line protocol as it is
+            - `health`: circuit breaker state and retry counters
     """
     def __init__(self, ifuser: str= None,
                     ifpass:str = None, 
                     ifdb: str =None, 
                     ifhost: str= None,
-                    ifport: int = None):
+                    ifport: int = None,
+                    spool = None,
+                    replay_chunk: int = 5000,
+                    encoder: str = "default",
+                    timeout: float = None,
+                    retries: int = 2,
+                    base_delay: float = 0.2,
+                    max_delay: float = 2,
+                    failure_threshold: int = 3,
+                    reset_timeout: float = 30):
         """ 
         ## Simple init function, establishes connection to InfluxDB
             Following this tutorial:  https://simonhearne.com/2020/pi-metrics-influx/
@@ -34,6 +49,14 @@ class upload_data_local_influx:
             ifdb: str= database name
             ifhost: str= host 
             ifport: int= port number
+            spool: spool= optional spool.spool object, points that fail to send are saved there
+            replay_chunk: int= the most spooled points replayed after each successful write
+            encoder: str= "default" sends dicts for the client to convert, "line" writes line protocol 
+                          directly with line_protocol.line_encoder (faster on a Pi)
+            timeout: float= seconds to wait for the connection and for the answer, None = no limit
+            retries, base_delay, max_delay= tries after the first one and their jittered waits, see resilience.retry_policy
+            failure_threshold, reset_timeout= failures in a row after which writes fail fast, and seconds between 
+                                              two pings while they do, see resilience.circuit_breaker
         Raises:
             rpie.CritcalError: when you don't fill the arguments or database connection isn't working.
         """
@@ -43,14 +66,23 @@ class upload_data_local_influx:
         if ifdb is None:     raise rpie.CritcalError("All fields should be completed")
         if ifhost is None:     raise rpie.CritcalError("All fields should be completed")
         if ifport is None:   raise rpie.CritcalError("All fields should be completed")
+        if encoder not in ("default", "line"): raise rpie.CriticalError(f"{encoder} is not a valid encoder")
         
         try:    
-            self.client = InfluxDBClient(ifhost,ifport,ifuser,ifpass,ifdb)
+            # one try per write in the client (its 0 means forever), the retries are up to self.guard
+            self.client = InfluxDBClient(ifhost,ifport,ifuser,ifpass,ifdb, timeout=timeout, retries=1)
         except Exception as err: 
             raise rpie.CriticalError(f"creating the influxdb client failed, the following error was encountered:\n {err}, {type(err)}")
-
+        
+        self.ifdb = ifdb
+        self.guard = resilient(f"InfluxDB {ifhost}:{ifport}", retries=retries, base_delay=base_delay, max_delay=max_delay,
+                               failure_threshold=failure_threshold, reset_timeout=reset_timeout, probe=self.client.ping)
+        self.spool = spool
+        self.replay_chunk = replay_chunk
+        self.encoder = line_encoder() if encoder == "line" else None
+        self._series_encoder = self.encoder or line_encoder()
     
-    def local_performance(self, machine_name:str=None, cpu_usage:float=None, ram_usage:float=None):
+    def local_performance(self, machine_name:str=None, cpu_usage:float=None, ram_usage:float=None, timestamp:int=None):
         """
         ## Sends performance data
         
@@ -61,6 +93,7 @@ class upload_data_local_influx:
         ## Arguments:
             - `cpu_usage`:float = percentage of cpu in use
             - `ram_uage`: float = total RAM use
+            - `timestamp`: int = ns since the epoch, when it was measured (now if not given)
         
         ## Raises:
             SilentError: if the point/measurment couldn't be added to the bucket.
@@ -82,17 +115,18 @@ class upload_data_local_influx:
         
         point = [{
                 "measurement": machine_name,
-                "time": time.time(),
+                "time": time.time_ns() if timestamp is None else timestamp,
                 "fields": {
                     "cpu": float(cpu_usage),
                     "ram": float(ram_usage),}
                 }]       
         try:
-            self.client.write_points(point)
+            self._write(point)
         except Exception as err:
-            rpie.SilentError(f"cpu data was not sent to influxdb, error: {err}")
+            if not isinstance(err, circuit_open): rpie.SilentError(f"cpu data was not sent to influxdb, error: {err}")
+            self._spool_points(point)
             
-    def net_usage(self,machine_name:str=None, net_in:float=None, net_out:float=None):
+    def net_usage(self,machine_name:str=None, net_in:float=None, net_out:float=None, timestamp:int=None):
         """
         ## Sends performance data
         
@@ -101,6 +135,7 @@ class upload_data_local_influx:
         ## Arguments:
             - `net_in`:float = amount of data recieved
             - `net_out`: float = amount of data sent
+            - `timestamp`: int = ns since the epoch, when it was measured (now if not given)
         
         ## Raises:
             ShortError: blinks the LED shortly to let the user know data usage is unavailble,
@@ -118,17 +153,18 @@ class upload_data_local_influx:
                 pass
         point = [{
                 "measurement": machine_name,
-                "time": time.time(),
+                "time": time.time_ns() if timestamp is None else timestamp,
                 "fields": {
                     "net_in": float(net_in),
                     "net_out": float(net_out),}
                 }]       
         try:
-            self.client.write_points(point)
+            self._write(point)
         except Exception as err:
-            rpie.ShortError(f"cpu data was not sent to influxdb, error: {err}")
+            if not isinstance(err, circuit_open): rpie.ShortError(f"cpu data was not sent to influxdb, error: {err}")
+            self._spool_points(point)
     
-    def generic(self, data, point_name:str ="m1", tag_type:str = "tag1"):
+    def generic(self, data, point_name:str ="m1", tag_type:str = "tag1", timestamp:int=None):
         """
         ## Somewhat Generic data logging method
         
@@ -141,6 +177,7 @@ class upload_data_local_influx:
                             }
             point_name (str): Name of the measurement logged in InfluxDB (ie, electric_data)
             tag_type (str): Name of the tag type used (ie, house)
+            timestamp (int): ns since the epoch, when it was measured (now if not given)
 
         Raises:
             SendingError: when data cannot be logged. The LED on the Raspberry will blink.
@@ -152,24 +189,106 @@ class upload_data_local_influx:
         
         # there are better ways
         try:    
+            if self.encoder is not None:
+                self.encoder.clear()
             for _tag in data:
                 tag_dict=data[_tag]
                 for value_name in tag_dict:
+                    if self.encoder is not None:
+                        self.encoder.add(point_name, ((tag_type, _tag),), {value_name: float(tag_dict[value_name])}, 
+                                         time.time_ns() if timestamp is None else timestamp)
+                        continue
+                    # the encoder skips NaN and inf, so does this path (make_lines would write v=nan)
+                    if not math.isfinite(float(tag_dict[value_name])): continue
                     point.append(
                         {
                         "measurement": point_name,
                         "tags":{tag_type: _tag},
-                        "time": time.time(),
+                        "time": time.time_ns() if timestamp is None else timestamp,
                         "fields": {value_name: float(tag_dict[value_name])}
                         }
                     )
+            if self.encoder is not None:
+                point = self.encoder.lines()
         except:
             rpie.CriticalError(f"making the points failed, likely due to improper formating:{data}")
-        
+
         try:
-            self.client.write_points(point)
+            self._write(point)
         except Exception as err:
-            rpie.SendingError(f"at time {time.time()} the process of writing to the api failed, bucket: {self.bucket}, org: {self.org}  \
+            # the breaker logged the outage once, not every loop
+            if not isinstance(err, circuit_open): rpie.SendingError(f"at time {time.time()} the process of writing to the api failed, database: {self.ifdb}  \
                         \n the following error was encountered: {err}, {type(err)} \n \
                             the current values: {point_name}, {tag_type}:{_tag}, {value_name}:{tag_dict[value_name]}")
+            self._spool_points(point)
+            return
+        self._replay()
+    
+    def raw_series(self, times, data, point_name:str ="m1", tag_type:str = "tag1"):
+        """
+        ## Sends a raw, timestamped series in one write
+        
+        Args:
+            times (list): timestamps in ns
+            data (dict): {"tag 1": {"field name 1": list of values, same length as times}}
+            point_name (str): Name of the measurement logged in InfluxDB
+            tag_type (str): Name of the tag type used (ie, house)
+        Raises:
+            SendingError: when the series cannot be logged.
+        """
+        self._series_encoder.clear()
+        self._series_encoder.series(point_name, tag_type, times, data)
+        lines = self._series_encoder.lines()
+        if not lines: return
+        try:
+            self._write_points(lines, protocol="line")
+        except Exception as err:
+            if not isinstance(err, circuit_open): rpie.SendingError(f"at time {time.time()} a raw series of {len(lines)} points could not be written, database: {self.ifdb}  \
+                        \n the following error was encountered: {err}, {type(err)}")
+            self._spool_points(lines)
+    
+    def write_lines(self, lines:[str,...]):
+        """
+        Writes line protocol as it is, in one request (used by the collector and the spool replay)
+
+        Raises:
+            circuit_open: the database is known to be down, nothing was sent
+            whatever the client raised on the last try, nothing is spooled or logged here
+        """
+        self._write_points(lines, protocol="line")
+    
+    def health(self):
+        """ Returns: dict: breaker state (closed, open, half_open), failures in a row, retries, rejected writes... """
+        return self.guard.stats()
+    
+    def _write_points(self, points, **kwargs):
+        """ client.write_points with retries and the circuit breaker (see resilience.resilient) """
+        return self.guard.call(self.client.write_points, points, **kwargs)
+    
+    def _write(self, points):
+        """
+        writes a list of dict points, with the line encoder they are turned into line protocol here
+        (the generic method fills the encoder buffer directly and passes the lines)
+        """
+        if self.encoder is None:
+            self._write_points(points)
+            return
+        if points and isinstance(points[0], dict):
+            points = [self.encoder.encode(point["measurement"], tuple(point.get("tags", {}).items()),
+                                          point["fields"], point["time"]) for point in points]
+        self._write_points([line for line in points if line is not None], protocol="line")
+
+    def _spool_points(self, points):
+        """ saves points that could not be sent in the spool (if there is one) """
+        if self.spool is None or not points: return
+        if isinstance(points[0], str): self.spool.append(points)
+        else: self.spool.append(make_lines({"points": points}).splitlines())
+    
+    def _replay(self):
+        """ 
+        Sends one chunk of spooled points. Only called after live data went through,
+        so the backlog is sent while the database is up and never ahead of new data.
+        """
+        if self.spool is None: return
+        self.spool.replay(self.write_lines, max_lines=self.replay_chunk)
 
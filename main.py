@@ -2,13 +2,21 @@ import time, os
 import pathlib
 path=pathlib.Path(__file__).parent.resolve()
 print(path)
-from on_start import check_code
-check = check_code(path)
+import sys
+import on_start
+# the checks are cached in preflight.json, `main.py --full-check` runs all of them again
+check = on_start.check_code(path, force="--full-check" in sys.argv)
 
 import tools
 import rpi_errors as rpie
-from local_solution import upload_data_local_influx
-from cloud_solution import upload_data_influxdb_cloud
+from upload_worker import upload_worker
+from spool import spool
+from sampling import continuous_sampler
+from rollup import rollup_stage
+from deadband import deadband_filter
+from scheduler import tick_scheduler
+from metrics import timers
+on_start.mark("imports")
 
 if __name__== "__main__":
     
@@ -17,25 +25,92 @@ if __name__== "__main__":
     
     use_cloud_solution, use_fake = config.get_methods()
     total_time, endless = config.get_time() 
+    startup_budget = config.get_startup_budget()
+    metrics_dir = config.get_metrics()
+    timers.configure(interval=metrics_dir["interval"], enabled=metrics_dir["enabled"])
+    on_start.mark("config")
     
-    if use_cloud_solution:
-        cloud_dir = config.get_cloud()
-        send = upload_data_influxdb_cloud(bucket=cloud_dir["bucket"],
-                                            org=cloud_dir["org"],
-                                            token= cloud_dir["token"],
-                                            url=cloud_dir["url"]) 
+    upload_dir = config.get_upload()
+    
+    # keep the points that couldn't be sent on disk, they are sent again when the database is back
+    spool_dir = config.get_spool()
+    def make_spool(folder:str):
+        if not spool_dir["enabled"]: return None
+        return spool(f"{path}/{folder}", segment_size=spool_dir["segment_size"], max_size=spool_dir["max_size"])
+    
+    # only the backend in use is imported
+    # with the worker the writes (and their retries) are off the loop thread, without it they get one short try
+    background = upload_dir["worker"]
+    fanout_dir = config.get_fanout()
+    if fanout_dir["sinks"]:
+        # the same samples to several backends at once, ie the local database for the control room and the cloud
+        from fanout import fanout
+        uploaders = {}
+        for name in fanout_dir["sinks"]:
+            # one spool per backend, a point is only sent again to the one it failed on.
+            # every sink has its own thread, the loop only waits for them up to the fanout timeout
+            uploaders[name] = tools.make_uploader(config, name, spool=make_spool(f"{spool_dir['directory']}/{name}"), background=True)
+        wait, _ = tools.write_budget("Fanout", config.get_period(), fanout_dir["timeout"], 0)
+        send = fanout(uploaders, timeout=wait, max_pending=fanout_dir["max_pending"])
+    elif config.get_sqlite()["enabled"]:
+        # no database server on site, log to a local SQLite file
+        send = tools.make_uploader(config, "sqlite")
+    elif config.get_collector()["enabled"]:
+        # many Pis send to one collector (collector.py), it writes to the database for them
+        send = tools.make_uploader(config, "collector", spool=make_spool(spool_dir["directory"]), background=background)
+    elif use_cloud_solution:
+        send = tools.make_uploader(config, "cloud", spool=make_spool(spool_dir["directory"]), background=background)
     else:    
-        local_dir = config.get_local()
-        send = upload_data_local_influx(ifuser=local_dir["ifuser"],
-                                        ifpass=local_dir["ifpass"],
-                                        ifdb=local_dir["ifdb"],
-                                        ifhost=local_dir["ifhost"],
-                                        ifport= local_dir["ifport"]) 
+        send = tools.make_uploader(config, "local", spool=make_spool(spool_dir["directory"]), background=background)
+    
+    # send from a background thread so a slow database doesn't hold up the loop
+    if upload_dir["worker"]:
+        send = upload_worker(send, queue_size=upload_dir["queue_size"], overflow=upload_dir["overflow"])
+    # the loop timings go straight here, they aren't measurements to filter, roll up or keep in the history
+    metrics_send = send
+    
+    # only send values that changed (or every heartbeat)
+    deadband_dir = config.get_deadband()
+    if deadband_dir["enabled"]:
+        send = deadband_filter(send, thresholds=deadband_dir["thresholds"], heartbeat=deadband_dir["heartbeat"])
+    
+    # summarise the data on the pi before it's sent, the rollups see every value
+    rollup_dir = config.get_rollup()
+    if rollup_dir["enabled"]:
+        send = rollup_stage(send, windows=rollup_dir["windows"], raw_every=rollup_dir["raw_every"])
+    
+    # the last hours of every series in memory, for local consumers (history.range / aggregate)
+    history_dir = config.get_history()
+    history = None
+    if history_dir["enabled"]:
+        from history import history_store
+        send = history = history_store(send, hours=history_dir["hours"], slot_seconds=history_dir["slot_seconds"],
+                                       max_series=history_dir["max_series"])
 
+    sensors_dir = config.get_sensors()
+    sensor_list = config.get_sensor_list()
     if use_fake:
-        model = tools.read_fake_data()
+        model = tools.read_fake_data(acquisition=sensors_dir["acquisition"], adc_samples=sensors_dir["adc_samples"], sensors=sensor_list)
     else:
-        model = tools.read_data()
+        model = tools.read_data(acquisition=sensors_dir["acquisition"], adc_samples=sensors_dir["adc_samples"], sensors=sensor_list)
+    
+    # play a recording back instead of reading the sensors, `speed` times faster than real time
+    replay_dir = config.get_replay()
+    if replay_dir["source"]:
+        import replay
+        model = replay.read_replay_data(f"{path}/{replay_dir['source']}", speed=replay_dir["speed"], loop=replay_dir["loop"])
+    # a replay is written at the time it was recorded, not squeezed into the next few minutes
+    recorded = model.timestamp if replay_dir["source"] else (lambda: None)
+    
+    # read the sensors from their own thread, the loop only collects the averages
+    sampling_dir = config.get_sampling()
+    if sampling_dir["mode"] == "continuous":
+        model = continuous_sampler(model, rate=sampling_dir["rate"], buffer_seconds=sampling_dir["buffer_seconds"])
+    
+    # save every measurement so it can be replayed later
+    if replay_dir["record"]:
+        import replay
+        model = replay.recorder(model, f"{path}/{replay_dir['record']}")
     
     # hold the last network usage
     # the way the function works is by getting the total upload/download at the check
@@ -43,52 +118,83 @@ if __name__== "__main__":
     # and then save the last measurement. Now you have data from a whole loop, including sending the
     # network data.
     hash_netin1, hash_netout2 = model.measure_network()
+    on_start.mark("clients")
     
     name = model.get_name()
+    
+    # ticks start on a fixed grid of the monotonic clock, late ticks are skipped not stacked up
+    period = config.get_period()
+    if replay_dir["source"]: period /= replay_dir["speed"]
+    schedule = tick_scheduler(period=period)
     i=0
+    first_sample = None
     while i< total_time:
-        start_time=time.time_ns() 
+        start_time=schedule.wait()
         
-        rpie.turn_led(True)
-        time.sleep(0.1)
-        rpie.turn_led(False)
-        time.sleep(0.1)
-        rpie.turn_led(True)
-        time.sleep(0.2)
-        rpie.turn_led(False)
+        rpie.heartbeat()
         
+        # every stage is timed (metrics.timers), an overrun shows which one was slow
         # net measuring part
-        net_in, net_out = model.measure_network()
-        send.net_usage(net_in=( (net_in-hash_netin1) /1024 /1024), net_out=((net_out-hash_netout2) / 1024 /1024))
+        with timers.time("measure_network"):
+            net_in, net_out = model.measure_network()
+        with timers.time("send_net_usage"):
+            send.net_usage(net_in=( (net_in-hash_netin1) /1024 /1024), net_out=((net_out-hash_netout2) / 1024 /1024),
+                           timestamp=recorded())
         hash_netin1, hash_netout2 = net_in, net_out
         
         # send cpu and ram data 
-        cpu,ram = model.measure_cpu()
-        send.local_performance(machine_name=name,cpu_usage= cpu,ram_usage= ram)
+        with timers.time("measure_cpu"):
+            cpu,ram = model.measure_cpu()
+        with timers.time("send_local_performance"):
+            send.local_performance(machine_name=name,cpu_usage= cpu,ram_usage= ram, timestamp=recorded())
         
         # voltage from the model
-        data = model.measure()
-        send.generic(data=data,point_name="Electricity Gen",tag_type="House")
+        with timers.time("measure"):
+            data = model.measure()
+        with timers.time("send_generic"):
+            send.generic(data=data,point_name="Electricity Gen",tag_type="House", timestamp=recorded())
+        
+        if first_sample is None:
+            # how long a restart costs: from the first line of on_start to the first values sent
+            on_start.mark("sample")
+            report = on_start.startup_report()
+            first_sample = report.pop("total")
+            print(f"Time to first sample: {first_sample:.2f} s, {report}")
+            send.generic(data={name: {**report, "first_sample": first_sample}},
+                         point_name="startup", tag_type="Machine")
+            if first_sample > startup_budget:
+                rpie.ShortError(f"Start up took {first_sample:.2f} s, more than the {startup_budget} s budget: {report}")
+        
+        if sampling_dir["mode"] == "continuous" and sampling_dir["raw"]:
+            times, raw = model.raw()
+            with timers.time("send_raw_series"):
+                send.raw_series(times, raw, point_name="Electricity Gen Raw", tag_type="House")
         
+        # the stage timings of the last `interval` seconds, in the loop_timing measurement
+        timers.publish(metrics_send)
+        
+        # in batch mode (and to a collector) the points above are only sent here, in one write
+        if hasattr(send, "flush"): 
+            with timers.time("flush"):
+                send.flush()
 
-        end_time=time.time_ns()
+        end_time=time.monotonic_ns()
+        timers.record("tick", (end_time-start_time)*1e-9)
         
         time_elapsed = (end_time-start_time)*1e-9  # 1e-9 because nanoseconds
         
-        # make sure a loop takes about 3 seconds.
-        # if it' longer but still acceptable (10), then just send a short error
-        # if it's shorter than 0, time travel (or trivial bug) -> short error
-        # if the absolute value is larger than 10, then there is a big problem with the code
-        
+        # make sure a loop takes about one period (3 seconds).
+        # if it' longer but still acceptable (10), then just send a short error, the scheduler skips the ticks it missed
+        # if it's larger than 10, then there is a big problem with the code
+        # the clock is monotonic so there is no more time travel to check for
         
-        if time_elapsed > 4 and time_elapsed <10:
-            rpie.ShortError(f"Total loop time: {time_elapsed} is {time_elapsed-3} longer than expected")
-        elif time_elapsed < 0 :
-            rpie.ShortError(f"Time travel discovered! We have returned {time_elapsed} seconds in the past! Initial time at {start_time}, final: {end_time}")
-        elif abs(time_elapsed) >10:
-            raise rpie.CriticalError(f"This code is to buggy to work within it's time paramenters. Maintance required. Loop took {time_elapsed} seconds")
-        else:
-            duration=max(1,(3-time_elapsed))  
-            time.sleep(duration)
+        if time_elapsed > max(10, 3*period):
+            raise rpie.CriticalError(f"This code is to buggy to work within it's time paramenters. Maintance required. Loop took {time_elapsed} seconds, stages (ms): {timers.last()}")
+        elif time_elapsed > period+1:
+            rpie.ShortError(f"Total loop time: {time_elapsed} is {time_elapsed-period} longer than expected, {schedule.missed} ticks missed so far, stages (ms): {timers.last()}")
         
-        if endless: i+=1
\ No newline at end of file
+        if endless: i+=1
+    
+    # once, down the whole chain: the worker queue, the points held back in batch mode, the sinks
+    if hasattr(send, "stop"): send.stop()
+    if sampling_dir["mode"] == "continuous" or replay_dir["record"]: model.stop()
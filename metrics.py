@@ -0,0 +1,175 @@
+"""
+Timing of the hot path: how long every stage of the main loop takes.
+
+The loop only ever logged its total time, and only when it ran over. With the stages
+timed separately an overrun shows whether I2C, psutil or the network was slow.
+
+Only uses the standard library, so rpi_errors can time the LED and the error log too.
+
+classes:
+    - histogram: fixed buckets, constant memory whatever the number of samples
+    - stage_metrics: one histogram per stage, timers and periodic publishing
+"""
+
+import time, threading, functools
+from contextlib import contextmanager
+from scheduler import tick_scheduler
+
+# upper bounds of the buckets in seconds, 50 us to 30 s, the last bucket takes the rest
+bounds = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+          0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+
+
+class histogram:
+    """
+        ## Purpose and use:
+            Counts durations in the buckets above, plus their count, sum and max.
+            Percentiles are estimated by interpolating inside a bucket, good to within
+            the width of the bucket, which is plenty to tell 1 ms from 100 ms.
+        ### Methods:
+            - `add`: one duration in seconds
+            - `percentile`: estimated duration below which a fraction of the samples are
+            - `summary`: count, mean, p50, p90, p99, max in ms
+            - `clear`
+    """
+    def __init__(self):
+        self.buckets = [0]*len(bounds)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds:float):
+        for i, bound in enumerate(bounds):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+
+    def percentile(self, fraction:float):
+        if not self.count: return 0.0
+        rank = fraction*self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                low = bounds[i-1] if i else 0.0
+                high = min(bounds[i], self.max)
+                return low + (high-low)*(rank-seen)/count
+            seen += count
+        return self.max
+
+    def summary(self):
+        """ Returns: dict: {count, mean_ms, p50_ms, p90_ms, p99_ms, max_ms} """
+        return {
+            "count": self.count,
+            "mean_ms": self.total/self.count*1e3 if self.count else 0.0,
+            "p50_ms": self.percentile(0.5)*1e3,
+            "p90_ms": self.percentile(0.9)*1e3,
+            "p99_ms": self.percentile(0.99)*1e3,
+            "max_ms": self.max*1e3
+        }
+
+    def clear(self):
+        self.__init__()
+
+
+class stage_metrics:
+    """
+        ## Purpose and use:
+            Keeps a histogram and the last duration of every stage. Stages are timed on
+            time.monotonic_ns(), with a context manager or a decorator:
+
+                with timers.time("measure"):
+                    data = model.measure()
+
+                @timers.timed("led")
+                def Blink(...): ...
+
+            `publish` sends the summaries of the last period with the uploader's `generic`,
+            one point per stage (tag Stage) in the `loop_timing` measurement, and starts
+            new histograms. It's safe to time stages from other threads (the upload worker).
+        ### Methods:
+            - `time`, `timed`, `record`: add a duration
+            - `last`: the most recent duration of every stage, in ms
+            - `summaries`: histogram summaries of every stage
+            - `publish`: sends the summaries every `interval` seconds
+    """
+    def __init__(self, interval:float = 60, enabled:bool = True):
+        """
+        ### Arguments:
+            interval: float = seconds between two publish calls that send something
+            enabled: bool = when False nothing is recorded (the timers still run the code)
+        """
+        self.enabled = enabled
+        self._histograms = {}
+        self._last = {}
+        self._lock = threading.Lock()
+        self.schedule = tick_scheduler(period=interval)
+        self.schedule.due() # starts the grid, the first publish is one interval from now
+
+    def configure(self, interval:float = None, enabled:bool = None):
+        """ main.py calls this once config.ini is read """
+        if enabled is not None: self.enabled = enabled
+        if interval is not None:
+            self.schedule = tick_scheduler(period=interval)
+            self.schedule.due()
+
+    def record(self, stage:str, seconds:float):
+        if not self.enabled: return
+        with self._lock:
+            hist = self._histograms.get(stage)
+            if hist is None: hist = self._histograms[stage] = histogram()
+            hist.add(seconds)
+            self._last[stage] = seconds
+
+    @contextmanager
+    def time(self, stage:str):
+        start = time.monotonic_ns()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.monotonic_ns()-start)*1e-9)
+
+    def timed(self, stage:str):
+        """ decorator version of `time` """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(stage):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def last(self, stages:[str,...] = None):
+        """ Returns: dict: {stage: ms} of the last time each stage ran """
+        with self._lock:
+            return {stage: round(seconds*1e3, 2) for stage, seconds in self._last.items()
+                    if stages is None or stage in stages}
+
+    def summaries(self, reset:bool = False):
+        """ Returns: dict: {stage: histogram.summary()} """
+        with self._lock:
+            result = {stage: hist.summary() for stage, hist in self._histograms.items() if hist.count}
+            if reset: self._histograms = {}
+        return result
+
+    def publish(self, send, point_name:str = "loop_timing"):
+        """
+        Sends the summaries when `interval` seconds passed since the last time, does nothing otherwise
+
+        Args:
+            send: an uploader (or stage) with a `generic` method
+            point_name (str): measurement name
+        Returns:
+            bool: True if something was sent
+        """
+        if not self.enabled or not self.schedule.due(): return False
+        data = self.summaries(reset=True)
+        if not data: return False
+        send.generic(data=data, point_name=point_name, tag_type="Stage")
+        return True
+
+
+# the timers shared by main.py, the uploaders and rpi_errors
+timers = stage_metrics()
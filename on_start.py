@@ -10,42 +10,104 @@ It's meant to work even if you only have python 3.11 installed. Everything else
 import os,sys, time
 import subprocess 
 import platform 
+import hashlib, json, threading
+from importlib import metadata
+
+started = time.monotonic_ns() # used for the time to first sample
+phases = {} # start up phase -> seconds, filled by mark()
+_last_mark = started
+
+def mark(phase:str):
+    """ ends a start up phase (preflight, imports, config, ...), it's timed from the end of the previous one """
+    global _last_mark
+    now = time.monotonic_ns()
+    phases[phase] = round((now-_last_mark)*1e-9, 3)
+    _last_mark = now
+
+def startup_report():
+    """
+    Returns:
+        dict: {phase: seconds, ..., total: seconds since on_start was imported}
+    """
+    return {**phases, "total": round((time.monotonic_ns()-started)*1e-9, 3)}
 
 class check_code:
-    def __init__(self, path) -> None:
+    def __init__(self, path, force:bool=False) -> None:
         """## Verify code before start
         
          This class checks for:
             - OS 
-            - internet connectivity 
+            - internet connectivity (in the background, it doesn't hold up the start)
             - any missing files/dependencies
             - file management (removes error logs if they are larger than 100 mb)
-
+        
+        What was checked is saved in preflight.json (the manifest): a hash of requirements.txt,
+        the installed versions and a checksum of every file. When nothing changed since the 
+        last start pip isn't called again, so a restart after a crash only takes a moment.
+        
+        ### Arguments:
+            path: folder of the code
+            force: bool = ignore the manifest and run every check
         """
         self.path= path
         self.errorfile = f"{path}/errorfile.txt"
+        self.manifest_file = f"{path}/preflight.json"
+        self.timings = {}
+        
+        self.manifest = {} if force else self.load_manifest()
+        new_manifest = {"python": sys.version, "executable": sys.executable}
 
-        self.check_OS()
-        self.check_network()
-        self.check_files()
-        self.check_dependecies()
+        self._timed("os", self.check_OS)
+        # pings take seconds when the network is down, nothing below needs them
+        self.network = threading.Thread(target=self.check_network, name="check_network", daemon=True)
+        self.network.start()
+        new_manifest["files"] = self._timed("files", self.check_files)
+        new_manifest.update(self._timed("dependencies", self.check_dependecies))
+        self._timed("led", self.setup_led)
         
-        # set the led up
+        self.save_manifest(new_manifest)
+        self.preflight_time = (time.monotonic_ns()-started)*1e-9
+        mark("preflight")
+        print(f"Preflight took {self.preflight_time:.2f} s: {self.timings}")
         
+    def _timed(self, name:str, check):
+        start = time.monotonic_ns()
+        result = check()
+        self.timings[name] = round((time.monotonic_ns()-start)*1e-9, 3)
+        return result
+    
+    def load_manifest(self):
+        """ the manifest of the last start, empty if there isn't one (or it can't be read) """
+        try:
+            with open(self.manifest_file) as manifest:
+                return json.load(manifest)
+        except FileNotFoundError:
+            return {}
+        except Exception as err:
+            self.log_error(f"preflight.json could not be read, running every check. Error: {err}")
+            return {}
+    
+    def save_manifest(self, manifest:dict):
+        try:
+            with open(f"{self.manifest_file}.tmp", "w") as file:
+                json.dump(manifest, file, indent=1)
+            os.replace(f"{self.manifest_file}.tmp", self.manifest_file)
+        except Exception as err:
+            self.log_error(f"preflight.json could not be saved, the next start will run every check. Error: {err}")
+    
+    def setup_led(self):
+        """ sets pin 18 up and shows the start up blinks, without waiting for them """
         try:
             import RPi.GPIO as GPIO
 
             GPIO.setmode(GPIO.BCM)
             GPIO.setwarnings(False)
             GPIO.setup(18,GPIO.OUT)
-        
-            for i in range(10):
-                GPIO.output(18,GPIO.HIGH)
-                time.sleep(1)
-                GPIO.output(18,GPIO.LOW)
-                time.sleep(0.5)
-        except RuntimeError as err:
+        except (RuntimeError, ImportError) as err:
             print(f"The blinking is disabled on WSL: \n {err}")    
+            return
+        import rpi_errors as rpie
+        rpie.led.show([(True, 1), (False, 0.5)]*10, priority=1)
         # The following code is for onboard led:
         # I commented it out because it doesn't work for my board but you might want 
         # to try and waste your time too! If you get it running, well, let me know!
@@ -79,8 +141,13 @@ class check_code:
             errfile.write("\n#################################################### \n")
             
     def check_files(self, files:[str,...]=None):
+        """
+        Returns:
+            dict: {file: [size, mtime, sha256]} for the manifest. Files with the same size and 
+                  modification time as last start aren't hashed again.
+        """
         if files is None: 
-            files= ["cloud_solution.py", "local_solution.py","rpi_errors.py",
+            files= ["main.py", "on_start.py", "cloud_solution.py", "local_solution.py","rpi_errors.py",
                     "tools.py", "requirements.txt", "config.ini"]
         
         # The errorfile has to be handled separate
@@ -91,11 +158,9 @@ class check_code:
                 self.log_error(f"errorfile.txt exists but system could not find its size. Error: {err}")
             # make sure we don't overload the RPi with errors
             if size > 1e8: # 1e8 is 100 Mb
-                if os.path.isfile(f"errorfile_old.txt"): os.remove(f"errorfile_old.txt") 
-                os.rename(self.errorfile, f"errorfile_old.txt") # we keep the old one when it reaches 100 Mb 
+                # we keep the old one when it reaches 100 Mb 
                 # the maximum size of errors is 200 Mb of data, plenty for debugging and not more than the RPi can handle
-                os.remove(self.errorfile)
-                self.create_errorfile()
+                os.replace(self.errorfile, f"{self.path}/errorfile_old.txt") 
         self.create_errorfile() # This will either create the error file or log the start
 
         # the other files are pulled from git
@@ -110,20 +175,76 @@ class check_code:
                                     check=True)
                 except Exception as err:
                     self.crit_error(f"Failed to copy file {file}. Critical part missing, error encountered: {err}")
+        
+        old = self.manifest.get("files", {})
+        checksums = {}
+        for file in files:
+            try:
+                stat = os.stat(f"{self.path}/{file}")
+            except OSError:
+                continue
+            last = old.get(file)
+            if last is not None and last[:2] == [stat.st_size, stat.st_mtime_ns]:
+                checksums[file] = last
+                continue
+            checksums[file] = [stat.st_size, stat.st_mtime_ns, self._hash(f"{self.path}/{file}")]
+            if last is not None and last[2] != checksums[file][2]:
+                self.log_error(f"{file} changed since the last start")
+        return checksums
+    
+    def _hash(self, filename:str):
+        with open(filename, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()
+    
+    def installed_versions(self, requirements:[str,...]):
+        """ 
+        Returns:
+            dict: {package: installed version}, None when the pinned version isn't installed
+        """
+        versions = {}
+        for line in requirements:
+            line = line.split("#")[0].strip()
+            if not line: continue
+            name, _, pinned = line.partition("==")
+            try:
+                version = metadata.version(name.strip())
+            except metadata.PackageNotFoundError:
+                version = None
+            if pinned and version != pinned.strip(): version = None
+            versions[name.strip()] = version
+        return versions
                 
     def check_dependecies(self):
         """
         Will automatically call pip to check on requirements.txt
         
         https://pip.pypa.io/en/latest/user_guide/#using-pip-from-your-program
+        
+        pip is skipped when requirements.txt and the python are the same as in the manifest
+        and every pinned version is still installed.
 
+        Returns:
+            dict: {requirements: hash, packages: {package: version}} for the manifest
         Raises:
             crit-error: when something doesn't work
         """
+        requirements = f'{self.path}/requirements.txt'
+        with open(requirements) as file:
+            lines = file.read().splitlines()
+        req_hash = self._hash(requirements)
+        
+        versions = self.installed_versions(lines)
+        if (self.manifest.get("requirements") == req_hash 
+                and self.manifest.get("executable") == sys.executable
+                and self.manifest.get("packages") == versions
+                and None not in versions.values()):
+            return {"requirements": req_hash, "packages": versions}
+        
         try:
-            pip_install = subprocess.check_call([sys.executable, '-m', 'pip', 'install', '-r', f'{self.path}/requirements.txt'])
+            pip_install = subprocess.check_call([sys.executable, '-m', 'pip', 'install', '-r', requirements])
         except Exception as err:
             self.crit_error(f"When updating dependencies the following error was encountered:{err}")
+        return {"requirements": req_hash, "packages": self.installed_versions(lines)}
 
     def check_OS(self):
         """ uses pltform.system to check for Raspberrr OS   """
@@ -136,14 +257,15 @@ class check_code:
         """### Pings google and listens
         
         This method tries to detect network connection without requiering external libraries
+        It runs on its own thread (check_code.network), the start doesn't wait for it.
         
         """
-        response = subprocess.call(['ping', '-c', '1', host])
+        response = subprocess.call(['ping', '-c', '1', '-W', '5', host])
 
         # exit if network connection worked
         if response == 0: 
             # try github for the fun of it (make sure its not under maintance)
-            gitresponse = os.system("ping -c 1 github.com")
+            gitresponse = os.system("ping -c 1 -W 5 github.com")
             if gitresponse == 0: 
                 print("Network fully functional")
                 return 
@@ -0,0 +1,253 @@
+"""
+Recorded sensor data: a recorder that saves what read_data measures, and a replay
+source that plays it back, up to 1000x faster, with the same calls as read_data.
+
+read_fake_data is noise, useless for testing rollups, deadbands or dashboards.
+A few days recorded on a real Pi can be pushed through the whole pipeline in minutes.
+
+File format (.spb), compact and fixed size so it can be memory mapped:
+    line 1: b"SPBREC1"
+    line 2: JSON header {sensors, channels, average_of, machine}
+    then one record per measure() call, little endian:
+        time int64 (ns), values float32 (sensors, channels), cpu float32, ram float64,
+        net_in float64, net_out float64 (the byte counters, as measure_network returns them)
+    84 bytes per record with 4 sensors, about 2.4 MB a day at one record every 3 s.
+
+classes:
+    - recorder: wraps read_data (or anything like it) and writes every measurement
+    - read_replay_data: plays a recording back
+"""
+
+import json, time, os, threading, atexit
+import numpy as np
+import rpi_errors as rpie
+from sampling import sample_engine, channels
+
+magic = b"SPBREC1\n"
+
+
+def record_dtype(sensors:int, n_channels:int = len(channels)):
+    return np.dtype([("time", "<i8"), ("values", "<f4", (sensors, n_channels)), ("cpu", "<f4"),
+                     ("ram", "<f8"), ("net_in", "<f8"), ("net_out", "<f8")])
+
+
+def open_recording(filename:str):
+    """
+    Returns:
+        (dict, np.memmap): the header and the records, memory mapped (read only)
+    Raises:
+        CriticalError: if the file isn't a recording
+    """
+    try:
+        with open(filename, "rb") as file:
+            if file.readline() != magic: raise ValueError("not a recording")
+            header = json.loads(file.readline())
+            offset = file.tell()
+        dtype = record_dtype(len(header["sensors"]), len(header["channels"]))
+        # a power cut can leave half a record at the end, it's left out
+        count = (os.path.getsize(filename) - offset) // dtype.itemsize
+        records = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=(count,)) if count else np.zeros(0, dtype=dtype)
+    except Exception as err:
+        raise rpie.CriticalError(f"{filename} could not be opened as a recording, error: {err}")
+    return header, records
+
+
+class recorder:
+    """
+        ## Purpose and use:
+            Takes the same calls as the model it wraps and passes them on. Every `measure`
+            also appends one record to `filename`: the means of that measurement and the
+            last cpu/ram and network values read. Records are buffered and written every
+            `flush_every` records (and at exit).
+
+            In main.py it goes around the model: [Replay] record: <file>
+        ### Methods:
+            - `measure`, `measure_stats`, `measure_cpu`, `measure_network`, `get_name`: passed to the model
+            - `flush`: writes the buffered records
+            - `stop`: flushes, and stops the model if it has a stop method
+    """
+    def __init__(self, model, filename:str, flush_every:int = 20):
+        """
+        ### Arguments:
+            model: read_data, read_fake_data or continuous_sampler object
+            filename: str = the recording, appended to if it exists (with the same sensors)
+            flush_every: int = records kept in memory before they are written
+        """
+        self.model = model
+        self.filename = filename
+        self.flush_every = max(1, int(flush_every))
+        self.engine = model.engine
+        names = self.engine.sensor_names
+        self.header = {"sensors": names, "channels": list(channels),
+                       "average_of": [names[s] for s in self.engine.average_of],
+                       "machine": model.get_name()}
+        self.dtype = record_dtype(len(names))
+        self._buffer = np.zeros(self.flush_every, dtype=self.dtype)
+        self._count = 0
+        self._cpu = (float("nan"), float("nan"))
+        self._net = (float("nan"), float("nan"))
+        self._lock = threading.Lock()
+
+        try:
+            with open(filename, "rb") as file:
+                first = file.readline()
+                existing = json.loads(file.readline()) if first == magic else None
+            if existing is None or existing["sensors"] != names or existing["channels"] != list(channels):
+                raise rpie.CriticalError(f"{filename} exists and isn't a recording of the same sensors")
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+            with open(filename, "wb") as file:
+                file.write(magic + json.dumps(self.header).encode() + b"\n")
+        atexit.register(self.flush)
+
+    def measure(self):
+        data = self.model.measure()
+        # the engine that made the measurement, continuous_sampler has its own
+        engine = getattr(self.model, "engine", self.engine)
+        with self._lock:
+            record = self._buffer[self._count]
+            record["time"] = time.time_ns()
+            record["values"] = engine.stats()["mean"]
+            record["cpu"], record["ram"] = self._cpu
+            record["net_in"], record["net_out"] = self._net
+            self._count += 1
+            full = self._count >= self.flush_every
+        if full: self.flush()
+        return data
+
+    def measure_stats(self):
+        return self.model.measure_stats()
+
+    def measure_cpu(self):
+        self._cpu = self.model.measure_cpu()
+        return self._cpu
+
+    def measure_network(self):
+        self._net = self.model.measure_network()
+        return self._net
+
+    def get_name(self):
+        return self.model.get_name()
+
+    def flush(self):
+        with self._lock:
+            if not self._count: return
+            data = self._buffer[:self._count].tobytes()
+            self._count = 0
+        try:
+            with open(self.filename, "ab") as file:
+                file.write(data)
+        except Exception as err:
+            rpie.SilentError(f"{len(data)//self.dtype.itemsize} records could not be written to {self.filename}, error: {err}")
+
+    def stop(self):
+        self.flush()
+        if hasattr(self.model, "stop"): self.model.stop()
+
+
+class read_replay_data:
+    """
+        ## Purpose and use:
+            Same calls as read_data, the values come from a recording. The recording is
+            played on a virtual clock that runs `speed` times faster than the real one:
+            every `measure` returns the mean of the records between the previous call and
+            "now" on that clock (or the next record if none is due, so it never repeats
+            itself or returns nothing). main.py divides its period by `speed`, so at 1000x a
+            3 s loop runs every 3 ms and a day of data goes through in under 2 minutes.
+
+            At the end of the recording it starts again (with `loop`) or raises CriticalError.
+            The network counters keep growing across loops so the differences stay right.
+
+            The points are meant to be written at the time they were recorded, main.py passes
+            `timestamp()` to the uploader: otherwise a replayed day lands in a few minutes of
+            today. Every loop is written one recording length after the previous one.
+        ### Methods:
+            - `measure`, `measure_stats`, `measure_cpu`, `measure_network`, `get_name`: same as read_data
+            - `read_sensor`: the current record of one sensor, for continuous_sampler
+            - `timestamp`: when the current record was recorded (ns since the epoch)
+    """
+    def __init__(self, filename:str, speed:float = 1, loop:bool = True):
+        """
+        ### Arguments:
+            filename: str = a recording made by `recorder`
+            speed: float = 1 to 1000, how much faster than real time
+            loop: bool = start again at the end of the recording
+        ### Raises:
+            CriticalError: if the file can't be read, is empty or the speed is out of range
+        """
+        if not 1 <= float(speed) <= 1000:
+            raise rpie.CriticalError(f"replay speed has to be between 1 and 1000, not {speed}")
+        self.header, self.records = open_recording(filename)
+        if not len(self.records):
+            raise rpie.CriticalError(f"{filename} has no records")
+
+        self.speed = float(speed)
+        self.loop = loop
+        self.sensor_names = self.header["sensors"]
+        self.ina_list = list(range(len(self.sensor_names)))
+        self.acquisition = "replay"
+        self.engine = sample_engine(self.sensor_names, rounds=1, average_of=self.header["average_of"])
+
+        times = self.records["time"]
+        self._first = int(times[0])
+        # one loop of the recording, plus one record length so the last and first don't overlap
+        self._length = int(times[-1]) - self._first + (int(times[-1]-times[-2]) if len(times) > 1 else int(3e9))
+        self._started = time.monotonic_ns()
+        self._position = 0 # next record, counted across loops
+        self._current = 0 # last record measured, counted across loops
+        self._net_offset = (0.0, 0.0)
+
+    def _clock(self):
+        """ Returns: int = how far into the recording (ns, across loops) the virtual clock is """
+        return int((time.monotonic_ns() - self._started)*self.speed)
+
+    def _time(self, position:int):
+        """ recording time of a record counted across loops """
+        laps, index = divmod(position, len(self.records))
+        return int(self.records["time"][index]) - self._first + laps*self._length
+
+    def _advance(self):
+        """ moves past the records that are due, returns their range (positions across loops) """
+        now = self._clock()
+        start = self._position
+        end = start + 1
+        while self._time(end) <= now and end - start < len(self.records): end += 1
+        if not self.loop and end > len(self.records):
+            raise rpie.CriticalError("the recording is over")
+        self._position = end
+        self._current = end - 1
+        return start, end
+
+    def measure(self):
+        """
+        Returns:
+            dict: same as read_data.measure(), the mean of the records that were due
+        """
+        start, end = self._advance()
+        index = np.arange(start, end) % len(self.records)
+        self.engine.load(np.asarray(self.records["values"][index], dtype=float))
+        return self.engine.as_dict()
+
+    def measure_stats(self):
+        return {statistic: self.engine.as_dict(statistic) for statistic in ("mean","min","max","std")}
+
+    def read_sensor(self, sensor:int):
+        return tuple(float(value) for value in self.records["values"][self._current % len(self.records)][sensor])
+
+    def measure_cpu(self):
+        record = self.records[self._current % len(self.records)]
+        return float(record["cpu"]), float(record["ram"])
+
+    def measure_network(self):
+        laps, index = divmod(self._current, len(self.records))
+        record, first, last = self.records[index], self.records[0], self.records[-1]
+        # every loop adds the traffic of a whole recording, the counters never go back
+        return (float(record["net_in"]) + laps*float(last["net_in"]-first["net_in"]),
+                float(record["net_out"]) + laps*float(last["net_out"]-first["net_out"]))
+
+    def timestamp(self):
+        """ Returns: int = recording time (ns since the epoch) of the last record measured, later on every loop """
+        return self._first + self._time(self._current)
+
+    def get_name(self):
+        return self.header.get("machine") or "Replay_machine"
@@ -0,0 +1,247 @@
+"""
+Retries and a circuit breaker for the writes to the database.
+
+With the database down every write of a tick used to wait for its own connection
+timeout, so one outage made minute long ticks. Now a write is retried a few times
+with a growing, jittered delay, and once the database has failed enough times in a
+row the breaker opens: writes fail straight away (the uploaders spool the points)
+while a background thread checks when the database is back.
+
+classes:
+    - circuit_open: raised instead of writing while the breaker is open
+    - retry_policy: how many times and how long to wait between tries
+    - circuit_breaker: closed / open / half open, with a background probe
+    - resilient: a retry policy and a breaker around one backend, used by the uploaders
+"""
+
+import time, random, threading
+import rpi_errors as rpie
+
+
+class circuit_open(Exception):
+    """ the backend is known to be down, the write wasn't tried """
+
+
+def is_transient(err:Exception):
+    """
+    Errors worth retrying: timeouts, refused connections, 5xx, 408 and 429.
+    A 4xx means the server is up and said no, trying again would get the same answer.
+
+    Both clients put the status on their exceptions, influxdb_client as `status`, influxdb as `code`.
+    """
+    status = getattr(err, "status", None) or getattr(err, "code", None)
+    if isinstance(status, int) and 400 <= status < 500 and status not in (408, 429): return False
+    return True
+
+
+class retry_policy:
+    """
+        ## Purpose and use:
+            Exponential backoff with full jitter: the wait before try n is a random time
+            between 0 and min(max_delay, base_delay*2**n), so Pis that lost the database
+            together don't all come back at the same instant.
+        ### Methods:
+            - `delay`: the wait before a retry
+    """
+    def __init__(self, retries:int = 2, base_delay:float = 0.2, max_delay:float = 2):
+        """
+        ### Arguments:
+            retries: int = tries after the first one
+            base_delay: float = seconds, the longest first wait
+            max_delay: float = seconds, the longest wait
+        """
+        self.retries = max(0, int(retries))
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+
+    def delay(self, attempt:int):
+        """ Returns: float = seconds to wait before retry number `attempt` (0 is the first retry) """
+        return random.uniform(0, min(self.max_delay, self.base_delay*2**attempt))
+
+
+class circuit_breaker:
+    """
+        ## Purpose and use:
+            closed: writes go through, failures in a row are counted
+            open: `failure_threshold` failures in a row, writes are refused (circuit_open)
+            half_open: the database might be back, one write goes through to check
+
+            With a `probe` (ie the client's ping) a daemon thread calls it every
+            `reset_timeout` seconds (jittered) while the breaker is open, and closes it when
+            it succeeds, so the loop never waits on a dead database. Without one, the
+            breaker goes half open after `reset_timeout` and the next write is the test.
+
+            Opening is logged once as a SendingError, closing as a SilentError.
+        ### Methods:
+            - `allow`: may a write be tried now
+            - `success`, `failure`: the result of a write
+            - `state`: closed, open or half_open
+            - `stats`: state and counters
+    """
+    def __init__(self, name:str = "database", failure_threshold:int = 3, reset_timeout:float = 30, probe = None):
+        """
+        ### Arguments:
+            name: str = what the breaker protects, for the error log
+            failure_threshold: int = failures in a row that open the breaker
+            reset_timeout: float = seconds between two probes (or before going half open)
+            probe: function = returns something truthy (or doesn't raise) when the backend is up, optional
+        """
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.probe = probe
+        self._state = "closed"
+        self._lock = threading.Lock()
+        self._opened_at = 0.0
+        self._thread = None
+        self.failures = 0 # in a row
+        self.opened = 0
+        self.rejected = 0
+        self.probes = 0
+        self.last_error = None
+
+    def state(self):
+        with self._lock:
+            if self._state == "open" and self.probe is None and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = "half_open"
+            return self._state
+
+    def allow(self):
+        """ Returns: bool = True if a write may be tried (in half open, only one at a time) """
+        state = self.state()
+        with self._lock:
+            if state == "closed": return True
+            if state == "half_open":
+                # the test write, the others keep failing fast until it's done
+                self._state = "testing"
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            was = self._state
+            self._state = "closed"
+            self.failures = 0
+        if was != "closed": self._closed_log()
+
+    def failure(self, err:Exception = None):
+        with self._lock:
+            self.failures += 1
+            self.last_error = f"{err}, {type(err)}" if err is not None else None
+            if self._state == "closed" and self.failures < self.failure_threshold: return
+            opening = self._state == "closed"
+            self._state = "open"
+            self._opened_at = time.monotonic()
+            if opening: self.opened += 1
+            start_probe = self.probe is not None and (self._thread is None or not self._thread.is_alive())
+            if start_probe:
+                self._thread = threading.Thread(target=self._probe, daemon=True, name=f"{self.name} probe")
+        if opening:
+            rpie.SendingError(f"at time {time.time()} {self.name} failed {self.failures} times in a row, writes fail fast "
+                              f"until it answers again, last error: {self.last_error}")
+        if start_probe: self._thread.start()
+
+    def _probe(self):
+        """ the background check, runs while the breaker is open """
+        while True:
+            time.sleep(self.reset_timeout*random.uniform(0.8, 1.2))
+            with self._lock:
+                if self._state != "open": return
+                self.probes += 1
+            try:
+                up = self.probe()
+            except Exception:
+                up = False
+            if up is not False and up is not None:
+                self.success()
+                return
+
+    def _closed_log(self):
+        rpie.SilentError(f"{self.name} answers again after {time.monotonic()-self._opened_at:.0f} s")
+
+    def stats(self):
+        """ Returns: dict: {state, failures, opened, rejected, probes, last_error} """
+        state = self.state()
+        with self._lock:
+            return {"state": "half_open" if state == "testing" else state, "failures": self.failures,
+                    "opened": self.opened, "rejected": self.rejected, "probes": self.probes, "last_error": self.last_error}
+
+
+class resilient:
+    """
+        ## Purpose and use:
+            Runs the writes of one backend through a retry policy and a circuit breaker:
+
+                self.guard = resilient("InfluxDB cloud", probe=self.client.ping)
+                self.guard.call(self.write_api.write, bucket=..., record=points)
+
+            A transient error is retried after `retry_policy.delay`, unless the breaker
+            opened meanwhile; every failed try counts towards opening it. Errors that
+            aren't transient (a 400 for a bad point) are raised at once and don't count,
+            the server did answer. While the breaker is open `call` raises circuit_open
+            without calling anything.
+
+            The retries wait, so they are for writes off the loop thread: on the loop
+            tools.make_uploader sets retries 0 and failure_threshold 1, the first failed
+            write opens the breaker and the spool replay sends the points later.
+        ### Methods:
+            - `call`: runs a write
+            - `stats`: breaker state, retry and call counters
+    """
+    def __init__(self, name:str = "database", retries:int = 2, base_delay:float = 0.2, max_delay:float = 2,
+                 failure_threshold:int = 3, reset_timeout:float = 30, probe = None, sleep = time.sleep):
+        """
+        ### Arguments:
+            name: str = the backend, for the error log
+            retries, base_delay, max_delay: see retry_policy
+            failure_threshold, reset_timeout, probe: see circuit_breaker
+            sleep: function = takes seconds, replaced in benchmarks
+        """
+        self.policy = retry_policy(retries, base_delay, max_delay)
+        self.breaker = circuit_breaker(name, failure_threshold, reset_timeout, probe)
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        # the breaker counts the failures in a row and the rejected writes
+        self.counts = {"calls": 0, "successes": 0, "failed_calls": 0, "retries": 0}
+
+    def _count(self, key:str):
+        with self._lock:
+            self.counts[key] += 1
+
+    def call(self, function, *args, **kwargs):
+        """
+        Returns: what `function` returns
+        Raises:
+            circuit_open: the breaker is open, `function` wasn't called
+            the error of the last try otherwise
+        """
+        self._count("calls")
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise circuit_open(f"{self.breaker.name} is down, not tried (last error: {self.breaker.last_error})")
+            try:
+                result = function(*args, **kwargs)
+            except Exception as err:
+                if not is_transient(err):
+                    self.breaker.success()
+                    self._count("failed_calls")
+                    raise
+                self.breaker.failure(err)
+                if attempt >= self.policy.retries or self.breaker.state() != "closed":
+                    self._count("failed_calls")
+                    raise
+                self._count("retries")
+                self.sleep(self.policy.delay(attempt))
+                attempt += 1
+                continue
+            self.breaker.success()
+            self._count("successes")
+            return result
+
+    def stats(self):
+        """ Returns: dict: the breaker stats and the call counters """
+        with self._lock:
+            counts = dict(self.counts)
+        return {**self.breaker.stats(), **counts}
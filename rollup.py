@@ -0,0 +1,142 @@
+"""
+On-device rollups: turns the 3 second samples into 1 minute, 15 minute, ... summaries
+before they are uploaded, so the dashboards (and the cloud bill) don't need every point.
+
+classes:
+    - rollup_stage: wraps an uploader, sends window summaries and optionally thins the raw points
+"""
+
+import time, socket
+
+
+def window_label(seconds:int):
+    """ 60 -> "1m", 900 -> "15m", 3600 -> "1h", 45 -> "45s" """
+    if seconds % 3600 == 0: return f"{seconds//3600}h"
+    if seconds % 60 == 0: return f"{seconds//60}m"
+    return f"{seconds}s"
+
+
+class rollup_stage:
+    """
+        ## Purpose and use:
+            Takes the same calls as the uploader it wraps (it can also wrap an upload_worker).
+            Every value passed through is added to one accumulator per rollup window. When a
+            window ends (windows line up with the clock, ie every full minute) its summary is
+            sent with `generic` to its own measurement, named after the original:
+
+                "Electricity Gen" -> "Electricity Gen_1m", "Electricity Gen_15m"
+                fields: voltage_mean, voltage_min, voltage_max, voltage_last, ...
+
+            local_performance and net_usage are rolled up into "local_performance_<window>"
+            and "network_<window>", tagged by Machine.
+
+            Raw points are still sent, unless thinned with `raw_every`:
+                {measurement: n} sends one raw call out of every n, 0 stops the raw points.
+            At `stop` the windows still open are sent as they are (a shorter window, but
+            the values of the last minutes before a restart aren't lost).
+        ### Methods:
+            - `local_performance`, `net_usage`, `generic`: same as the uploader
+            - `raw_series`, `flush`: passed to the uploader
+            - `stop`: sends the open windows, then passed to the uploader
+    """
+    def __init__(self, uploader, windows:[int,...] = (60, 900), raw_every:dict = None):
+        """
+        ### Arguments:
+            uploader: the uploader (or upload_worker) the rollups and raw points are sent to
+            windows: list = rollup window lengths in seconds
+            raw_every: dict = {measurement name: n}, see above. Measurements not listed are all sent.
+        """
+        self.uploader = uploader
+        self.windows = sorted(set(int(window) for window in windows if int(window) > 0))
+        self.raw_every = raw_every or {}
+        self._calls = {}
+        # (window, measurement, tag type) -> [window number, {tag: {field: [sum, count, min, max, last]}}]
+        self._windows = {}
+
+    def local_performance(self, machine_name:str=None, cpu_usage:float=None, ram_usage:float=None, timestamp:int=None):
+        machine_name = machine_name or self._hostname()
+        self._add("local_performance", "Machine", {machine_name: {"cpu": cpu_usage, "ram": ram_usage}}, timestamp)
+        if self._keep_raw("local_performance"):
+            self.uploader.local_performance(machine_name=machine_name, cpu_usage=cpu_usage, ram_usage=ram_usage, timestamp=timestamp)
+
+    def net_usage(self, machine_name:str=None, net_in:float=None, net_out:float=None, timestamp:int=None):
+        machine_name = machine_name or self._hostname()
+        self._add("network", "Machine", {machine_name: {"net_in": net_in, "net_out": net_out}}, timestamp)
+        if self._keep_raw("network"):
+            self.uploader.net_usage(machine_name=machine_name, net_in=net_in, net_out=net_out, timestamp=timestamp)
+
+    def generic(self, data, point_name:str ="m1", tag_type:str = "tag1", timestamp:int=None):
+        if data is not None: self._add(point_name, tag_type, data, timestamp)
+        if self._keep_raw(point_name):
+            self.uploader.generic(data=data, point_name=point_name, tag_type=tag_type, timestamp=timestamp)
+
+    def raw_series(self, *args, **kwargs):
+        self.uploader.raw_series(*args, **kwargs)
+
+    def flush(self, *args, **kwargs):
+        if hasattr(self.uploader, "flush"): self.uploader.flush(*args, **kwargs)
+
+    def stop(self, *args, **kwargs):
+        windows, self._windows = self._windows, {}
+        for key, (_, values) in windows.items():
+            self._emit(key, values)
+        if hasattr(self.uploader, "flush"): self.uploader.flush(force=True)
+        if hasattr(self.uploader, "stop"): self.uploader.stop(*args, **kwargs)
+
+    def _hostname(self):
+        try:
+            return socket.gethostname()
+        except Exception:
+            return "Machine Undetected"
+
+    def _keep_raw(self, measurement:str):
+        every = self.raw_every.get(measurement, 1)
+        if every <= 0: return False
+        count = self._calls[measurement] = self._calls.get(measurement, 0) + 1
+        return count % every == 1 % every
+
+    def _add(self, measurement:str, tag_type:str, data:dict, timestamp:int = None):
+        """ the windows follow the time the values were measured at (ns), now if not given """
+        now = time.time() if timestamp is None else timestamp/1e9
+        for window in self.windows:
+            key = (window, measurement, tag_type)
+            number = int(now // window)
+            current = self._windows.get(key)
+            if current is not None and current[0] != number:
+                self._emit(key, current[1], timestamp)
+                current = None
+            if current is None:
+                current = self._windows[key] = [number, {}]
+
+            for tag, fields in data.items():
+                tag_values = current[1].setdefault(tag, {})
+                for field, value in fields.items():
+                    try:
+                        value = float(value)
+                    except (TypeError, ValueError):
+                        continue
+                    if value != value: continue # NaN
+                    acc = tag_values.get(field)
+                    if acc is None:
+                        tag_values[field] = [value, 1, value, value, value]
+                    else:
+                        acc[0] += value
+                        acc[1] += 1
+                        if value < acc[2]: acc[2] = value
+                        if value > acc[3]: acc[3] = value
+                        acc[4] = value
+
+    def _emit(self, key, values:dict, timestamp:int = None):
+        """ sends the summary of a window, stamped with the time of the value that closed it """
+        window, measurement, tag_type = key
+        data = {}
+        for tag, fields in values.items():
+            summary = {}
+            for field, (total, count, low, high, last) in fields.items():
+                summary[f"{field}_mean"] = total/count
+                summary[f"{field}_min"] = low
+                summary[f"{field}_max"] = high
+                summary[f"{field}_last"] = last
+            if summary: data[tag] = summary
+        if data:
+            self.uploader.generic(data=data, point_name=f"{measurement}_{window_label(window)}", tag_type=tag_type, timestamp=timestamp)
@@ -31,23 +31,98 @@ try:
     import RPi.GPIO as GPIO
 except RuntimeError as err:
     print(f"No GPIO pins available on WSL: \n {err} \n From now on the code will print 'blink' ")
-import time, os
+import time, os, re
+import threading, atexit
+from metrics import timers
 
 path = os.getcwd()
 
+def _set_led(state:bool=True):
+    """ the actual GPIO write, only the led_controller thread should call this """
+    try:
+        if state: GPIO.output(18,GPIO.HIGH)
+        else: GPIO.output(18,GPIO.LOW)    
+    except NameError as err:
+        print("blink")     
+
+class led_controller:
+    """
+    ## Drives the LED from a background thread
+    
+    Blinking used to sleep in whatever code raised the error, a MeasuringError stopped 
+    the loop for 18 seconds. Now patterns are handed to a thread and the caller 
+    returns straight away.
+    
+    A pattern is a list of (state, seconds) steps. Every priority level holds at most 
+    one waiting pattern, so a new pattern replaces the waiting one of the same priority
+    instead of queueing behind it: an error repeated every loop blinks once, not for minutes.
+    Higher priorities go first and cut a lower priority pattern short.
+    """
+    def __init__(self, set_led=_set_led):
+        self.set_led = set_led
+        self._waiting = {} # priority -> pattern
+        self._playing = None # priority of the pattern being shown
+        self._lock = threading.Condition()
+        self._thread = None
+    
+    def show(self, pattern:[(bool, float),...], priority:int=0):
+        with self._lock:
+            self._waiting[priority] = list(pattern)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="led_controller", daemon=True)
+                self._thread.start()
+            self._lock.notify_all()
+    
+    def drain(self, timeout:float=40, priority:int=0):
+        """ waits (up to timeout seconds) for the patterns of at least `priority` to be shown """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while time.monotonic() < deadline:
+                busy = [p for p in self._waiting if p >= priority]
+                if self._playing is not None and self._playing >= priority: busy.append(self._playing)
+                if not busy: return
+                self._lock.wait(timeout=deadline-time.monotonic())
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._waiting:
+                    self._lock.wait()
+                priority = max(self._waiting)
+                pattern = self._waiting.pop(priority)
+                self._playing = priority
+            
+            for state, seconds in pattern:
+                self.set_led(state)
+                with self._lock:
+                    # sleep, unless something more important comes in
+                    end = time.monotonic() + seconds
+                    while time.monotonic() < end and not any(p > priority for p in self._waiting):
+                        self._lock.wait(timeout=end-time.monotonic())
+                    if any(p > priority for p in self._waiting): break
+            
+            with self._lock:
+                self._playing = None
+                self._lock.notify_all()
+
+led = led_controller()
+# a CriticalError stops the code, let its blinks finish before the process exits
+atexit.register(led.drain, 40, 4)
+
 def turn_led(state:bool=True):
     """Turn led on pin 18 on
 
     Connect a 1k ressitor in series with an LED on pin 18, the other end to GND
-    This will blink that LED
+    This will blink that LED. Returns straight away, the led_controller sets it.
     Args:
         state (bool, optional): _description_. Defaults to True.
     """
-    try:
-        if state: GPIO.output(18,GPIO.HIGH)
-        else: GPIO.output(18,GPIO.LOW)    
-    except NameError as err:
-        print("blink")     
+    led.show([(state, 0)], priority=0)
+
+@timers.timed("led")
+def heartbeat():
+    """ the short-short-long pattern shown every loop when everything works """
+    led.show([(True, 0.1), (False, 0.1), (True, 0.2), (False, 0)], priority=0)
 def turn_board_led(state:bool=True):
     """Use the LED files from sys/class/leds to control the onboard led
 
@@ -62,26 +137,124 @@ def turn_board_led(state:bool=True):
     if state: os.system('echo 1 | sudo tee /sys/class/leds/led0/brightness > /dev/null 2>&1') # led on
     else: os.system('echo 0 | sudo tee /sys/class/leds/led0/brightness > /dev/null 2>&1') # led off
 
+@timers.timed("led")
 def Blink(number:int=None):
-    if number is None: pass
+    """ 
+    Blinks `number` times, each blink `number` seconds off and on (1 is a quick blink).
+    Returns straight away, the more blinks the higher the priority.
+    """
+    if number is None: return
     
     if number== 1:
-        turn_led(False)
-        time.sleep(0.1)
-        turn_led(True)
-        time.sleep(0.1)
-        turn_led(False)
+        pattern = [(False, 0.1), (True, 0.1), (False, 0)]
     else: 
-        for i in range(number):
-            turn_led(False)
-            time.sleep(number)
-            turn_led(True)
-            time.sleep(number)
-            turn_led(False)    
+        pattern = [(False, number), (True, number)]*number + [(False, 0)]
+    led.show(pattern, priority=number)
+def _stamp(date=None):
+    """ the time format used in errorfile.txt """
+    date = date or time.localtime()
+    return f"{date.tm_year}/{date.tm_mon}/{date.tm_mday}/{date.tm_hour}:{date.tm_min}:{date.tm_sec}"
+
+# epoch times in seconds or nanoseconds (10 digits or more), the rest of a message is compared as it is
+_timestamps = re.compile(r"\d{10,}(\.\d+)?")
+
+def _repeat_key(message):
+    """ the message without its timestamps, two errors of the same kind from the same place give the same key """
+    return _timestamps.sub("<time>", str(message))
+
+class log_writer:
+    """
+    ## Writes errorfile.txt from a background thread
+    
+    Record() used to open, write and close the file on every error, in the middle of
+    the loop. During an outage the same message came every 3 seconds and wore the SD card.
+    
+    Now messages go on a queue and a thread writes them in one go every `flush_interval`
+    seconds (or when `buffer_size` are waiting). On top of that:
+        - a message equal to the previous one isn't written again, it's counted and 
+          "last message repeated N times" is written when a different one comes in (or at
+          the next write to the file). Most messages start with `at time {time.time()}`, so
+          they are compared without their timestamps (`_repeat_key`)
+        - at most `max_per_minute` lines a minute, the rest are counted as dropped
+        - when the file passes `max_size` bytes it's moved to errorfile_old.txt and a new 
+          one is started (the old old file is deleted), so the logs never take more than 2x max_size
+    """
+    def __init__(self, filename:str, max_size:int=int(1e8), flush_interval:float=5, 
+                 buffer_size:int=100, max_per_minute:int=120):
+        self.filename = filename
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.max_per_minute = max_per_minute
+        
+        self._lines = []
+        self._last = None
+        self._repeated = 0
+        self._minute = None
+        self._in_minute = 0
+        self._dropped = 0
+        self._lock = threading.Condition()
+        self._thread = None
+    
+    def write(self, message:str):
+        now = time.localtime()
+        key = _repeat_key(message)
+        with self._lock:
+            if key == self._last:
+                self._repeated += 1
+                return
+            self._close_repeat(now)
+            self._last = key
+            
+            minute = int(time.monotonic()//60)
+            if minute != self._minute:
+                if self._dropped: 
+                    self._lines.append(f"{_stamp(now)}| {self._dropped} messages were dropped, more than {self.max_per_minute} a minute \n")
+                self._minute, self._in_minute, self._dropped = minute, 0, 0
+            if self._in_minute >= self.max_per_minute:
+                self._dropped += 1
+                return
+            self._in_minute += 1
+            self._lines.append(f"{_stamp(now)}| {message} \n")
+            
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log_writer", daemon=True)
+                self._thread.start()
+            if len(self._lines) >= self.buffer_size: self._lock.notify_all()
+    
+    def _close_repeat(self, now):
+        if self._repeated:
+            self._lines.append(f"{_stamp(now)}| last message repeated {self._repeated} times \n")
+            self._repeated = 0
+    
+    def flush(self):
+        """ writes everything waiting, called by the thread and before exiting """
+        with self._lock:
+            self._close_repeat(time.localtime())
+            if not self._lines: return
+            lines, self._lines = self._lines, []
+        text = "".join(lines)
+        try:
+            if os.path.isfile(self.filename) and os.path.getsize(self.filename) + len(text) > self.max_size:
+                os.replace(self.filename, f"{os.path.dirname(self.filename)}/errorfile_old.txt")
+            with open(file=self.filename, mode="a+") as errorlog:
+                errorlog.write(text)
+        except Exception as err:
+            print(f"errorfile.txt could not be written: {err} \n{text}")
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                self._lock.wait(timeout=self.flush_interval)
+            self.flush()
+
+log = log_writer(f"{path}/errorfile.txt")
+atexit.register(log.flush)
+
+@timers.timed("error_log")
 def Record(message:str="Generic Error"):
-    with open(file=f"{path}/errorfile.txt",mode="a+") as errorlog:
-        date= time.localtime()
-        errorlog.write(f"{date.tm_year}/{date.tm_mon}/{date.tm_mday}/{date.tm_hour}:{date.tm_min}:{date.tm_sec}| {message} \n")
+    """ adds a line to errorfile.txt, returns straight away (see log_writer) """
+    log.write(message)
         
 class CriticalError(Exception):
     def __init__(self, msg:str=None) -> None:
@@ -110,8 +283,8 @@ class SilentError(Exception):
 class ShortError(Exception):
     def __init__(self, msg:str=None) -> None:
         """
-        Stops the code for a short moment to blink the onboard
-        led (a fraction of a second) and log the error code.
+        Blinks the led once (a fraction of a second, in the 
+        background) and logs the error code.
         
         Usecase: specific bugs that don't impede critcal code
         but can still limit functionality and should be sorted. 
@@ -122,7 +295,7 @@ class ShortError(Exception):
 class SendingError(Exception):
     def __init__(self, msg:str=None) -> None:
         """
-        Stops the code for a bit, blinks twice and saves the error
+        Blinks twice (in the background) and saves the error
         
         Usecase: when the upload function fails to send a measurement
         """
@@ -132,7 +305,7 @@ class SendingError(Exception):
 class MeasuringError(Exception):
     def __init__(self, msg:str=None) -> None:
         """
-        Stops the code for a bit, blinks 3 times and saves the 
+        Blinks 3 times (in the background) and saves the 
         error
         
         Usecase: when the INA219 doesn't measure any volatage or
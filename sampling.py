@@ -0,0 +1,264 @@
+"""
+Sampling engine shared by the measuring classes in tools.py.
+
+Readings go straight into one preallocated NumPy array and every statistic is
+worked out in a single vectorised pass at the end of the window.
+
+classes:
+    - sample_engine: takes `rounds` readings of every sensor and returns mean/min/max/std
+    - ring_buffer: fixed size, array backed history of timestamped readings
+    - continuous_sampler: thread that reads the sensors at a fixed rate into a ring_buffer
+"""
+
+import time, warnings, threading
+import numpy as np
+import rpi_errors as rpie
+
+# what read_sensor() returns for every INA219, in this order
+channels = ("voltage", "power", "bus_voltage")
+# decimals kept for each channel in the dict output, same as the old read_ina219
+decimals = {"voltage": 4, "power": 3, "bus_voltage": 3}
+
+
+class sample_engine:
+    """
+        ## Purpose and use:
+            Holds a (rounds, sensors, channels) array that is filled once per measure() call.
+            Failed readings are stored as NaN and left out of the statistics, so one bad
+            I2C read doesn't ruin the whole window.
+
+            The dict returned by `as_dict` has the same shape read_data.measure() always had:
+                {sensor name: {voltage, power, bus_voltage}, bus_average: {voltage, power}}
+            but the values are real means (the old loop returned 10x sums). A channel with
+            no good reading in the window is left out (and a sensor with none at all), so
+            no NaN reaches the uploaders.
+        ### Methods:
+            - `sample`: reads every sensor `rounds` times
+            - `stats`: mean, min, max and std per sensor and channel
+            - `load`: use readings taken somewhere else (ie a ring_buffer window) instead of `sample`
+            - `as_dict`: one of the statistics in the old dict shape
+    """
+    def __init__(self, sensor_names:[str,...], rounds:int = 10, average_of:[str,...] = ("blue_house","red_house","green_house")):
+        """
+        ### Arguments:
+            sensor_names: list = names of the sensors, in the order they are read
+            rounds: int = readings of every sensor per window
+            average_of: list = sensors whose bus voltage makes up `bus_average`
+        """
+        self.sensor_names = list(sensor_names)
+        self.rounds = max(1, int(rounds))
+        self.average_of = [self.sensor_names.index(name) for name in average_of if name in self.sensor_names]
+        self.samples = np.full((self.rounds, len(self.sensor_names), len(channels)), np.nan)
+        self.filled = 0
+        self._stats = None
+
+    def sample(self, read, sensors:list, delay:float = 0.05):
+        """
+        ## Fills the array
+
+        Args:
+            read (function): takes one sensor and returns (voltage, power, bus_voltage),
+                             NaN for values that couldn't be read
+            sensors (list): the sensor objects, in the same order as `sensor_names`
+            delay (float): seconds from the start of one round to the start of the next.
+                           The time spent reading counts towards it, so with many sensors 
+                           the rounds run back to back instead of reading + delay each.
+        Returns:
+            dict: the statistics, see `stats`
+        """
+        if self.samples.shape[0] != self.rounds:
+            self.samples = np.full((self.rounds, len(self.sensor_names), len(channels)), np.nan)
+        self.samples.fill(np.nan)
+        start = time.monotonic()
+        for r in range(self.rounds):
+            if r: time.sleep(max(0, start + r*delay - time.monotonic()))
+            # one round of every sensor, written to the array in one go
+            self.samples[r] = [read(sensor) for sensor in sensors]
+        self.filled = self.rounds
+        self._stats = None
+        return self.stats()
+
+    def load(self, window):
+        """
+        Args:
+            window (np.ndarray): readings shaped (n, sensors, channels), n can be anything
+        """
+        self.samples = window
+        self.filled = len(window)
+        self._stats = None
+        return self.stats()
+
+    def stats(self):
+        """
+        Returns:
+            dict: {mean, min, max, std} each an array shaped (sensors, channels)
+        """
+        if self._stats is None:
+            window = self.samples[:max(1, self.filled)]
+            # NaN only when every reading in the window failed, no need for the warning
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                self._stats = {
+                    "mean": np.nanmean(window, axis=0),
+                    "min": np.nanmin(window, axis=0),
+                    "max": np.nanmax(window, axis=0),
+                    "std": np.nanstd(window, axis=0)
+                }
+        return self._stats
+
+    def as_dict(self, statistic:str = "mean"):
+        """
+        Args:
+            statistic (str): mean, min, max or std
+        Returns:
+            dict: { house/blue/green/red/bus: {voltage, power, bus_voltage}, bus_average: {voltage: float, power: float}}
+                  only the finite values, a sensor (or bus_average) without any is left out
+        """
+        values = self.stats()[statistic]
+        finite = np.isfinite(values)
+        data = {}
+        for s, name in enumerate(self.sensor_names):
+            fields = {channel: float(round(values[s, c], decimals[channel])) for c, channel in enumerate(channels) if finite[s, c]}
+            if fields: data[name] = fields
+
+        # average bus voltage of the houses, always from the means, of the houses that have one
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            bus_voltage = float(np.nanmean(self.stats()["mean"][self.average_of, channels.index("bus_voltage")])) if self.average_of else float("nan")
+        if np.isfinite(bus_voltage):
+            data["bus_average"] = {
+                "voltage": float(round(bus_voltage,3)),
+                "power": float(round(0.1*(bus_voltage**2),3))
+            }
+        return data
+
+
+class ring_buffer:
+    """
+        ## Purpose and use:
+            Keeps the last `capacity` readings in two preallocated arrays, one for the
+            timestamps (ns) and one for the values (capacity, sensors, channels).
+            Old readings are overwritten, memory use never grows.
+        ### Methods:
+            - `append`: adds one round of readings
+            - `since`: readings taken after a time, oldest first
+    """
+    def __init__(self, capacity:int, sensors:int, n_channels:int = len(channels)):
+        self.capacity = max(1, int(capacity))
+        self.times = np.zeros(self.capacity, dtype=np.int64)
+        self.values = np.full((self.capacity, sensors, n_channels), np.nan)
+        self.written = 0
+        self._lock = threading.Lock()
+
+    def append(self, time_ns:int, row):
+        with self._lock:
+            slot = self.written % self.capacity
+            self.times[slot] = time_ns
+            self.values[slot] = row
+            self.written += 1
+
+    def since(self, start_ns:int = 0):
+        """
+        Returns:
+            (np.ndarray, np.ndarray): copies of the times and values newer than `start_ns`, oldest first
+        """
+        with self._lock:
+            count = min(self.written, self.capacity)
+            start = self.written - count
+            order = np.arange(start, self.written) % self.capacity
+            times = self.times[order]
+            keep = times > start_ns
+            return times[keep], self.values[order[keep]]
+
+
+class continuous_sampler:
+    """
+        ## Purpose and use:
+            Reads the sensors of a read_data (or read_fake_data) object from its own thread,
+            at `rate` rounds per second, into a ring_buffer. Sampling no longer depends on
+            how long the main loop takes: `measure` returns the statistics of everything
+            read since the previous call, and `raw` the readings themselves.
+
+            It takes the same calls as the model it wraps, so main.py can use it in its place.
+        ### Methods:
+            - `measure`, `measure_stats`: same as read_data, over the readings since the last call
+            - `raw`: timestamps and readings since the last `raw` call
+            - `measure_cpu`, `measure_network`, `get_name`: passed to the model
+            - `stop`: stops the thread
+    """
+    def __init__(self, model, rate:float = 20, buffer_seconds:float = 60):
+        """
+        ### Arguments:
+            model: read_data or read_fake_data object
+            rate: float = sensor rounds per second
+            buffer_seconds: float = how much history the ring buffer holds
+        """
+        self.model = model
+        self.period = 1/max(0.1, float(rate))
+        names = model.engine.sensor_names
+        self.engine = sample_engine(names, average_of=[names[s] for s in model.engine.average_of])
+        self.buffer = ring_buffer(int(buffer_seconds/self.period)+1, len(model.ina_list))
+        self.missed = 0
+        self._last_measure = time.time_ns()
+        self._last_raw = self._last_measure
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="continuous_sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        deadline = time.monotonic()
+        while self._running:
+            try:
+                row = [self.model.read_sensor(sensor) for sensor in self.model.ina_list]
+                self.buffer.append(time.time_ns(), row)
+            except Exception as err:
+                rpie.SilentError(f"continuous sampler could not read the sensors, error: {err}")
+
+            # fixed rate, if a round ran late the missed rounds are skipped, not made up
+            deadline += self.period
+            late = time.monotonic() - deadline
+            if late > 0:
+                skipped = int(late/self.period) + 1
+                self.missed += skipped
+                deadline += skipped*self.period
+            time.sleep(max(0, deadline - time.monotonic()))
+
+    def measure(self):
+        """
+        Returns:
+            dict: same as read_data.measure(), averaged over the readings since the last call
+        """
+        times, window = self.buffer.since(self._last_measure)
+        if len(times): self._last_measure = int(times[-1])
+        self.engine.load(window)
+        return self.engine.as_dict()
+
+    def measure_stats(self):
+        """ statistics of the window used by the last measure() call """
+        return {statistic: self.engine.as_dict(statistic) for statistic in ("mean","min","max","std")}
+
+    def raw(self):
+        """
+        Returns:
+            (np.ndarray, dict): timestamps in ns and {sensor name: {channel: np.ndarray}},
+                                for the readings since the last call
+        """
+        times, window = self.buffer.since(self._last_raw)
+        if len(times): self._last_raw = int(times[-1])
+        data = {}
+        for s, name in enumerate(self.engine.sensor_names):
+            data[name] = {channel: window[:, s, c] for c, channel in enumerate(channels)}
+        return times, data
+
+    def measure_cpu(self):
+        return self.model.measure_cpu()
+
+    def measure_network(self):
+        return self.model.measure_network()
+
+    def get_name(self):
+        return self.model.get_name()
+
+    def stop(self):
+        self._running = False
+        self._thread.join(timeout=2*self.period+1)
@@ -0,0 +1,124 @@
+"""
+Fixed rate scheduling on the monotonic clock.
+
+The main loop used to sleep "3 seconds minus however long the loop took" on the
+wall clock, so every slow loop pushed all the following ones back and an NTP
+correction could make a loop sleep for far too long (or not at all).
+
+classes:
+    - tick_scheduler: wakes up on absolute deadlines, `period` seconds apart
+"""
+
+import time, math
+
+
+class tick_scheduler:
+    """
+        ## Purpose and use:
+            Keeps a list of deadlines start, start+period, start+2*period, ... on
+            time.monotonic_ns(), which never jumps. `wait` sleeps until the next deadline.
+            When a tick ran so long that one or more deadlines already passed, those
+            ticks are skipped (and counted in `missed`) instead of being run back to back,
+            so the loop gets back on its grid straight away.
+
+            Lateness is how long after its deadline a tick really started, jitter is the
+            standard deviation of the lateness.
+
+            Works for any periodic job, not only the main loop:
+
+                schedule = tick_scheduler(period=60)
+                while True:
+                    schedule.wait()
+                    job()
+
+            or without blocking, from inside another loop:
+
+                if schedule.due(): job()
+        ### Methods:
+            - `wait`: sleeps until the next tick
+            - `due`: True (once) when a tick is due, never sleeps
+            - `stats`: tick count, missed ticks, lateness and jitter
+    """
+    def __init__(self, period:float = 3, clock = time.monotonic_ns, sleep = time.sleep):
+        """
+        ### Arguments:
+            period: float = seconds between two ticks
+            clock: function = returns nanoseconds, monotonic
+            sleep: function = takes seconds
+        """
+        self.period = int(float(period)*1e9)
+        self.clock = clock
+        self.sleep = sleep
+        self.deadline = None
+
+        self.ticks = 0
+        self.missed = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        # running mean and variance of the lateness (Welford)
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def _next(self, now:int):
+        """ moves the deadline to the next tick, skipping the ones already missed """
+        self.deadline += self.period
+        if now >= self.deadline + self.period:
+            skipped = (now - self.deadline) // self.period
+            self.missed += skipped
+            self.deadline += skipped*self.period
+
+    def _record(self, now:int, deadline:int):
+        lateness = max(0, now - deadline)*1e-9
+        self.ticks += 1
+        self.last_lateness = lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        delta = lateness - self._mean
+        self._mean += delta/self.ticks
+        self._m2 += delta*(lateness - self._mean)
+
+    def wait(self):
+        """
+        Sleeps until the next deadline. The first call returns straight away and starts the grid.
+
+        Returns:
+            int: the monotonic time (ns) the tick started at
+        """
+        now = self.clock()
+        if self.deadline is None:
+            self.deadline = now
+        else:
+            self._next(now)
+            if self.deadline > now:
+                self.sleep((self.deadline - now)*1e-9)
+                now = self.clock()
+        self._record(now, self.deadline)
+        return now
+
+    def due(self):
+        """
+        Returns:
+            bool: True if a deadline passed since the last tick, then the next deadline is set
+        """
+        now = self.clock()
+        if self.deadline is None:
+            self.deadline = now
+        elif now < self.deadline + self.period:
+            return False
+        else:
+            self._next(now)
+        self._record(now, self.deadline)
+        return True
+
+    def stats(self):
+        """
+        Returns:
+            dict: {ticks, missed, lateness (last), mean_lateness, max_lateness, jitter}, times in seconds
+        """
+        return {
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "lateness": self.last_lateness,
+            "mean_lateness": self._mean,
+            "max_lateness": self.max_lateness,
+            "jitter": math.sqrt(self._m2/self.ticks) if self.ticks else 0.0
+        }
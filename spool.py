@@ -0,0 +1,202 @@
+"""
+An on-disk spool (write-ahead log) for points that could not be sent.
+
+When the network or the database is down the uploaders append the failed points
+here as line protocol, and replay them in chunks once writes work again.
+
+classes:
+    - spool: append-only segment files with a replay offset
+"""
+
+import os, time
+import rpi_errors as rpie
+from resilience import is_transient
+
+
+class spool:
+    """
+        ## Purpose and use:
+            Keeps undelivered points on disk so an outage doesn't lose data.
+
+            Points are appended to `segment_<number>.lp` files, one line protocol line
+            each. When the active segment passes `segment_size` bytes a new one is
+            started, so every file is written once, read once and then deleted. The
+            read position is saved in `replay.offset`, a replay interrupted by a
+            restart carries on where it stopped.
+
+            To go easy on the SD card, the whole spool is capped at `max_size` bytes;
+            past that the oldest segment is dropped (and logged).
+        ### Methods:
+            - `append`: saves a list of line protocol strings
+            - `replay`: sends the oldest `max_lines` lines with the function given
+            - `reject`: saves lines the database refused for good in `rejected.lp`
+            - `pending`: bytes waiting to be replayed
+    """
+    def __init__(self, directory:str, segment_size:int = 1_000_000, max_size:int = 100_000_000):
+        """
+        ### Arguments:
+            directory: str = folder for the segment files, created if missing
+            segment_size: int = bytes after which a segment is closed and a new one started
+            max_size: int = bytes after which the oldest segments are deleted
+        ### Raises:
+            rpie.CriticalError: if the folder can't be created
+        """
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except Exception as err:
+            raise rpie.CriticalError(f"spool folder {directory} could not be created, error: {err}")
+
+        self.directory = directory
+        self.segment_size = int(segment_size)
+        self.max_size = int(max_size)
+        self.offset_file = os.path.join(directory, "replay.offset")
+        self.rejected_file = os.path.join(directory, "rejected.lp")
+
+    def _segments(self):
+        """ segment numbers on disk, oldest first """
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment_") and name.endswith(".lp"):
+                try: numbers.append(int(name[8:-3]))
+                except ValueError: pass
+        return sorted(numbers)
+
+    def _path(self, number:int):
+        return os.path.join(self.directory, f"segment_{number:08d}.lp")
+
+    def _read_offset(self):
+        try:
+            with open(self.offset_file, "r") as file:
+                number, offset = file.read().split()
+            return int(number), int(offset)
+        except Exception:
+            return None, 0
+
+    def _write_offset(self, number:int, offset:int):
+        # write then rename, so a power cut never leaves half an offset file
+        with open(self.offset_file + ".tmp", "w") as file:
+            file.write(f"{number} {offset}")
+        os.replace(self.offset_file + ".tmp", self.offset_file)
+
+    def pending(self):
+        """ Returns: int = bytes not replayed yet """
+        total = 0
+        number, offset = self._read_offset()
+        for segment in self._segments():
+            total += os.path.getsize(self._path(segment))
+            if segment == number: total -= offset
+        return total
+
+    def append(self, lines:[str,...]):
+        """
+        Saves lines at the end of the active segment, starting a new segment when
+        the active one is full.
+
+        Args:
+            lines (list): line protocol strings, each one must have a timestamp
+        Raises:
+            SilentError: if the points couldn't be written to disk
+        """
+        if not lines: return
+        try:
+            segments = self._segments()
+            number = segments[-1] if segments else 0
+            if segments and os.path.getsize(self._path(number)) >= self.segment_size:
+                number += 1
+            with open(self._path(number), "a") as file:
+                file.write("\n".join(lines) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self._trim()
+        except Exception as err:
+            rpie.SilentError(f"{len(lines)} points could not be saved in the spool, error: {err}")
+
+    def _trim(self):
+        """ drops the oldest segments while the spool is larger than max_size """
+        segments = self._segments()
+        total = sum(os.path.getsize(self._path(segment)) for segment in segments)
+        while len(segments) > 1 and total > self.max_size:
+            oldest = segments.pop(0)
+            total -= os.path.getsize(self._path(oldest))
+            os.remove(self._path(oldest))
+            rpie.SilentError(f"spool is over {self.max_size} bytes, segment {oldest} was deleted without being sent")
+
+    def replay(self, send, max_lines:int = 5000):
+        """
+        ## Sends the oldest spooled lines
+
+        Reads up to `max_lines` lines from the oldest segment and passes them to
+        `send` as one list. The offset only moves forward when `send` doesn't raise,
+        so nothing is lost if the database goes down again mid replay. Lines the
+        database refuses for good (a 4xx, see resilience.is_transient) would be sent
+        again forever and hold back every segment behind them: they are moved to
+        `rejected.lp` instead and the offset moves on.
+        Call it once per loop, after the live data went through, so the backlog
+        never delays new measurements.
+
+        Args:
+            send (function): takes a list of line protocol strings and writes them
+            max_lines (int): the most lines sent in this call
+        Returns:
+            int: the number of lines sent (or rejected)
+        """
+        try:
+            segments = self._segments()
+            if not segments: return 0
+
+            number, offset = self._read_offset()
+            oldest = segments[0]
+            if number != oldest: offset = 0
+
+            # the active segment is closed first so appends can't land behind the offset
+            if len(segments) == 1:
+                if os.path.getsize(self._path(oldest)) <= offset:
+                    os.remove(self._path(oldest))
+                    return 0
+                self._rotate(oldest)
+
+            lines = []
+            with open(self._path(oldest), "r") as file:
+                file.seek(offset)
+                while len(lines) < max_lines:
+                    line = file.readline()
+                    if not line: break
+                    if line.strip(): lines.append(line.rstrip("\n"))
+                end = file.tell()
+                finished = not file.readline()
+        except OSError as err:
+            rpie.SilentError(f"the spool in {self.directory} could not be read, error: {err}")
+            return 0
+
+        if lines:
+            try:
+                send(lines)
+            except Exception as err:
+                # down or busy, the same lines are tried again next time
+                if is_transient(err): return 0
+                # refused for good (a bad line, a field type conflict), it would block everything behind it
+                self.reject(lines, err)
+
+        try:
+            if finished:
+                os.remove(self._path(oldest))
+                self._write_offset(oldest + 1, 0)
+            else:
+                self._write_offset(oldest, end)
+        except OSError as err:
+            rpie.SilentError(f"the spool offset in {self.directory} could not be saved, the last lines will be sent again, error: {err}")
+        return len(lines)
+
+    def reject(self, lines:[str,...], err:Exception):
+        """ moves lines the database refused to `rejected.lp`, with the error as a comment, so they can be fixed by hand """
+        rpie.SendingError(f"the database refused {len(lines)} points for good, they were moved to {self.rejected_file}, error: {err}")
+        try:
+            with open(self.rejected_file, "a") as file:
+                file.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')} {str(err).splitlines()[0] if str(err) else type(err)}\n")
+                file.write("\n".join(lines) + "\n")
+        except OSError as write_err:
+            rpie.SilentError(f"{len(lines)} refused points could not be saved in {self.rejected_file}, error: {write_err}")
+
+    def _rotate(self, number:int):
+        """ makes sure the next append goes to a new segment """
+        open(self._path(number + 1), "a").close()
@@ -0,0 +1,262 @@
+"""
+A file that contains the class needed to log to an embedded SQLite database, for sites
+that can't run an InfluxDB server on the Pi.
+
+Only uses the standard library (sqlite3).
+"""
+
+import sqlite3, socket, threading, time, os, atexit
+import rpi_errors as rpie
+from line_protocol import line_encoder
+
+
+class upload_data_sqlite:
+    """
+        ## Purpose and use:
+            Same calls as the other uploaders, the points go to one SQLite file:
+
+                series(id, measurement, tag_key, tag_value, field, is_int)  one row per series
+                points(series, time, value)  primary key (series, time), WITHOUT ROWID
+
+            so a point is 3 numbers on disk and a range query on one series is one index scan.
+            The measurements, tags and fields are the ones upload_data_influxdb_cloud writes,
+            with the same types: values are stored as REAL, but a series that was given ints
+            (ie RAM) is flagged `is_int` and read and exported as ints (`RAM=412345678i`), or
+            InfluxDB would refuse the backfill for a field type conflict.
+
+            The database runs in WAL mode with synchronous=NORMAL, and points are held in
+            memory and written `batch_size` at a time (or every `flush_interval` seconds) in
+            one transaction, so the SD card sees a few large writes instead of one per point.
+            Points older than `retention_days` are deleted once an hour.
+        ### Methods:
+            - `local_performance`, `net_usage`, `generic`, `raw_series`: same as the other uploaders
+            - `flush`: writes the points held back (main.py calls it every loop)
+            - `query`: points of a measurement between two times
+            - `export_lines`, `export`: points as line protocol, ie to backfill InfluxDB later
+            - `stop`: writes what is left and closes the database
+    """
+    def __init__(self, filename:str = None, batch_size:int = 500, flush_interval:float = 30,
+                 retention_days:float = 0):
+        """
+        ### Arguments:
+            filename: str = the database file, created if missing
+            batch_size: int = points per transaction
+            flush_interval: float = most seconds a point waits in memory
+            retention_days: float = points older than this are deleted, 0 keeps everything
+        ### Raises:
+            rpie.CriticalError: when the database can't be opened
+        """
+        if filename is None: raise rpie.CriticalError(f"{filename} is not a valid database file")
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            # the upload worker writes from its own thread, the lock keeps the calls apart
+            self.db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS series (
+                    id INTEGER PRIMARY KEY,
+                    measurement TEXT NOT NULL, tag_key TEXT NOT NULL, tag_value TEXT NOT NULL, field TEXT NOT NULL,
+                    is_int INTEGER NOT NULL DEFAULT 0,
+                    UNIQUE (measurement, tag_key, tag_value, field));
+                CREATE TABLE IF NOT EXISTS points (
+                    series INTEGER NOT NULL, time INTEGER NOT NULL, value REAL,
+                    PRIMARY KEY (series, time)) WITHOUT ROWID;
+            """)
+            # files made before the field types were kept
+            if "is_int" not in [row[1] for row in self.db.execute("PRAGMA table_info(series)")]:
+                self.db.execute("ALTER TABLE series ADD COLUMN is_int INTEGER NOT NULL DEFAULT 0")
+        except Exception as err:
+            raise rpie.CriticalError(f"the sqlite database {filename} could not be opened, error:\n {err}, {type(err)}")
+
+        self.filename = filename
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.retention_days = float(retention_days)
+        self._lock = threading.RLock()
+        self._series = {}
+        self._integers = set() # ids of the series written with ints
+        for series, *key, is_int in self.db.execute("SELECT id, measurement, tag_key, tag_value, field, is_int FROM series"):
+            self._series[tuple(key)] = series
+            if is_int: self._integers.add(series)
+        self._pending = [] # (series id, time, value)
+        self._last_flush = time.monotonic()
+        self._last_cleanup = 0.0
+        self.encoder = line_encoder()
+        # the points still in memory when the code stops
+        atexit.register(self.flush, True)
+
+    def local_performance(self, machine_name:str=None, cpu_usage:float=None, ram_usage:float=None, timestamp:int=None):
+        if cpu_usage is None or ram_usage is None:
+            rpie.SilentError("either ram or cpu data was not supplied")
+        machine_name = machine_name or self._hostname()
+        now = time.time_ns() if timestamp is None else timestamp
+        self._add("cpu_usage", "Machine", machine_name, "CPU", cpu_usage, now, keep_type=True)
+        self._add("ram_usage", "Machine", machine_name, "RAM", ram_usage, now, keep_type=True)
+
+    def net_usage(self, machine_name:str=None, net_in:float=None, net_out:float=None, timestamp:int=None):
+        if net_in is None or net_out is None:
+            rpie.ShortError("Some net data was not supplied")
+        machine_name = machine_name or self._hostname()
+        now = time.time_ns() if timestamp is None else timestamp
+        self._add("network", "Machine", machine_name, "upload", net_in, now, keep_type=True)
+        self._add("network", "Machine", machine_name, "download", net_out, now, keep_type=True)
+
+    def generic(self, data, point_name:str ="m1", tag_type:str = "tag1", timestamp:int=None):
+        """
+        Args:
+            data (dict): {"tag 1": {"field name 1": field value 1}}, same as the other uploaders
+            point_name (str): Name of the measurement (ie, electric_data)
+            tag_type (str): Name of the tag type used (ie, house)
+        Raises:
+            CriticalError: when there is no data
+        """
+        if data is None:
+            raise rpie.CriticalError("No data was assigned to the function")
+        now = time.time_ns() if timestamp is None else timestamp
+        for _tag, tag_dict in data.items():
+            for value_name, value in tag_dict.items():
+                self._add(point_name, tag_type, _tag, value_name, value, now)
+
+    def raw_series(self, times, data, point_name:str ="m1", tag_type:str = "tag1"):
+        for _tag, fields in data.items():
+            for field, values in fields.items():
+                for timestamp, value in zip(times, values):
+                    self._add(point_name, tag_type, _tag, field, value, int(timestamp))
+
+    def _hostname(self):
+        try:
+            return socket.gethostname()
+        except Exception:
+            return "Machine Undetected"
+
+    def _series_id(self, key:tuple):
+        """ the id of a series, added to the series table the first time it's seen """
+        series = self._series.get(key)
+        if series is None:
+            self.db.execute("INSERT OR IGNORE INTO series (measurement, tag_key, tag_value, field) VALUES (?, ?, ?, ?)", key)
+            series = self._series[key] = self.db.execute(
+                "SELECT id FROM series WHERE measurement=? AND tag_key=? AND tag_value=? AND field=?", key).fetchone()[0]
+        return series
+
+    def _add(self, measurement:str, tag_key:str, tag_value:str, field:str, value, timestamp:int, keep_type:bool = False):
+        """ keep_type: an int stays an int, as local_performance and net_usage of the cloud uploader write them (generic and raw_series write floats) """
+        integer = keep_type and isinstance(value, int) and not isinstance(value, bool)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            rpie.SilentError(f"{measurement} {tag_value} {field}={value} is not a number, not logged")
+            return
+        if value != value: return # NaN
+        with self._lock:
+            try:
+                series = self._series_id((measurement, tag_key, str(tag_value), field))
+                if integer and series not in self._integers:
+                    self.db.execute("UPDATE series SET is_int=1 WHERE id=?", (series,))
+                    self._integers.add(series)
+            except Exception as err:
+                rpie.SendingError(f"series {measurement} {tag_value} {field} could not be added to {self.filename}, error: {err}")
+                return
+            self._pending.append((series, timestamp, value))
+            if len(self._pending) >= self.batch_size: self.flush(force=True)
+
+    def flush(self, force:bool=False):
+        """
+        Writes the points held back in one transaction, once `flush_interval` passed (or when forced)
+
+        Raises:
+            SendingError: when the transaction fails, the points are kept for the next flush
+        """
+        with self._lock:
+            if not self._pending: return
+            if not force and time.monotonic()-self._last_flush < self.flush_interval: return
+            pending, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+            try:
+                with self.db:
+                    self.db.execute("BEGIN")
+                    # a second point of a series in the same ns replaces the first
+                    self.db.executemany("INSERT OR REPLACE INTO points (series, time, value) VALUES (?, ?, ?)", pending)
+            except Exception as err:
+                # keep them, but not forever
+                self._pending = (pending + self._pending)[-100*self.batch_size:]
+                rpie.SendingError(f"at time {time.time()} {len(pending)} points could not be written to {self.filename} \
+                    \n the following error was encountered: {err}, {type(err)}")
+                return
+            self._cleanup()
+
+    def _cleanup(self):
+        """ deletes the points past retention_days, at most once an hour """
+        if self.retention_days <= 0 or time.monotonic()-self._last_cleanup < 3600: return
+        self._last_cleanup = time.monotonic()
+        oldest = time.time_ns() - int(self.retention_days*86400e9)
+        try:
+            with self.db:
+                self.db.execute("BEGIN")
+                for series in self._series.values():
+                    self.db.execute("DELETE FROM points WHERE series=? AND time<?", (series, oldest))
+        except Exception as err:
+            rpie.SilentError(f"old points could not be deleted from {self.filename}, error: {err}")
+
+    def _select(self, measurement:str = None, start:int = None, end:int = None, field:str = None, tag_value:str = None):
+        """ (measurement, tag_key, tag_value, field, time, value) rows, one series after the other, by time """
+        with self._lock:
+            keys = [(key, series) for key, series in self._series.items()
+                    if (measurement is None or key[0] == measurement) and (field is None or key[3] == field)
+                    and (tag_value is None or key[2] == tag_value)]
+        for key, series in sorted(keys):
+            with self._lock:
+                rows = self.db.execute("SELECT time, value FROM points WHERE series=? AND time>=? AND time<? ORDER BY time",
+                                       (series, start or 0, end or 2**63-1)).fetchall()
+            integer = series in self._integers
+            for timestamp, value in rows:
+                yield (*key, timestamp, int(value) if integer and value is not None else value)
+
+    def query(self, measurement:str, start:float = None, end:float = None, field:str = None, tag_value:str = None):
+        """
+        Args:
+            measurement (str): ie "Electricity Gen"
+            start, end (float): seconds since the epoch, end excluded, None = no limit
+            field, tag_value (str): only this field / tag, None = all of them
+        Returns:
+            dict: {(tag value, field): [(time ns, value), ...]}, points not flushed yet are left out,
+                  the values are ints for the series written with ints
+        """
+        result = {}
+        for _, _, tag, name, timestamp, value in self._select(measurement, self._ns(start), self._ns(end), field, tag_value):
+            result.setdefault((tag, name), []).append((timestamp, value))
+        return result
+
+    def export_lines(self, start:float = None, end:float = None, measurement:str = None):
+        """
+        Yields every point between start and end as a line protocol line, one series after the other
+
+        Args:
+            start, end (float): seconds since the epoch, end excluded, None = no limit
+            measurement (str): only this measurement, None = all of them
+        """
+        self.flush(force=True)
+        for measurement, tag_key, tag_value, field, timestamp, value in self._select(measurement, self._ns(start), self._ns(end)):
+            line = self.encoder.encode(measurement, ((tag_key, tag_value),), {field: value}, timestamp)
+            if line is not None: yield line
+
+    def export(self, filename:str, start:float = None, end:float = None, measurement:str = None):
+        """
+        Writes `export_lines` to a file, ready for the influx CLI or backfill.py
+
+        Returns: int = lines written
+        """
+        count = 0
+        with open(filename, "w") as file:
+            for line in self.export_lines(start, end, measurement):
+                file.write(line + "\n")
+                count += 1
+        return count
+
+    def _ns(self, seconds:float):
+        return None if seconds is None else int(seconds*1e9)
+
+    def stop(self, *args, **kwargs):
+        self.flush(force=True)
+        with self._lock:
+            self.db.close()
@@ -8,14 +8,178 @@ classes:
     - read_config: reads the config files for the project
 """
 
-from ina219 import INA219  # allows RPi to read voltages with the INA219 module
 import psutil # cpu/ram/network monitoring
 import socket # hostname
-import numpy as np 
-import time, os
+import time, os, math
+import importlib
 from configparser import ConfigParser
 
 import rpi_errors as rpie
+from sampling import sample_engine
+
+# config.ini adc_samples -> INA219 ADC setting, 1 is a single 12 bit conversion
+# (names, ina219 is only imported by read_data)
+adc_modes = {1: "ADC_12BIT", 2: "ADC_2SAMP", 4: "ADC_4SAMP", 8: "ADC_8SAMP",
+             16: "ADC_16SAMP", 32: "ADC_32SAMP", 64: "ADC_64SAMP", 128: "ADC_128SAMP"}
+
+# config.ini gain and range -> INA219 setting names
+gains = {"auto": "GAIN_AUTO", "1": "GAIN_1_40MV", "2": "GAIN_2_80MV", "4": "GAIN_4_160MV", "8": "GAIN_8_320MV"}
+ranges = {"16": "RANGE_16V", "32": "RANGE_32V"}
+
+# the model as it was wired before the sensors were in config.ini. The bus used to be read 
+# at 0x44 too, which is the blue house, so it isn't here: a bus sensor needs its own
+# [Sensor bus] section with the address it really has.
+default_sensors = [
+    {"name": "blue_house", "address": 0x44, "shunt_ohms": 0.1, "max_amps": 3, "range": "16", "gain": "auto", "average": True},
+    {"name": "red_house", "address": 0x40, "shunt_ohms": 0.1, "max_amps": 3, "range": "16", "gain": "auto", "average": True},
+    {"name": "green_house", "address": 0x41, "shunt_ohms": 0.1, "max_amps": 3, "range": "16", "gain": "auto", "average": True},
+]
+
+def check_sensors(sensors:[dict,...]):
+    """
+    Makes sure a sensor list can be used: unique names and addresses, known gain and range
+    
+    Raises: CriticalError
+    """
+    if not sensors: raise rpie.CriticalError("No sensors are defined")
+    names = [sensor["name"] for sensor in sensors]
+    addresses = [sensor["address"] for sensor in sensors]
+    for sensor in sensors:
+        if names.count(sensor["name"]) > 1: 
+            raise rpie.CriticalError(f"sensor {sensor['name']} is defined more than once")
+        if addresses.count(sensor["address"]) > 1: 
+            raise rpie.CriticalError(f"{hex(sensor['address'])} is used by more than one sensor")
+        if str(sensor["gain"]) not in gains: 
+            raise rpie.CriticalError(f"{sensor['name']}: gain has to be one of {list(gains)}, not {sensor['gain']}")
+        if str(sensor["range"]) not in ranges: 
+            raise rpie.CriticalError(f"{sensor['name']}: range has to be one of {list(ranges)}, not {sensor['range']}")
+
+# the upload classes, only the one in config.ini is imported: influxdb_client alone takes 
+# longer to import than the rest of the code together on a Pi Zero
+uploaders = {"cloud": ("cloud_solution", "upload_data_influxdb_cloud"),
+             "local": ("local_solution", "upload_data_local_influx"),
+             "collector": ("collector_solution", "upload_data_collector"),
+             "sqlite": ("sqlite_solution", "upload_data_sqlite")}
+
+def load_uploader(name:str):
+    """
+    Imports the module of an upload class when it's first needed
+    
+    Args:    name (str): cloud, local, collector or sqlite (see uploaders)
+    Returns: class: the upload class
+    Raises:  CriticalError: if the name is unknown or the module can't be imported
+    """
+    if name not in uploaders:
+        raise rpie.CriticalError(f"{name} is not a valid uploader, use one of {list(uploaders)}")
+    module, cls = uploaders[name]
+    try:
+        return getattr(importlib.import_module(module), cls)
+    except ImportError as err:
+        raise rpie.CriticalError(f"{module} could not be imported, error: {err}")
+
+def write_budget(name:str, period:float, timeout:float, connect_timeout:float = None):
+    """
+    The longest one failed write can hold up the loop is about connect_timeout + timeout.
+    On the loop thread that has to stay well under the period, or a network drop makes
+    ticks long enough to stop the code (main.py raises CriticalError past 10 s): half
+    the period at most. Longer timeouts are scaled down, and a ShortError says so.
+    
+    Args:
+        name (str): the config.ini section, for the error log
+        period (float): seconds per loop
+        timeout (float): seconds to wait for an answer, None = no limit
+        connect_timeout (float): seconds to wait for the connection, None = same as timeout
+    Returns: (float, float): the timeout and connect timeout to use
+    """
+    budget = period/2
+    if timeout is None: timeout = budget
+    worst = timeout + (timeout if connect_timeout is None else connect_timeout)
+    if worst <= budget: return timeout, connect_timeout
+    scale = budget/worst
+    fitted = (timeout*scale, None if connect_timeout is None else connect_timeout*scale)
+    rpie.ShortError(f"[{name}] a failed write could hold up the loop for {worst:.1f} s, more than half the {period} s period, "
+                    f"the timeouts are cut to {fitted[0]:.2f} s (connect {fitted[1] or fitted[0]:.2f} s). "
+                    f"Turn on the [Upload] worker to keep them")
+    return fitted
+
+def make_uploader(config, name:str, spool=None, background:bool = False):
+    """
+    Creates an upload object from its config.ini section
+    
+    On the loop thread (`background` False) a write is tried once, the first failure opens
+    the circuit breaker so the next writes go straight to the spool, and the timeouts are
+    fitted in the loop (see write_budget): a network drop costs one short timeout, not
+    a tick. The retries of [Resilience] are only for uploaders that have their own thread
+    (the upload worker, the fanout sinks, the collector).
+    
+    Args:
+        config (read_config): the config file
+        name (str): cloud, local, collector or sqlite
+        spool (spool): where the points that couldn't be sent are kept, optional
+        background (bool): the uploader is called from a thread of its own, not from the loop
+    Returns: the upload object
+    Raises:  CriticalError: see load_uploader and the upload classes
+    """
+    upload_dir = config.get_upload()
+    replay_chunk = config.get_spool()["replay_chunk"]
+    resilience_dir = config.get_resilience()
+    if not background: resilience_dir.update(retries=0, failure_threshold=1)
+    uploader = load_uploader(name)
+    if name == "cloud":
+        cloud_dir = config.get_cloud()
+        if not background:
+            cloud_dir["timeout"], cloud_dir["connect_timeout"] = write_budget("Cloud", config.get_period(), cloud_dir["timeout"], cloud_dir["connect_timeout"])
+        return uploader(bucket=cloud_dir["bucket"],
+                        org=cloud_dir["org"],
+                        token= cloud_dir["token"],
+                        url=cloud_dir["url"],
+                        batch=cloud_dir["batch"],
+                        batch_size=cloud_dir["batch_size"],
+                        flush_interval=cloud_dir["flush_interval"],
+                        spool=spool,
+                        replay_chunk=replay_chunk,
+                        encoder=upload_dir["encoder"],
+                        gzip=cloud_dir["gzip"],
+                        pool_size=cloud_dir["pool_size"],
+                        timeout=cloud_dir["timeout"],
+                        connect_timeout=cloud_dir["connect_timeout"],
+                        adaptive=cloud_dir["adaptive"],
+                        target_latency=cloud_dir["target_latency"],
+                        min_batch=cloud_dir["min_batch"],
+                        max_batch=cloud_dir["max_batch"],
+                        report_interval=cloud_dir["report_interval"],
+                        **resilience_dir) 
+    if name == "local":
+        local_dir = config.get_local()
+        if not background:
+            # the client uses the same timeout for the connection and the answer
+            local_dir["timeout"], _ = write_budget("Local", config.get_period(), local_dir["timeout"])
+        return uploader(ifuser=local_dir["ifuser"],
+                        ifpass=local_dir["ifpass"],
+                        ifdb=local_dir["ifdb"],
+                        ifhost=local_dir["ifhost"],
+                        ifport= local_dir["ifport"],
+                        spool=spool,
+                        replay_chunk=replay_chunk,
+                        encoder=upload_dir["encoder"],
+                        timeout=local_dir["timeout"],
+                        **resilience_dir) 
+    if name == "sqlite":
+        sqlite_dir = config.get_sqlite()
+        return uploader(filename=sqlite_dir["filename"],
+                        batch_size=sqlite_dir["batch_size"],
+                        flush_interval=sqlite_dir["flush_interval"],
+                        retention_days=sqlite_dir["retention_days"])
+    collector_dir = config.get_collector()
+    if not background:
+        collector_dir["timeout"], _ = write_budget("Collector", config.get_period(), collector_dir["timeout"])
+    return uploader(url=collector_dir["url"],
+                    source=collector_dir["source"],
+                    token=collector_dir["token"],
+                    timeout=collector_dir["timeout"],
+                    max_buffer=collector_dir["max_buffer"],
+                    spool=spool,
+                    replay_chunk=replay_chunk)
 
 class read_data:
     """
@@ -28,24 +192,53 @@ class read_data:
     ### Methods:
         1. read_ina219
     
+    ### Acquisition:
+        - software: every INA219 is read 10 times, 0.05 s apart, and averaged here
+        - hardware: the INA219s average `adc_samples` conversions themselves and
+                    are read once per measure(), no sleeping and 8x less I2C traffic
     """
-    def __init__(self)->None:
-        try:
-            # Create INA objects only once (as I should have done from the start))
-            self.ina_red = INA219(0.1, 3, address=0x40)
-            self.ina_red.configure(self.ina_red.RANGE_16V, self.ina_red.GAIN_AUTO)
-            
-            self.ina_green = INA219(0.1, 3, address=0x41)
-            self.ina_green.configure(self.ina_green.RANGE_16V, self.ina_green.GAIN_AUTO)
-            
-            self.ina_blue = INA219(0.1, 3, address=0x44)
-            self.ina_blue.configure(self.ina_blue.RANGE_16V, self.ina_blue.GAIN_AUTO)
-            
-            self.ina_bus = INA219(0.1, 3, address=0x44)
-            self.ina_bus.configure(self.ina_blue.RANGE_16V, self.ina_bus.GAIN_AUTO)
-        except Exception as err:
+    def __init__(self, acquisition:str="software", adc_samples:int=128, sensors:[dict,...]=None)->None:
+        """
+        ### Arguments:
+            acquisition: str = software or hardware
+            adc_samples: int = conversions averaged by the INA219 in hardware acquisition
+            sensors: list = [{name, address, shunt_ohms, max_amps, range, gain, average}], 
+                            from read_config.get_sensor_list(), default_sensors when not given.
+                            `average` sensors make up bus_average.
+                            A sensor that doesn't answer is logged (MeasuringError) and left
+                            out, only having none at all stops the code.
+        """
+        if acquisition not in ("software", "hardware"):
+            raise rpie.CriticalError(f"{acquisition} is not a valid acquisition mode, use software or hardware")
+        if acquisition == "hardware" and adc_samples not in adc_modes:
+            raise rpie.CriticalError(f"adc_samples has to be one of {list(adc_modes)}, not {adc_samples}")
+        sensors = sensors or default_sensors
+        check_sensors(sensors)
+        from ina219 import INA219  # allows RPi to read voltages with the INA219 module
+        adc = getattr(INA219, adc_modes[adc_samples] if acquisition == "hardware" else "ADC_12BIT")
+        
+        # the registry: sensor name -> INA219, created only once
+        self.sensors = {}
+        for sensor in sensors:
+            try:
+                ina = INA219(sensor["shunt_ohms"], sensor["max_amps"], address=sensor["address"])
+                # configure is the first write to the chip, it fails if nothing is at the address
+                ina.configure(getattr(ina, ranges[str(sensor["range"])]), getattr(ina, gains[str(sensor["gain"])]), 
+                              bus_adc=adc, shunt_adc=adc)
+            except Exception as err:
+                print(f"INA219 {sensor['name']} at {hex(sensor['address'])} not found, it is skipped")
+                rpie.MeasuringError(f"could not create the INA219 {sensor['name']} at {hex(sensor['address'])}, it is skipped, error: \n {err}")
+                continue
+            self.sensors[sensor["name"]] = ina
+        if not self.sensors:
             print("##################################")
-            raise rpie.CriticalError(f"could not create INA Objects, error: \n {err}")
+            raise rpie.CriticalError(f"none of the INA219s could be created: {[hex(sensor['address']) for sensor in sensors]}")
+        
+        # same order as the names given to the sampling engine
+        self.ina_list = list(self.sensors.values())
+        self.acquisition = acquisition
+        self.engine = sample_engine(list(self.sensors), rounds=10 if acquisition == "software" else 1,
+                                    average_of=[sensor["name"] for sensor in sensors if sensor.get("average")])
         
         
     def read_ina219(self, ina):
@@ -55,64 +248,51 @@ class read_data:
         Returns: dict: {voltage: float, power: float, bus_voltage:float}
         Raises:  MeasurementError: if measuring the voltage fails
         """
-        # measurement
-        try:
-            v = ina.voltage()
-            v_shunt = ina.shunt_voltage()
-        except Exception as err:
-            rpie.MeasuringError("Error encountered when measuring voltage with the ina219")
-            
-        # average and pack
+        v_shunt, power, v = self.read_sensor(ina)
+        
+        # pack
         result = {
             "voltage": round(v_shunt,4),
-            "power": round(0.1*(v**2),3),
+            "power": round(power,3),
             "bus_voltage": round(v,3)
         }
         
         #send
         return result
     
+    def read_sensor(self, ina):
+        """ 
+        One raw reading, in the order of sampling.channels
+        Args:    ina (object): pass an INA219() object 
+        Returns: tuple: (voltage, power, bus_voltage), NaN if the reading failed
+        Raises:  MeasurementError: if measuring the voltage fails
+        """
+        try:
+            v = ina.voltage()
+            v_shunt = ina.shunt_voltage()
+        except Exception as err:
+            rpie.MeasuringError(f"Error encountered when measuring voltage with the ina219: {err}")
+            return (float("nan"), float("nan"), float("nan"))
+        return (v_shunt, 0.1*(v**2), v)
+    
     def measure(self):
-        """Measures voltage from four parts
+        """Measures voltage from every sensor in the registry, 10 times each and averaged 
+        (once each in hardware acquisition, the INA219 does the averaging)
 
         Returns:
-            dict: { house/blue/green/red/bus: read_ina(), bus_average: {voltage: float, power: float}}
+            dict: { sensor name: read_ina(), bus_average: {voltage: float, power: float}}
         """
-        # get the right shape
-        data= {
-            "blue_house": self.read_ina219(self.ina_blue),
-            "red_house": self.read_ina219(self.ina_red),
-            "green_house" :self.read_ina219(self.ina_green),
-            "bus": self.read_ina219(self.ina_bus)
-        }
-        time.sleep(0.05) 
-        
-        ina_list=[self.ina_blue, self.ina_red,self.ina_green, self.ina_bus]
-        data_keys=list(data.keys())
-        
-        for x in range(9):
-            for i in range(4): # loop through all ina
-                measure = self.read_ina219(ina=ina_list[i])
-                for key in measure: # at every ina, loop through all measurements and add the value taken 
-                    data[data_keys[i]][key]+=measure[key]    
-            time.sleep(0.05) 
-
-        # average out every value
-        for key in data.keys(): 
-            for value in data[key].values(): 
-                value = value/10 # 10 because we measure once at start
-                
-        # get average bus voltage
-        bus_voltage=0
-        for key in ["blue_house","red_house","green_house"]: bus_voltage += data[key]["bus_voltage"]
-        bus_voltage /= 3
-        
-        data["bus_average"]= {
-            "voltage": float(round(bus_voltage,3)),
-            "power":float(round(0.1*(bus_voltage**2),3))
-        }
+        self.engine.sample(self.read_sensor, self.ina_list, delay=0.05)
+        return self.engine.as_dict()
+    
+    def measure_stats(self):
+        """
+        Statistics of the last measure() call
         
-        return data
+        Returns:
+            dict: {mean/min/max/std: same shape as measure()}
+        """
+        return {statistic: self.engine.as_dict(statistic) for statistic in ("mean","min","max","std")}
         
     def measure_cpu(self):
         """
@@ -171,56 +351,40 @@ class read_fake_data:
     in diagnosing data accuracy. 
     
     """
-    def __init__(self)->None:
-        self.ina_blue =1
-        self.ina_red =2
-        self.ina_green =3
-        self.ina_bus =0
+    def __init__(self, acquisition:str="software", adc_samples:int=128, sensors:[dict,...]=None)->None:
+        sensors = sensors or default_sensors
+        check_sensors(sensors)
+        # every fake sensor is a number, the amplitude of its sine
+        self.sensors = {sensor["name"]: number+1 for number, sensor in enumerate(sensors)}
+        
+        self.ina_list = list(self.sensors.values())
+        self.acquisition = acquisition
+        self.engine = sample_engine(list(self.sensors), rounds=10 if acquisition == "software" else 1,
+                                    average_of=[sensor["name"] for sensor in sensors if sensor.get("average")])
         
     def measure(self):
         """
         # Fake
-        Measures voltage from four parts
+        Measures voltage from every sensor
 
         Returns:
-            dict: { house/blue/green/red/bus: read_ina(), bus_average: {voltage: float, power: float}}
+            dict: { sensor name: read_ina(), bus_average: {voltage: float, power: float}}
         """
-
-        # get the right shape
-        data= {
-            "blue_house": self.read_ina219(self.ina_blue),
-            "red_house": self.read_ina219(self.ina_red),
-            "green_house" :self.read_ina219(self.ina_green),
-            "bus": self.read_ina219(self.ina_bus)
-        }
-        time.sleep(0.05) 
-        
-        ina_list=[self.ina_blue, self.ina_red,self.ina_green, self.ina_bus]
-        data_keys=list(data.keys())
-        
-        for x in range(9):
-            for i in range(4): # loop through all ina
-                measure = self.read_ina219(ina=ina_list[i])
-                for key in measure: # at every ina, loop through all measurements and add the value taken 
-                    data[data_keys[i]][key]+=float(measure[key])    
-            time.sleep(0.05) 
-
-        # average out every value
-        for key in data.keys(): 
-            for value in data[key].values(): 
-                value = value/10 # 10 because we measure once at start
-                
-        # get average bus voltage
-        bus_voltage=0
-        for key in ["blue_house","red_house","green_house"]: bus_voltage += data[key]["bus_voltage"]
-        bus_voltage /= 3
-        
-        data["bus_average"]= {
-            "voltage": float(round(bus_voltage,3)),
-            "power":float(round(0.1*(bus_voltage**2),3))
-        }
-        
-        return data
+        self.engine.sample(self.read_sensor, self.ina_list, delay=0.05)
+        return self.engine.as_dict()
+    
+    def measure_stats(self):
+        """ # Fake
+        Returns:
+            dict: {mean/min/max/std: same shape as measure()}
+        """
+        return {statistic: self.engine.as_dict(statistic) for statistic in ("mean","min","max","std")}
+    
+    def read_sensor(self, ina):
+        """ # Fake
+        Returns: tuple: (voltage, power, bus_voltage)
+        """
+        return (float(ina*math.sin(time.time_ns())), float(ina*math.sin(time.time_ns())), float(ina*math.sin(time.time_ns())))
     
     def read_ina219(self, ina):
         """ # Fake
@@ -230,9 +394,9 @@ class read_fake_data:
         Raises:  MeasurementError: if measuring the voltage fails
         """
         result = {
-            "voltage": float(ina*np.sin(time.time_ns())),
-            "power": float(ina*np.sin(time.time_ns())),
-            "bus_voltage": float(ina*np.sin(time.time_ns()))
+            "voltage": float(ina*math.sin(time.time_ns())),
+            "power": float(ina*math.sin(time.time_ns())),
+            "bus_voltage": float(ina*math.sin(time.time_ns()))
         }
         return result
     
@@ -248,8 +412,8 @@ class read_fake_data:
         Raises: SilentError
         """
         try:
-            cpu_usage= float(1*abs(np.sin(time.time_ns())))*100
-            ram_usage= float(2*abs(np.cos(time.time_ns())))*500
+            cpu_usage= float(1*abs(math.sin(time.time_ns())))*100
+            ram_usage= float(2*abs(math.cos(time.time_ns())))*500
         except Exception as err:
             rpie.SilentError("CPU or RAM could not be measured")
             cpu_usage= -1.0
@@ -270,8 +434,8 @@ class read_fake_data:
         Raises: ShortError when it fails and changes the numbers
         """
         try:
-            net_in = float(2*abs(np.cos(time.time_ns())))*10
-            net_out = float(2*abs(np.cos(time.time_ns())))*100
+            net_in = float(2*abs(math.cos(time.time_ns())))*10
+            net_out = float(2*abs(math.cos(time.time_ns())))*100
         except Exception as err:
             rpie.ShortError(f"Network mesurment failed: {err}")
         return net_in,net_out
@@ -325,21 +489,184 @@ class read_config:
             raise rpie.CriticalError(f"{filename} is nt the correct path!")
         
         self.config.read(filenames=filename)
+        self.filename = filename
     def get_methods(self):
         cloud = self.config.getboolean(section="Method",option="Cloud") 
         fake = self.config.getboolean(section="Method",option="Fake")
         return cloud, fake
     def get_time(self):
-        total_time= self.config.getint(section="Time", option="Seconds")/3
+        total_time= self.config.getint(section="Time", option="Seconds")/self.get_period()
         endless = self.config.getboolean(section="Time", option="Endless")
         return total_time, endless
+    def get_period(self):
+        return self.config.getfloat(section="Time", option="Period", fallback=3)
+    def get_startup_budget(self):
+        return self.config.getfloat(section="Time", option="startup_budget", fallback=60)
     def get_cloud(self):
         _dir={}
         for item in ["bucket","org","token","url"]:
             _dir[item]=self.config.get("Cloud", option=item)
+        # batching is optional, older config files don't have it
+        _dir["batch"]=self.config.getboolean("Cloud", option="batch", fallback=False)
+        _dir["batch_size"]=self.config.getint("Cloud", option="batch_size", fallback=500)
+        _dir["flush_interval"]=self.config.getfloat("Cloud", option="flush_interval", fallback=0)
+        # transport, the defaults are the client's
+        _dir["gzip"]=self.config.getboolean("Cloud", option="gzip", fallback=False)
+        pool_size=self.config.get("Cloud", option="pool_size", fallback="").strip()
+        _dir["pool_size"]=int(pool_size) if pool_size else None
+        _dir["timeout"]=self.config.getfloat("Cloud", option="timeout", fallback=10)
+        connect_timeout=self.config.get("Cloud", option="connect_timeout", fallback="").strip()
+        _dir["connect_timeout"]=float(connect_timeout) if connect_timeout else None
+        _dir["adaptive"]=self.config.getboolean("Cloud", option="adaptive", fallback=False)
+        _dir["target_latency"]=self.config.getfloat("Cloud", option="target_latency", fallback=2)
+        _dir["min_batch"]=self.config.getint("Cloud", option="min_batch", fallback=50)
+        _dir["max_batch"]=self.config.getint("Cloud", option="max_batch", fallback=5000)
+        _dir["report_interval"]=self.config.getfloat("Cloud", option="report_interval", fallback=3600)
         return _dir
     def get_local(self):
         _dir={}
         for item in ["ifuser","ifpass","ifdb","ifhost","ifport"]:
             _dir[item]=self.config.get("Local", option=item)
+        # empty = no limit, older config files don't have it
+        timeout=self.config.get("Local", option="timeout", fallback="").strip()
+        _dir["timeout"]=float(timeout) if timeout else None
+        return _dir
+    def get_upload(self):
+        _dir={}
+        _dir["worker"]=self.config.getboolean("Upload", option="worker", fallback=False)
+        _dir["queue_size"]=self.config.getint("Upload", option="queue_size", fallback=100)
+        _dir["overflow"]=self.config.get("Upload", option="overflow", fallback="drop_oldest")
+        _dir["encoder"]=self.config.get("Upload", option="encoder", fallback="default")
+        return _dir
+    def get_sensors(self):
+        _dir={}
+        _dir["acquisition"]=self.config.get("Sensors", option="acquisition", fallback="software")
+        _dir["adc_samples"]=self.config.getint("Sensors", option="adc_samples", fallback=128)
+        return _dir
+    def get_sensor_list(self):
+        """
+        Every [Sensor <name>] section is one INA219, in the order they are written.
+        Without any, the default_sensors are used.
+        
+        Returns: list: [{name, address, shunt_ohms, max_amps, range, gain, average}]
+        Raises:  CriticalError: a section without a valid address, there is no default for it
+        """
+        sensors=[]
+        for section in self.config.sections():
+            if not section.startswith("Sensor "): continue
+            address=self.config.get(section, option="address", fallback="").strip()
+            try:
+                address=int(address, 0) # 0x40 or 64
+            except ValueError:
+                raise rpie.CriticalError(f"[{section}] needs the I2C address of its INA219, not '{address}'")
+            sensors.append({
+                "name": section[len("Sensor "):].strip(),
+                "address": address,
+                "shunt_ohms": self.config.getfloat(section, option="shunt_ohms", fallback=0.1),
+                "max_amps": self.config.getfloat(section, option="max_amps", fallback=3),
+                "range": self.config.get(section, option="range", fallback="16"),
+                "gain": self.config.get(section, option="gain", fallback="auto").lower(),
+                "average": self.config.getboolean(section, option="average", fallback=False)
+            })
+        return sensors or default_sensors
+    def get_sampling(self):
+        _dir={}
+        _dir["mode"]=self.config.get("Sampling", option="mode", fallback="window")
+        _dir["rate"]=self.config.getfloat("Sampling", option="rate", fallback=20)
+        _dir["buffer_seconds"]=self.config.getfloat("Sampling", option="buffer_seconds", fallback=60)
+        _dir["raw"]=self.config.getboolean("Sampling", option="raw", fallback=False)
+        return _dir
+    def get_rollup(self):
+        _dir={}
+        _dir["enabled"]=self.config.getboolean("Rollup", option="enabled", fallback=False)
+        windows=self.config.get("Rollup", option="windows", fallback="60, 900")
+        _dir["windows"]=[int(window) for window in windows.split(",") if window.strip()]
+        # "Electricity Gen=1, network=0" -> {"Electricity Gen": 1, "network": 0}
+        _dir["raw_every"]={}
+        for item in self.config.get("Rollup", option="raw_every", fallback="").split(","):
+            if "=" not in item: continue
+            name, every = item.rsplit("=", 1)
+            _dir["raw_every"][name.strip()]=int(every)
+        return _dir
+    def get_deadband(self):
+        _dir={}
+        _dir["enabled"]=self.config.getboolean("Deadband", option="enabled", fallback=False)
+        _dir["heartbeat"]=self.config.getfloat("Deadband", option="heartbeat", fallback=300)
+        # every other option is a field name and its threshold
+        _dir["thresholds"]={}
+        if self.config.has_section("Deadband"):
+            for field, threshold in self.config.items("Deadband", raw=True):
+                if field not in ("enabled", "heartbeat"): _dir["thresholds"][field]=threshold
+        return _dir
+    def get_resilience(self):
+        _dir={}
+        _dir["retries"]=self.config.getint("Resilience", option="retries", fallback=2)
+        _dir["base_delay"]=self.config.getfloat("Resilience", option="base_delay", fallback=0.2)
+        _dir["max_delay"]=self.config.getfloat("Resilience", option="max_delay", fallback=2)
+        _dir["failure_threshold"]=self.config.getint("Resilience", option="failure_threshold", fallback=3)
+        _dir["reset_timeout"]=self.config.getfloat("Resilience", option="reset_timeout", fallback=30)
+        return _dir
+    def get_history(self):
+        _dir={}
+        _dir["enabled"]=self.config.getboolean("History", option="enabled", fallback=False)
+        _dir["hours"]=self.config.getfloat("History", option="hours", fallback=6)
+        _dir["slot_seconds"]=self.config.getfloat("History", option="slot_seconds", fallback=self.get_period())
+        _dir["max_series"]=self.config.getint("History", option="max_series", fallback=64)
+        return _dir
+    def get_replay(self):
+        _dir={}
+        _dir["source"]=self.config.get("Replay", option="source", fallback="")
+        _dir["speed"]=self.config.getfloat("Replay", option="speed", fallback=1)
+        _dir["loop"]=self.config.getboolean("Replay", option="loop", fallback=True)
+        _dir["record"]=self.config.get("Replay", option="record", fallback="")
+        return _dir
+    def get_metrics(self):
+        _dir={}
+        _dir["enabled"]=self.config.getboolean("Metrics", option="enabled", fallback=True)
+        _dir["interval"]=self.config.getfloat("Metrics", option="interval", fallback=60)
+        return _dir
+    def get_sqlite(self):
+        _dir={}
+        _dir["enabled"]=self.config.getboolean("SQLite", option="enabled", fallback=False)
+        filename=self.config.get("SQLite", option="filename", fallback="data/solar.sqlite")
+        # relative to the code folder, like the spool
+        _dir["filename"]=filename if os.path.isabs(filename) else os.path.join(os.path.dirname(os.path.abspath(self.filename)), filename)
+        _dir["batch_size"]=self.config.getint("SQLite", option="batch_size", fallback=500)
+        _dir["flush_interval"]=self.config.getfloat("SQLite", option="flush_interval", fallback=30)
+        _dir["retention_days"]=self.config.getfloat("SQLite", option="retention_days", fallback=0)
+        return _dir
+    def get_fanout(self):
+        _dir={}
+        sinks=self.config.get("Fanout", option="sinks", fallback="")
+        _dir["sinks"]=[sink.strip() for sink in sinks.split(",") if sink.strip()]
+        for sink in _dir["sinks"]:
+            if sink not in uploaders:
+                raise rpie.CriticalError(f"[Fanout] {sink} is not a valid sink, use some of {list(uploaders)}")
+        _dir["timeout"]=self.config.getfloat("Fanout", option="timeout", fallback=5)
+        _dir["max_pending"]=self.config.getint("Fanout", option="max_pending", fallback=100)
+        return _dir
+    def get_collector(self):
+        _dir={}
+        # the Pi side
+        _dir["enabled"]=self.config.getboolean("Collector", option="enabled", fallback=False)
+        _dir["url"]=self.config.get("Collector", option="url", fallback="http://localhost:8090")
+        _dir["source"]=self.config.get("Collector", option="source", fallback="") or None
+        _dir["token"]=self.config.get("Collector", option="token", fallback="").strip() or None
+        _dir["timeout"]=self.config.getfloat("Collector", option="timeout", fallback=5)
+        _dir["max_buffer"]=self.config.getint("Collector", option="max_buffer", fallback=10000)
+        # the collector side
+        _dir["listen"]=self.config.get("Collector", option="listen", fallback="127.0.0.1")
+        _dir["port"]=self.config.getint("Collector", option="port", fallback=8090)
+        _dir["batch_size"]=self.config.getint("Collector", option="batch_size", fallback=5000)
+        _dir["flush_interval"]=self.config.getfloat("Collector", option="flush_interval", fallback=5)
+        _dir["source_limit"]=self.config.getint("Collector", option="source_limit", fallback=20000)
+        _dir["max_pending"]=self.config.getint("Collector", option="max_pending", fallback=200000)
+        return _dir
+    def get_spool(self):
+        _dir={}
+        _dir["enabled"]=self.config.getboolean("Spool", option="enabled", fallback=False)
+        _dir["directory"]=self.config.get("Spool", option="directory", fallback="spool")
+        _dir["segment_size"]=self.config.getint("Spool", option="segment_size", fallback=1_000_000)
+        _dir["max_size"]=self.config.getint("Spool", option="max_size", fallback=100_000_000)
+        _dir["replay_chunk"]=self.config.getint("Spool", option="replay_chunk", fallback=5000)
         return _dir
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+Transport tuning for the cloud writes, over a cellular uplink whose latency swings by 10x.
+
+A batch size that suits a good connection makes every request time out on a bad one,
+and one that suits a bad connection wastes requests (and their headers) on a good one.
+The batch size follows the measured latency instead. The SIMs are paid per MB, so
+the bytes saved by gzip are counted and published.
+
+classes:
+    - batch_controller: grows or shrinks the batch size to hit a target latency per request
+    - wire_meter: bytes before and after compression, and how many a day that saves
+"""
+
+import time, threading
+
+
+class batch_controller:
+    """
+        ## Purpose and use:
+            Every write reports how many points it carried and how long it took. The
+            latency is smoothed (EWMA), and the size is scaled by target/latency after
+            every write, by at most `max_step` either way:
+
+                latency 4 s, target 2 s: 1000 points -> 500
+                latency 0.5 s, target 2 s: 1000 points -> 2000 (max_step 2)
+
+            Only writes that carried at least half the current size can grow it: a loop
+            of 10 points going through quickly says nothing about 5000. Any slow write
+            shrinks it, and a failed write counts as a write that took `timeout`.
+        ### Methods:
+            - `record`: the result of one write
+            - `stats`: size, smoothed latency and the number of changes
+    """
+    def __init__(self, size:int = 500, target:float = 2, minimum:int = 50, maximum:int = 5000,
+                 smoothing:float = 0.3, max_step:float = 2, timeout:float = 10):
+        """
+        ### Arguments:
+            size: int = starting batch size
+            target: float = seconds one request should take
+            minimum, maximum: int = limits of the batch size
+            smoothing: float = weight of the newest latency in the average, 0 to 1
+            max_step: float = largest factor the size changes by after one write
+            timeout: float = latency counted for a failed write
+        """
+        self.target = float(target)
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.size = min(self.maximum, max(self.minimum, int(size)))
+        self.smoothing = float(smoothing)
+        self.max_step = max(1.0, float(max_step))
+        self.timeout = float(timeout)
+        self.latency = None
+        self.changes = 0
+        self._lock = threading.Lock()
+
+    def record(self, points:int, seconds:float = None, failed:bool = False):
+        """
+        Args:
+            points (int): points in the request
+            seconds (float): how long it took
+            failed (bool): the write raised, `seconds` is replaced by the timeout
+        Returns:
+            int: the new batch size
+        """
+        if failed: seconds = max(self.timeout, seconds or 0)
+        with self._lock:
+            self.latency = seconds if self.latency is None else self.smoothing*seconds + (1-self.smoothing)*self.latency
+            factor = min(self.max_step, max(1/self.max_step, self.target/max(self.latency, 1e-3)))
+            if factor > 1 and points < self.size/2: return self.size
+            size = min(self.maximum, max(self.minimum, int(self.size*factor)))
+            if size != self.size:
+                self.size = size
+                self.changes += 1
+            return self.size
+
+    def stats(self):
+        """ Returns: dict: {batch_size, latency_ms, changes} """
+        with self._lock:
+            return {"batch_size": self.size, "latency_ms": (self.latency or 0.0)*1e3, "changes": self.changes}
+
+
+class wire_meter:
+    """
+        ## Purpose and use:
+            Counts the bytes of every request body before (`raw`) and after (`wire`)
+            compression. `report` gives the totals since the last reset and the bytes
+            saved scaled to a day, and by default starts again:
+
+                saved_per_day = (raw - wire) / seconds since last report * 86400
+        ### Methods:
+            - `add`: one request body
+            - `report`: totals since the last reset
+    """
+    def __init__(self, clock = time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._start = clock()
+        self.raw = 0
+        self.wire = 0
+        self.requests = 0
+
+    def add(self, raw:int, wire:int):
+        with self._lock:
+            self.raw += raw
+            self.wire += wire
+            self.requests += 1
+
+    def report(self, reset:bool = True):
+        """ Returns: dict: {requests, raw_bytes, wire_bytes, saved_bytes, saved_per_day, ratio} """
+        with self._lock:
+            now = self.clock()
+            seconds = max(now - self._start, 1e-9)
+            raw, wire, requests = self.raw, self.wire, self.requests
+            if reset:
+                self.raw = self.wire = self.requests = 0
+                self._start = now
+        return {"requests": requests, "raw_bytes": raw, "wire_bytes": wire, "saved_bytes": raw - wire,
+                "saved_per_day": (raw - wire)/seconds*86400, "ratio": raw/wire if wire else 1.0}
@@ -0,0 +1,163 @@
+"""
+A background stage that sits in front of the upload classes.
+
+The main loop only hands its data to a bounded queue and a worker thread does the
+sending, so a slow or unreachable database can't push the loop past its 3 seconds.
+
+classes:
+    - upload_worker: wraps upload_data_influxdb_cloud or upload_data_local_influx
+"""
+
+import threading, time
+from collections import deque
+import rpi_errors as rpie
+from metrics import timers
+
+
+class upload_worker:
+    """
+        ## Purpose and use:
+            Takes the same calls as the uploader it wraps, but only queues them.
+            A daemon thread drains the queue in order and calls the real uploader,
+            which still raises its own rpi errors (from the worker thread).
+            `local_performance`, `net_usage` and `generic` are given the time they were
+            queued at (`timestamp`, unless the caller gave one), so a slow write or a long
+            queue doesn't move the points to the time they were sent at.
+
+            When the queue is full the `overflow` policy decides what happens:
+                - `drop_oldest`: forget the oldest queued call to make room
+                - `drop_newest`: forget the call being added
+                - `block`: wait for the worker to make room (the old behaviour, but bounded by the queue)
+        ### Methods:
+            - `local_performance`, `net_usage`, `generic`, `raw_series`, `flush`: queued versions of the uploader methods
+            - `stats`: queue depth and counters
+            - `stop`: sends what is still queued and stops the thread
+    """
+    policies = ("drop_oldest", "drop_newest", "block")
+
+    def __init__(self, uploader, queue_size:int = 100, overflow:str = "drop_oldest"):
+        """
+        ### Arguments:
+            uploader: an upload_data_influxdb_cloud or upload_data_local_influx object
+            queue_size: int = how many calls can wait in memory
+            overflow: str = one of `drop_oldest`, `drop_newest`, `block`
+        ### Raises:
+            rpie.CriticalError: if the overflow policy is unknown
+        """
+        if overflow not in self.policies:
+            raise rpie.CriticalError(f"{overflow} is not a valid overflow policy, use one of {self.policies}")
+
+        self.uploader = uploader
+        self.queue_size = max(1, int(queue_size))
+        self.overflow = overflow
+
+        self._queue = deque()
+        self._lock = threading.Condition()
+        self._running = True
+        self._busy = False
+        self._dropping = False
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+        self._thread = threading.Thread(target=self._run, name="upload_worker", daemon=True)
+        self._thread.start()
+
+    def local_performance(self, *args, **kwargs):
+        self._stamp(kwargs)
+        self._put("local_performance", args, kwargs)
+
+    def net_usage(self, *args, **kwargs):
+        self._stamp(kwargs)
+        self._put("net_usage", args, kwargs)
+
+    def generic(self, *args, **kwargs):
+        self._stamp(kwargs)
+        self._put("generic", args, kwargs)
+
+    def _stamp(self, kwargs:dict):
+        """ the time the call was queued at, unless the stage in front gave one """
+        if kwargs.get("timestamp") is None: kwargs["timestamp"] = time.time_ns()
+
+    def raw_series(self, *args, **kwargs):
+        self._put("raw_series", args, kwargs)
+
+    def flush(self, *args, **kwargs):
+        # the local uploader has nothing to flush
+        if hasattr(self.uploader, "flush"):
+            self._put("flush", args, kwargs)
+
+    def stats(self):
+        """
+        Returns: dict: {depth: int, max_depth: int, sent: int, failed: int, dropped: int}
+        """
+        with self._lock:
+            return {
+                "depth": len(self._queue),
+                "max_depth": self.max_depth,
+                "sent": self.sent,
+                "failed": self.failed,
+                "dropped": self.dropped
+            }
+
+    def stop(self, timeout:float = 10):
+        """
+        Waits up to `timeout` seconds for the queue to be sent, then stops the worker
+        and the uploader (if it has a stop method).
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while (self._queue or self._busy) and time.monotonic() < deadline:
+                self._lock.wait(timeout=max(0, deadline-time.monotonic()))
+            self._running = False
+            self._lock.notify_all()
+        self._thread.join(timeout=max(0, deadline-time.monotonic()))
+        if hasattr(self.uploader, "stop"): self.uploader.stop()
+
+    def _put(self, method:str, args, kwargs):
+        with self._lock:
+            if len(self._queue) >= self.queue_size:
+                if self.overflow == "block":
+                    while len(self._queue) >= self.queue_size and self._running:
+                        self._lock.wait()
+                else:
+                    self.dropped += 1
+                    if not self._dropping:
+                        # only log once per overflow, not for every call that is lost
+                        self._dropping = True
+                        rpie.SilentError(f"upload queue is full ({self.queue_size} calls), using {self.overflow} until it drains")
+                    if self.overflow == "drop_newest": return
+                    self._queue.popleft()
+
+            self._queue.append((method, args, kwargs))
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._lock.notify_all()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and self._running:
+                    self._lock.wait()
+                if not self._queue: return
+                method, args, kwargs = self._queue.popleft()
+                self._busy = True
+                if len(self._queue) < self.queue_size // 2: self._dropping = False
+                self._lock.notify_all()
+
+            try:
+                # the time the real write took, main.py only sees the time to queue it
+                with timers.time(f"worker_{method}"):
+                    getattr(self.uploader, method)(*args, **kwargs)
+                ok = True
+            except Exception as err:
+                # the uploaders only raise CriticalError, the thread has to survive it
+                ok = False
+                rpie.SilentError(f"upload worker could not run {method}, error: {err}, {type(err)}")
+
+            with self._lock:
+                if ok: self.sent += 1
+                else: self.failed += 1
+                self._busy = False
+                self._lock.notify_all()